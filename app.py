@@ -1,12 +1,18 @@
 import os
-import boto3
 import chainlit as cl
-from chainlit.input_widget import Select, Slider, Switch
+from chainlit.input_widget import Select, Slider, Switch, Tags, TextInput
 from typing import Optional
 import app_retrieve_generate
 import app_retrieve
+import app_retrieve_filter
+import app_rerank
+import app_query_expansion
 import app_generate
+import app_bedrock
 import app_bedrock_lib
+import app_metrics
+import app_logging
+import app_admission
 from typing import List
 
 
@@ -16,10 +22,8 @@ AUTH_ADMIN_PWD = os.environ["AUTH_ADMIN_PWD"]
 AUTH_USER_USR = os.environ["AUTH_USER_USR"]
 AUTH_USER_PWD = os.environ["AUTH_USER_PWD"]
 
-bedrock = boto3.client("bedrock", region_name=AWS_REGION)
-bedrock_runtime = boto3.client('bedrock-runtime', region_name=AWS_REGION)
-bedrock_agent = boto3.client('bedrock-agent', region_name=AWS_REGION)
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
+app_logging.setup()
+app_metrics.mount_metrics_endpoint()
 
 @cl.password_auth_callback
 def auth_callback(username: str, password: str) -> Optional[cl.User]:
@@ -59,6 +63,11 @@ async def setup_settings():
                 values=kb_id_list,
                 initial_index=0
             ),
+            Tags(
+                id="AdditionalKnowledgeBases",
+                label="Additional KnowledgeBase IDs - Retrieve mode searches these together with the KnowledgeBase above (IDs from the list above)",
+                initial=[],
+            ),
             Slider(
                 id = "RetrieveDocumentCount",
                 label = "KnowledgeBase DocumentCount",
@@ -67,6 +76,20 @@ async def setup_settings():
                 max = 24,
                 step = 1,
             ),
+            Select(
+                id = "SearchType",
+                label = "KnowledgeBase Search Type",
+                values = ["DEFAULT", "HYBRID", "SEMANTIC"],
+                initial_index = 0,
+            ),
+            TextInput(
+                id = "MetadataFilter",
+                label = "KnowledgeBase Metadata Filter - JSON, e.g. {\"equals\": {\"key\": \"category\", \"value\": \"pumps\"}}",
+                initial = "",
+            ),
+            Switch(id="Rerank", label=f"Retrieve - Rerank (fetch {app_rerank.RERANK_FETCH_COUNT}, keep DocumentCount)", initial=app_rerank.RERANK_ENABLED),
+            Switch(id="MultiQuery", label=f"Retrieve - Multi-Query ({1 + app_query_expansion.QUERY_EXPANSION_COUNT} searches, rank fusion)", initial=app_query_expansion.QUERY_EXPANSION_ENABLED),
+            Switch(id="AutoFilter", label="Retrieve - Filter by Entities in the Question (e.g. Product Codes)", initial=False),
             Select(
                 id = "Mode",
                 label = "KnowledgeBase Generation Mode",
@@ -111,6 +134,7 @@ async def setup_settings():
                 max = 4096,
                 step = 256,
             ),
+            Switch(id="PromptTemplate", label="RetrieveAndGenerate - Custom Prompt Template", initial=True),
             Switch(id="Strict", label="Retrieve - Limit Answers to KnowledgeBase", initial=False),
             Switch(id="Terse", label="Terse - Terse & Consise Answers", initial=False),
             Switch(id="AlignUnitsOfMeasure", label="Align Units of Measure", initial=True),
@@ -120,26 +144,48 @@ async def setup_settings():
         ]
     ).send()
 
-    print("Save Settings: ", settings)
+    app_logging.payload("settings.save", settings)
 
     return settings
 
 @cl.on_settings_update
 async def setup_agent(settings):
 
-    print("Setup Agent: ", settings)
+    app_logging.payload("settings.setup", settings)
 
     knowledge_base_id = settings["KnowledgeBase"]
     knowledge_base_id = knowledge_base_id.split(" ", 1)[0]
+
+    # typed ids are checked against the KnowledgeBase listing: an unknown one would fail every Retrieve
+    additional_knowledge_base_ids = [kb_id.strip().split(" ", 1)[0] for kb_id in settings.get("AdditionalKnowledgeBases") or []]
+    additional_knowledge_base_ids, unknown_knowledge_base_ids = await app_bedrock_lib.known_knowledge_base_ids([kb_id for kb_id in additional_knowledge_base_ids if kb_id])
+    if unknown_knowledge_base_ids:
+        await cl.Message(content=f"Unknown KnowledgeBase IDs ignored: {', '.join(unknown_knowledge_base_ids)}").send()
+
+    knowledge_base_ids = [knowledge_base_id]
+    for additional_knowledge_base_id in additional_knowledge_base_ids:
+        if additional_knowledge_base_id not in knowledge_base_ids:
+            knowledge_base_ids.append(additional_knowledge_base_id)
     
     llm_model_arn = "arn:aws:bedrock:{}::foundation-model/{}".format(AWS_REGION, settings["Model"])
     mode = settings["Mode"]
     strict = settings["Strict"]
     kb_retrieve_document_count = int(settings["RetrieveDocumentCount"])
+    # DEFAULT leaves the search type to the KnowledgeBase
+    kb_search_type = settings["SearchType"] if settings["SearchType"] != "DEFAULT" else None
+    kb_prompt_template = settings["PromptTemplate"]
+    kb_auto_filter = settings.get("AutoFilter", False)
+    kb_rerank = settings.get("Rerank", app_rerank.RERANK_ENABLED)
+    kb_multi_query = settings.get("MultiQuery", app_query_expansion.QUERY_EXPANSION_ENABLED)
+    try:
+        kb_metadata_filter = app_retrieve_filter.parse_filter(settings.get("MetadataFilter"))
+    except ValueError as e:
+        kb_metadata_filter = None
+        await cl.Message(content=f"Metadata filter ignored: {e}").send()
 
     bedrock_model_id = settings["Model"]
 
-    inference_parameters = dict (
+    inference_parameters = app_bedrock.FrozenSettings (
         temperature = settings["Temperature"],
         top_p = float(settings["TopP"]),
         top_k = int(settings["TopK"]),
@@ -149,7 +195,7 @@ async def setup_agent(settings):
         system_message = "You are a helpful assistant and tries to answer questions as best as you can."
     )
 
-    application_options = dict (
+    application_options = app_bedrock.FrozenSettings (
         option_terse = settings["Terse"],
         option_strict = settings["Strict"],
         option_align_units_of_measure = settings["AlignUnitsOfMeasure"],
@@ -158,11 +204,22 @@ async def setup_agent(settings):
         option_source_table_markdown_display = settings["SourceTableMarkdown"]
     )
 
+    # compile this model's prompt/request templates now rather than on the first message
+    app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id).compile(application_options, inference_parameters)
+    app_generate.prompt_template(application_options)
+
     cl.user_session.set("inference_parameters", inference_parameters)
     cl.user_session.set("bedrock_model_id", bedrock_model_id)
     cl.user_session.set("llm_model_arn", llm_model_arn)
     cl.user_session.set("knowledge_base_id", knowledge_base_id)
+    cl.user_session.set("knowledge_base_ids", knowledge_base_ids)
     cl.user_session.set("kb_retrieve_document_count", kb_retrieve_document_count)
+    cl.user_session.set("kb_search_type", kb_search_type)
+    cl.user_session.set("kb_prompt_template", kb_prompt_template)
+    cl.user_session.set("kb_metadata_filter", kb_metadata_filter)
+    cl.user_session.set("kb_auto_filter", kb_auto_filter)
+    cl.user_session.set("kb_rerank", kb_rerank)
+    cl.user_session.set("kb_multi_query", kb_multi_query)
     cl.user_session.set("mode", mode)
     cl.user_session.set("strict", strict)
     cl.user_session.set("application_options", application_options)
@@ -173,7 +230,7 @@ def bedrock_list_models(bedrock):
     response = bedrock.list_foundation_models(byOutputModality="TEXT")
 
     for item in response["modelSummaries"]:
-        print(item['modelId'])
+        app_logging.event("bedrock.model", model=item['modelId'])
 
     
 @cl.on_chat_start
@@ -186,7 +243,7 @@ async def main():
 
     await setup_agent(settings)
 
-    #bedrock_list_models(bedrock)
+    #bedrock_list_models(app_bedrock_clients.get_client("bedrock"))
 
 
 @cl.on_message
@@ -194,9 +251,14 @@ async def main(message: cl.Message):
 
     mode = cl.user_session.get("mode") 
 
-    if mode == "RetrieveAndGenerate":
-        await app_retrieve_generate.main_retrieve_and_generate(message)
-    elif mode == "Generate":
-        await app_generate.main_retrieve(message)
-    else:
-        await app_retrieve.main_retrieve(message)
+    # per-user concurrency and token budgets; over the limit the message waits its turn in a fair queue
+    try:
+        async with app_admission.admission():
+            if mode == "RetrieveAndGenerate":
+                await app_retrieve_generate.main_retrieve_and_generate(message)
+            elif mode == "Generate":
+                await app_generate.main_retrieve(message)
+            else:
+                await app_retrieve.main_retrieve(message)
+    except app_admission.AdmissionTimeout as e:
+        await cl.Message(content=f"{e}").send()
@@ -0,0 +1,224 @@
+import os
+import time
+import asyncio
+import logging
+import contextlib
+import collections
+import chainlit as cl
+import app_metrics
+import app_logging
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "true").lower() == "true"
+# Messages handled at once across all users, 0 is unlimited
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "32"))
+# Per user (auth identifier): messages handled at once, and model tokens (in + out) per rolling minute. 0 is unlimited.
+ADMISSION_USER_MAX_CONCURRENT = int(os.environ.get("ADMISSION_USER_MAX_CONCURRENT", "16"))
+ADMISSION_USER_TOKENS_PER_MINUTE = int(os.environ.get("ADMISSION_USER_TOKENS_PER_MINUTE", "0"))
+# A queued message gives up after this long
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "120"))
+ADMISSION_POSITION_INTERVAL_SECONDS = 1.0
+
+WINDOW_SECONDS = 60
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class AdmissionController():
+
+    def __init__(self, max_concurrent: int, user_max_concurrent: int, user_tokens_per_minute: int):
+        self.max_concurrent = max_concurrent
+        self.user_max_concurrent = user_max_concurrent
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.in_flight = 0
+        self.user_in_flight = collections.Counter()
+        # user -> waiting futures in arrival order; the dict order is the round-robin order of users
+        self.queues = {}
+        # user -> (time, tokens) charged in the last WINDOW_SECONDS
+        self.spent = collections.defaultdict(collections.deque)
+        # user -> average tokens per invocation, what a message in flight is expected to spend
+        self.average_tokens = {}
+        self.admitted = 0
+        self.queued = 0
+        self.timed_out = 0
+        self._retry = None
+
+    def tokens_last_minute(self, user: str, now: float) -> int:
+        spent = self.spent[user]
+        while spent and spent[0][0] <= now - WINDOW_SECONDS:
+            spent.popleft()
+        return sum(tokens for _, tokens in spent)
+
+    def _has_capacity(self) -> bool:
+        return not self.max_concurrent or self.in_flight < self.max_concurrent
+
+    def _admissible(self, user: str, now: float) -> bool:
+        if self.user_max_concurrent and self.user_in_flight[user] >= self.user_max_concurrent:
+            return False
+        if self.user_tokens_per_minute:
+            average = self.average_tokens.get(user)
+            if average is None:
+                # one message at a time until the user's first invocation tells how much a message spends
+                return self.user_in_flight[user] == 0
+            if self.tokens_last_minute(user, now) + self.user_in_flight[user] * average >= self.user_tokens_per_minute:
+                return False
+        return True
+
+    def _admit(self, user: str):
+        self.in_flight += 1
+        self.user_in_flight[user] += 1
+        self.admitted += 1
+
+    def _dispatch(self):
+        # round-robin over the users with queued messages: one admission per user per turn
+        now = time.monotonic()
+        while self.queues and self._has_capacity():
+            for user in list(self.queues):
+                if self._admissible(user, now):
+                    queue = self.queues.pop(user)
+                    self._admit(user)
+                    queue.popleft().set_result(None)
+                    if queue:
+                        # back of the rotation
+                        self.queues[user] = queue
+                    break
+            else:
+                break
+        self._schedule_retry(now)
+
+    def _schedule_retry(self, now: float):
+        # users held back by their token budget only get admitted when old usage leaves the window
+        if self._retry is not None or not self.user_tokens_per_minute:
+            return
+        expiries = [self.spent[user][0][0] + WINDOW_SECONDS for user in self.queues if self.spent[user]]
+        if expiries:
+            def retry():
+                self._retry = None
+                self._dispatch()
+            self._retry = asyncio.get_running_loop().call_later(max(0.0, min(expiries) - now) + 0.01, retry)
+
+    def position(self, user: str, future: asyncio.Future) -> int:
+        # messages admitted before this one if the queues do not change: everything queued ahead of it for this
+        # user, and as many of every other user's (one more for the users ahead in the rotation)
+        queue = self.queues.get(user)
+        if not queue or future not in queue:
+            return 0
+        index = queue.index(future)
+        users = list(self.queues)
+        mine = users.index(user)
+        ahead = index
+        for i, other in enumerate(users):
+            if other != user:
+                ahead += min(len(self.queues[other]), index + (1 if i < mine else 0))
+        return ahead + 1
+
+    def _remove(self, user: str, future: asyncio.Future):
+        queue = self.queues.get(user)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.queues[user]
+
+    async def acquire(self, user: str, on_wait=None):
+        # on_wait(position) is awaited while the message is queued, every time the position may have changed
+        now = time.monotonic()
+        if user not in self.queues and self._has_capacity() and self._admissible(user, now):
+            self._admit(user)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user, collections.deque()).append(future)
+        self.queued += 1
+        deadline = now + ADMISSION_QUEUE_TIMEOUT_SECONDS
+        self._dispatch()
+        try:
+            while not future.done():
+                if time.monotonic() > deadline:
+                    self.timed_out += 1
+                    raise AdmissionTimeout(f"Too many requests, not admitted after {ADMISSION_QUEUE_TIMEOUT_SECONDS:.0f}s. Please try again later.")
+                if on_wait is not None:
+                    await on_wait(self.position(user, future))
+                await asyncio.wait({future}, timeout=ADMISSION_POSITION_INTERVAL_SECONDS)
+        except BaseException:
+            if future.done():
+                # admitted while being cancelled
+                self.release(user)
+            else:
+                future.cancel()
+                self._remove(user, future)
+            raise
+
+    def release(self, user: str):
+        self.in_flight -= 1
+        self.user_in_flight[user] -= 1
+        self._dispatch()
+
+    def charge(self, user: str, tokens: int):
+        if tokens:
+            self.spent[user].append((time.monotonic(), tokens))
+            average = self.average_tokens.get(user)
+            self.average_tokens[user] = tokens if average is None else 0.8 * average + 0.2 * tokens
+
+    @property
+    def stats(self) -> str:
+        return f"admitted={self.admitted} queued={self.queued} timed_out={self.timed_out}"
+
+
+controller = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_USER_MAX_CONCURRENT, ADMISSION_USER_TOKENS_PER_MINUTE)
+
+
+def user_id() -> str:
+    user = cl.user_session.get("user")
+    return user.identifier if user else "anonymous"
+
+
+def charge(usage):
+    # from app_usage.record, once per model invocation
+    if ADMISSION_ENABLED and usage is not None:
+        controller.charge(user_id(), (usage.input_tokens or 0) + (usage.output_tokens or 0))
+
+
+@contextlib.asynccontextmanager
+async def admission():
+
+    if not ADMISSION_ENABLED:
+        yield
+        return
+
+    user = user_id()
+    notice = None
+    shown = None
+    start = time.perf_counter()
+
+    async def on_wait(position: int):
+        nonlocal notice, shown
+        if position == shown:
+            return
+        shown = position
+        content = f"Queued: position {position}. Your message will be answered when capacity frees up."
+        if notice is None:
+            notice = cl.Message(content=content)
+            await notice.send()
+        else:
+            notice.content = content
+            await notice.update()
+
+    try:
+        await controller.acquire(user, on_wait)
+    except AdmissionTimeout:
+        app_metrics.ADMISSION_WAIT_SECONDS.labels(outcome="timeout").observe(time.perf_counter() - start)
+        app_logging.event("admission.timeout", logging.WARNING, user=user)
+        if notice is not None:
+            await notice.remove()
+        raise
+
+    try:
+        waited = time.perf_counter() - start
+        app_metrics.ADMISSION_WAIT_SECONDS.labels(outcome="admitted").observe(waited)
+        if notice is not None:
+            app_logging.event("admission.queued", logging.INFO, user=user, waited=f"{waited:.2f}s")
+            await notice.remove()
+        yield
+    finally:
+        controller.release(user)
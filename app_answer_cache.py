@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import app_retrieve_cache
+import app_retrieve_filter
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512"))
+# Jaccard similarity of the query terms required to reuse an answer for the same prompt fingerprint
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.8"))
+
+STOPWORDS = frozenset("""a an and are as at be by can could do does for from how i in is it me my of on or please
+    tell the this to was what when where which who why will with would you your""".split())
+
+
+# negation and exclusion: "is X suitable" and "is X not suitable" score high on shared terms but have opposite answers.
+# Contractions are normalized to "not t" word pairs ("isn t"); they and the spelled-out forms count as "not".
+NEGATIONS = frozenset("no never without except excluding none nor neither nothing".split())
+NOT_FORMS = frozenset("not cannot dont doesnt didnt isnt arent wasnt werent cant wont wouldnt shouldnt couldnt hasnt havent hadnt".split())
+
+
+def query_terms(query: str) -> frozenset:
+    terms = app_retrieve_cache.normalize_query(query).split()
+    return frozenset(term for term in terms if term not in STOPWORDS) or frozenset(terms)
+
+
+def exact_terms(query: str) -> frozenset:
+    # product codes, numbers and negations: questions that differ in one of these never share an answer,
+    # however similar the rest of the wording
+    entities = app_retrieve_filter.find_entities(query)
+    terms = {value.lower() for values in entities.values() for value in values}
+    words = app_retrieve_cache.normalize_query(query).split()
+    for i, word in enumerate(words):
+        if any(c.isdigit() for c in word):
+            terms.add(word)
+        elif word in NOT_FORMS or (word == "t" and i > 0 and words[i - 1].endswith("n")):
+            terms.add("not")
+        elif word in NEGATIONS:
+            terms.add(word)
+    return frozenset(terms)
+
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class AnswerCache():
+
+    def __init__(self, ttl: float, max_entries: int, min_similarity: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.misses = 0
+        # prompt fingerprint -> {normalized query: (knowledge_base_ids, terms, exact terms, expires_at, answer)}
+        self._buckets = {}
+        self._lru = OrderedDict()
+        self._kb_versions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def cacheable(self, inference_parameters: dict) -> bool:
+        return ANSWER_CACHE_ENABLED and inference_parameters.get("temperature") == 0
+
+    def fingerprint(self, bedrock_model_id: str, inference_parameters: dict, prompt_without_query: str) -> str:
+        raw = json.dumps([bedrock_model_id, inference_parameters, prompt_without_query], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def set_knowledge_base_version(self, knowledge_base_id: str, updated_at):
+        updated_at = str(updated_at)
+        previous = self._kb_versions.get(knowledge_base_id)
+        self._kb_versions[knowledge_base_id] = updated_at
+        if previous is not None and previous != updated_at:
+            self.invalidate_knowledge_base(knowledge_base_id)
+
+    def invalidate_knowledge_base(self, knowledge_base_id: str):
+        with self._lock:
+            for fingerprint, query in list(self._lru):
+                if knowledge_base_id in self._buckets[fingerprint][query][0]:
+                    self._remove(fingerprint, query)
+
+    def _remove(self, fingerprint: str, query: str):
+        del self._lru[(fingerprint, query)]
+        bucket = self._buckets[fingerprint]
+        del bucket[query]
+        if not bucket:
+            del self._buckets[fingerprint]
+
+    def get(self, fingerprint: str, query: str):
+
+        terms = query_terms(query)
+        exact = exact_terms(query)
+        now = time.monotonic()
+        best = None
+        best_similarity = self.min_similarity
+
+        with self._lock:
+            for cached_query, (_, cached_terms, cached_exact, expires_at, answer) in list(self._buckets.get(fingerprint, {}).items()):
+                if expires_at < now:
+                    self._remove(fingerprint, cached_query)
+                    continue
+                if exact != cached_exact:
+                    continue
+                score = similarity(terms, cached_terms)
+                if score >= best_similarity:
+                    best = (cached_query, answer)
+                    best_similarity = score
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            self._lru.move_to_end((fingerprint, best[0]))
+            self.hits += 1
+            return best[1]
+
+    def put(self, fingerprint: str, knowledge_base_ids: list, query: str, answer: str):
+
+        normalized = app_retrieve_cache.normalize_query(query)
+
+        with self._lock:
+            if (fingerprint, normalized) in self._lru:
+                self._remove(fingerprint, normalized)
+            self._buckets.setdefault(fingerprint, {})[normalized] = (frozenset(knowledge_base_ids), query_terms(query), exact_terms(query), time.monotonic() + self.ttl, answer)
+            self._lru[(fingerprint, normalized)] = None
+            while len(self._lru) > self.max_entries:
+                self._remove(*next(iter(self._lru)))
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY)
@@ -1,9 +1,87 @@
 import chainlit as cl
 import json
+import logging
+import app_bedrock_async
+import app_bedrock_decode
+import app_stream_sink
+import app_usage
+import app_logging
+import types
+
+# Compiled prompt/request templates kept per strategy (settings combinations seen)
+_TEMPLATE_CACHE_MAX_ENTRIES = 1024
+
+# placeholders the prompt builders are rendered with once, then split on
+_CONTEXT_SLOT = "\x00context\x00"
+_QUERY_SLOT = "\x00query\x00"
+
+
+class FrozenSettings(dict):
+
+    # settings fixed by setup_agent; the hash is computed once so compiled templates are found with one dict lookup
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hash = hash(tuple(sorted((key, tuple(value) if isinstance(value, list) else value) for key, value in self.items())))
+
+    def __hash__(self):
+        return self._hash
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("FrozenSettings is read-only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+def _lookup(templates: dict, settings: dict):
+    try:
+        return templates.get(settings), settings
+    except TypeError:
+        # a plain dict (not from setup_agent)
+        settings = FrozenSettings(settings)
+        return templates.get(settings), settings
+
+
+def _cache(templates: dict, settings: FrozenSettings, template):
+    if len(templates) >= _TEMPLATE_CACHE_MAX_ENTRIES:
+        templates.clear()
+    templates[settings] = template
+    return template
+
 
 class BedrockModelStrategy():
 
+    prompt_field = "prompt"
+
+    def __init__(self):
+        # application_options -> (head, middle, tail), indexed by with_context
+        self._prompt_templates = ({}, {})
+        # inference_parameters -> read-only request without the prompt
+        self._request_templates = {}
+
+    def compile(self, application_options: dict, inference_parameters: dict):
+        # called from setup_agent when settings change, so messages only splice into ready templates
+        self.prompt_template(application_options, True)
+        self.prompt_template(application_options, False)
+        self.request_template(inference_parameters)
+
     def create_prompt(self, application_options: dict, context_info: str, query: str) -> str:
+        head, middle, tail = self.prompt_template(application_options, "" != context_info)
+        return f"{head}{context_info}{middle}{query}{tail}"
+
+    def prompt_template(self, application_options: dict, with_context: bool) -> tuple:
+        templates = self._prompt_templates[with_context]
+        template, application_options = _lookup(templates, application_options)
+        if template is None:
+            prompt = self.render_prompt(application_options, _CONTEXT_SLOT if with_context else "", _QUERY_SLOT)
+            if with_context:
+                head, _, rest = prompt.partition(_CONTEXT_SLOT)
+            else:
+                head, rest = "", prompt
+            middle, _, tail = rest.partition(_QUERY_SLOT)
+            template = _cache(templates, application_options, (head, middle, tail))
+        return template
+
+    def render_prompt(self, application_options: dict, context_info: str, query: str) -> str:
 
         prompt = ""
         if "" == context_info:
@@ -47,29 +125,77 @@ class BedrockModelStrategy():
 
         return prompt
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def history_query(self, query: str, history) -> str:
+        # prompt-style models read the conversation (app_conversation.History) as text ahead of the question
+        return history.transcript(query) if history else query
+
+    def create_request(self, inference_parameters: dict, prompt : str, history = None) -> dict:
+        request = self.request_template(inference_parameters).copy()
+        request[self.prompt_field] = prompt
+        return request
+
+    def request_template(self, inference_parameters: dict) -> dict:
+        # read-only; create_request copies it and splices in the prompt
+        template, inference_parameters = _lookup(self._request_templates, inference_parameters)
+        if template is None:
+            template = _cache(self._request_templates, inference_parameters, types.MappingProxyType(self._create_request_template(inference_parameters)))
+        return template
+
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         pass
 
     def send_request(self, request:dict, bedrock_runtime, bedrock_model_id:str):
         response = bedrock_runtime.invoke_model_with_response_stream(modelId = bedrock_model_id, body = json.dumps(request))
         return response
 
+    async def send_request_async(self, request:dict, bedrock_runtime, bedrock_model_id:str):
+        return await app_bedrock_async.run_blocking(self.send_request, request, bedrock_runtime, bedrock_model_id)
+
     async def process_response(self, response, msg : cl.Message):
         stream = response["body"]
-        await self.process_response_stream(stream, msg)
+        sink = app_stream_sink.BufferedMessageStream(msg)
+        try:
+            await self.process_response_stream(stream, sink)
+        finally:
+            await sink.flush()
+        return sink
+
+    async def replay_response(self, answer: str, msg : cl.Message):
+        sink = app_stream_sink.BufferedMessageStream(msg)
+        await sink.stream_token(answer)
+        await sink.flush()
+        return sink
+
+    async def stream_stats(self, msg : app_stream_sink.BufferedMessageStream, usage: app_usage.InvocationUsage):
+        # every stop reason ends here; answers cut off at the token limit are not marked completed (not cached)
+        if not usage.truncated:
+            msg.mark_completed()
+        msg.usage = usage
+        await msg.annotate(f"\n\n{usage.stats}")
 
     async def process_response_stream(self, stream, msg : cl.Message):
-        print("unknown")
+        app_logging.event("bedrock.unsupported_stream", logging.WARNING, strategy=type(self).__name__)
         await msg.stream_token("unknown")
 
-    #Todo Utils: amazon-bedrock-invocationMetrics 
-
 
 class BedrockModelStrategyFactory():
 
+    # strategies hold no per-request state, one instance per model id is shared by all sessions
+    _strategies = {}
+
     @staticmethod
     def create(bedrock_model_id : str) -> BedrockModelStrategy:
 
+        model_strategy = BedrockModelStrategyFactory._strategies.get(bedrock_model_id)
+        if model_strategy is None:
+            model_strategy = BedrockModelStrategyFactory._create(bedrock_model_id)
+            BedrockModelStrategyFactory._strategies[bedrock_model_id] = model_strategy
+
+        return model_strategy
+
+    @staticmethod
+    def _create(bedrock_model_id : str) -> BedrockModelStrategy:
+
         model_strategy = None
 
         provider = bedrock_model_id.split(".")[0]
@@ -96,9 +222,9 @@ class BedrockModelStrategyFactory():
     
 class AnthropicBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "prompt": prompt,
+            "prompt": None,
             "temperature": inference_parameters.get("temperature"),
             "top_p": inference_parameters.get("top_p"), #0.5,
             "top_k": inference_parameters.get("top_k"), #300,
@@ -109,35 +235,40 @@ class AnthropicBedrockModelStrategy(BedrockModelStrategy):
 
     async def process_response_stream(self, stream, msg : cl.Message):
         if stream:
-            for event in stream:
-                chunk = event.get("chunk")
-                if chunk:
-                    object = json.loads(chunk.get("bytes").decode())
-                    #print(object)
-                    if "completion" in object:
-                        completion = object["completion"]
-                        #print(completion)
+            async for event in app_bedrock_async.iterate_stream(stream):
+                object = app_bedrock_decode.chunk_object(event)
+                if object:
+                    completion = object.get("completion")
+                    if completion:
                         await msg.stream_token(completion)
-                    stop_reason = None
-                    if "stop_reason" in object:
-                        stop_reason = object["stop_reason"]
-                    
-                    if stop_reason == 'stop_sequence':
-                        invocation_metrics = object["amazon-bedrock-invocationMetrics"]
-                        if invocation_metrics:
-                            input_token_count = invocation_metrics["inputTokenCount"]
-                            output_token_count = invocation_metrics["outputTokenCount"]
-                            latency = invocation_metrics["invocationLatency"]
-                            lag = invocation_metrics["firstByteLatency"]
-                            stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                            await msg.stream_token(f"\n\n{stats}")
+                    stop_reason = object.get("stop_reason")
+                    if stop_reason:
+                        # stop_sequence or max_tokens
+                        await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(object, stop_reason))
+
+def _messages_request(request: dict, prompt: str, history) -> dict:
+    # the conversation as earlier turns of the messages API, its summary in the system prompt
+    if not history:
+        request["messages"] = [{"role": "user", "content": prompt}]
+        return request
+    request["messages"] = history.messages() + [{"role": "user", "content": prompt}]
+    if request.get("system"):
+        request["system"] = history.system(request["system"])
+    elif history.summary:
+        request["system"] = history.system("")
+    return request
+
 
 class AnthropicClaude3MsgBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def history_query(self, query: str, history) -> str:
+        return query
+
+    def create_request(self, inference_parameters: dict, prompt : str, history = None) -> dict:
+        request = self.request_template(inference_parameters).copy()
+        return _messages_request(request, prompt, history)
 
-        user_message =  {"role": "user", "content": f"{prompt}"}
-        messages = [user_message]
+    def _create_request_template(self, inference_parameters: dict) -> dict:
 
         request = {
             "anthropic_version": "bedrock-2023-05-31",
@@ -146,24 +277,29 @@ class AnthropicClaude3MsgBedrockModelStrategy(BedrockModelStrategy):
             "top_k": inference_parameters.get("top_k"), #300,
             "max_tokens": inference_parameters.get("max_tokens_to_sample"), #2048,
             #"system": system_prompt,
-            "messages": messages
+            "messages": None
             #"stop_sequences": []
         }
         return request
 
     def send_request(self, request:dict, bedrock_runtime, bedrock_model_id:str):
         response = bedrock_runtime.invoke_model(modelId = bedrock_model_id, body = json.dumps(request))
-        print(response)
+        app_logging.payload("bedrock.response", response.get("ResponseMetadata"), model=bedrock_model_id)
         return response
 
     async def process_response(self, response, msg : cl.Message):
-        response_body = json.loads(response.get('body').read())
-        print(response_body)
+        response_body = app_bedrock_decode.loads(await app_bedrock_async.run_blocking(response.get('body').read))
+        app_logging.payload("bedrock.response_body", response_body)
+        sink = app_stream_sink.BufferedMessageStream(msg)
         contents = response_body["content"]
         for content in contents:
-            await msg.stream_token(f"{content['text']}")
-        usage = response_body["usage"]
-        await msg.stream_token(f"token.in={usage['input_tokens']},token.out={usage['output_tokens']}")
+            await sink.stream_token(f"{content['text']}")
+        usage = app_usage.InvocationUsage.from_response_headers(response, response_body.get("stop_reason"))
+        usage.input_tokens = response_body["usage"]["input_tokens"]
+        usage.output_tokens = response_body["usage"]["output_tokens"]
+        await self.stream_stats(sink, usage)
+        await sink.flush()
+        return sink
 
     async def process_response_stream(self, stream, msg : cl.Message):
         pass
@@ -171,7 +307,7 @@ class AnthropicClaude3MsgBedrockModelStrategy(BedrockModelStrategy):
 
 class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
 
-    def create_prompt(self, application_options: dict, context_info: str, query: str) -> str:
+    def render_prompt(self, application_options: dict, context_info: str, query: str) -> str:
 
         option_terse = application_options.get("option_terse")
         option_strict = application_options.get("option_strict")
@@ -214,10 +350,14 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
 
         return prompt
     
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def history_query(self, query: str, history) -> str:
+        return query
+
+    def create_request(self, inference_parameters: dict, prompt : str, history = None) -> dict:
+        request = self.request_template(inference_parameters).copy()
+        return _messages_request(request, prompt, history)
 
-        user_message =  {"role": "user", "content": f"{prompt}"}
-        messages = [user_message]
+    def _create_request_template(self, inference_parameters: dict) -> dict:
 
         request = {
             "anthropic_version": "bedrock-2023-05-31",
@@ -226,59 +366,57 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
             "top_k": inference_parameters.get("top_k"), #300,
             "max_tokens": inference_parameters.get("max_tokens_to_sample"), #2048,
             "system": inference_parameters.get("system_message") if inference_parameters.get("system_message") else  "You are a helpful assistant.",
-            "messages": messages
+            "messages": None
             #"stop_sequences": []
         }
         return request
 
     def send_request(self, request:dict, bedrock_runtime, bedrock_model_id:str):
         response = bedrock_runtime.invoke_model_with_response_stream(modelId = bedrock_model_id, body = json.dumps(request))
-        print(response)
+        app_logging.payload("bedrock.response", response.get("ResponseMetadata"), model=bedrock_model_id)
         return response
 
     async def process_response_stream(self, stream, msg : cl.Message):
 
-        for event in stream:
-            if event["chunk"]:
-                chunk = json.loads(event["chunk"]["bytes"])
+        stop_reason = None
+
+        async for event in app_bedrock_async.iterate_stream(stream):
+            chunk = app_bedrock_decode.chunk_object(event)
+            if chunk:
+                chunk_type = chunk['type']
 
-                if chunk['type'] == 'message_start':
+                # text deltas are nearly every chunk, test for them first
+                if chunk_type == 'content_block_delta':
+                    delta = chunk['delta']
+                    if delta['type'] == 'text_delta':
+                        await msg.stream_token(delta['text'])
+
+                elif chunk_type == 'message_start':
                     #print(f"Input Tokens: {chunk['message']['usage']['input_tokens']}")
                     pass
 
-                elif chunk['type'] == 'message_delta':
-                    #print(f"\nStop reason: {chunk['delta']['stop_reason']}")
+                elif chunk_type == 'message_delta':
                     #print(f"Stop sequence: {chunk['delta']['stop_sequence']}")
                     #print(f"Output tokens: {chunk['usage']['output_tokens']}")
-                    pass
+                    stop_reason = chunk['delta'].get('stop_reason')
+
+                elif chunk_type == 'message_stop':
+                    await msg.flush()
+                    await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(chunk, stop_reason))
 
-                elif chunk['type'] == 'content_block_delta':
-                    if chunk['delta']['type'] == 'text_delta':
-                        text = chunk['delta']['text']
-                        await msg.stream_token(f"{text}")
-
-                elif chunk['type'] == 'message_stop':
-                    invocation_metrics = chunk['amazon-bedrock-invocationMetrics']
-                    input_token_count = invocation_metrics["inputTokenCount"]
-                    output_token_count = invocation_metrics["outputTokenCount"]
-                    latency = invocation_metrics["invocationLatency"]
-                    lag = invocation_metrics["firstByteLatency"]
-                    stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                    await msg.stream_token(f"\n\n{stats}")
-
-            elif event["internalServerException"]:
+            elif event.get("internalServerException"):
                 exception = event["internalServerException"]
                 await msg.stream_token(f"\n\n{exception}")
-            elif event["modelStreamErrorException"]:
+            elif event.get("modelStreamErrorException"):
                 exception = event["modelStreamErrorException"]
                 await msg.stream_token(f"\n\n{exception}")
-            elif event["modelTimeoutException"]:
+            elif event.get("modelTimeoutException"):
                 exception = event["modelTimeoutException"]
                 await msg.stream_token(f"\n\n{exception}")
-            elif event["throttlingException"]:
+            elif event.get("throttlingException"):
                 exception = event["throttlingException"]
                 await msg.stream_token(f"\n\n{exception}")
-            elif event["validationException"]:
+            elif event.get("validationException"):
                 exception = event["validationException"]
                 await msg.stream_token(f"\n\n{exception}")
             else:
@@ -286,7 +424,7 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
 
 class CohereBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_prompt(self, application_options: dict, context_info: str, query: str) -> str:
+    def render_prompt(self, application_options: dict, context_info: str, query: str) -> str:
 
         option_terse = application_options.get("option_terse")
         option_strict = application_options.get("option_strict")
@@ -308,9 +446,9 @@ class CohereBedrockModelStrategy(BedrockModelStrategy):
 
         return prompt
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "prompt": prompt,
+            "prompt": None,
             "temperature": inference_parameters.get("temperature"),
             "p": inference_parameters.get("top_p"), #0.5,
             "k": inference_parameters.get("top_k"), #300,
@@ -324,30 +462,22 @@ class CohereBedrockModelStrategy(BedrockModelStrategy):
         #print("cohere")
         #await msg.stream_token("Cohere")
         if stream:
-            for event in stream:
-                chunk = event.get("chunk")
-                if chunk:
-                    object = json.loads(chunk.get("bytes").decode())
-                    is_finished = object["is_finished"]
-                    if is_finished == False:
+            async for event in app_bedrock_async.iterate_stream(stream):
+                object = app_bedrock_decode.chunk_object(event)
+                if object:
+                    if not object["is_finished"]:
                         await msg.stream_token(object["text"])
                     else:
-                        if "amazon-bedrock-invocationMetrics" in object:
-                            invocation_metrics = object["amazon-bedrock-invocationMetrics"]
-                            if invocation_metrics:
-                                input_token_count = invocation_metrics["inputTokenCount"]
-                                output_token_count = invocation_metrics["outputTokenCount"]
-                                latency = invocation_metrics["invocationLatency"]
-                                lag = invocation_metrics["firstByteLatency"]
-                                stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                                await msg.stream_token(f"\n\n{stats}")
+                        await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(object, object.get("finish_reason")))
 
 
 class TitanBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    prompt_field = "inputText"
+
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "inputText": prompt,
+            "inputText": None,
             "textGenerationConfig": {
                 "temperature": inference_parameters.get("temperature"),
                 "topP": inference_parameters.get("top_p"), #0.5,
@@ -362,32 +492,21 @@ class TitanBedrockModelStrategy(BedrockModelStrategy):
         #print("titan")
         #await msg.stream_token("Titan")
         if stream:
-            for event in stream:
-                chunk = event.get("chunk")
-                if chunk:
-                    object = json.loads(chunk.get("bytes").decode())
-                    #print(object)
-                    if "outputText" in object:
-                        completion = object["outputText"]
+            async for event in app_bedrock_async.iterate_stream(stream):
+                object = app_bedrock_decode.chunk_object(event)
+                if object:
+                    completion = object.get("outputText")
+                    if completion:
                         await msg.stream_token(completion)
-                    if "completionReason" in object:
-                        finish_reason = object["completionReason"]
-                        if finish_reason:
-                            if "amazon-bedrock-invocationMetrics" in object:
-                                invocation_metrics = object["amazon-bedrock-invocationMetrics"]
-                                if invocation_metrics:
-                                    input_token_count = invocation_metrics["inputTokenCount"]
-                                    output_token_count = invocation_metrics["outputTokenCount"]
-                                    latency = invocation_metrics["invocationLatency"]
-                                    lag = invocation_metrics["firstByteLatency"]
-                                    stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag} finish_reason={finish_reason}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                    finish_reason = object.get("completionReason")
+                    if finish_reason:
+                        await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(object, finish_reason))
 
 
 # Issue - Infinite Please answer the question with the provided context while following instructions provided.
 class MetaBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_prompt(self, application_options: dict, context_info: str, query: str) -> str:
+    def render_prompt(self, application_options: dict, context_info: str, query: str) -> str:
 
         option_terse = application_options.get("option_terse")
         option_strict = application_options.get("option_strict")
@@ -410,9 +529,9 @@ class MetaBedrockModelStrategy(BedrockModelStrategy):
 
         return prompt
     
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "prompt": prompt,           
+            "prompt": None,
             "temperature": inference_parameters.get("temperature"),
             "top_p": inference_parameters.get("top_p"), #0.5,
             #"top_k": inference_parameters.get("top_k"), #300,
@@ -422,36 +541,23 @@ class MetaBedrockModelStrategy(BedrockModelStrategy):
         return request
 
     async def process_response_stream(self, stream, msg : cl.Message):
-        print("meta")
-        await msg.stream_token("Meta")
         if stream:
-            for event in stream:
-                chunk = event.get("chunk")
-                if chunk:
-                    object = json.loads(chunk.get("bytes").decode())
-                    print(object)
-                    if "generation" in object:
-                        completion = object["generation"]
+            async for event in app_bedrock_async.iterate_stream(stream):
+                object = app_bedrock_decode.chunk_object(event)
+                if object:
+                    completion = object.get("generation")
+                    if completion:
                         await msg.stream_token(completion)
-                    if "stop_reason" in object:
-                        finish_reason = object["stop_reason"]
-                        if finish_reason:
-                            if "amazon-bedrock-invocationMetrics" in object:
-                                invocation_metrics = object["amazon-bedrock-invocationMetrics"]
-                                if invocation_metrics:
-                                    input_token_count = invocation_metrics["inputTokenCount"]
-                                    output_token_count = invocation_metrics["outputTokenCount"]
-                                    latency = invocation_metrics["invocationLatency"]
-                                    lag = invocation_metrics["firstByteLatency"]
-                                    stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag} finish_reason={finish_reason}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                    finish_reason = object.get("stop_reason")
+                    if finish_reason:
+                        await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(object, finish_reason))
 
 
 class AI21BedrockModelStrategy(BedrockModelStrategy):
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "prompt": prompt,           
+            "prompt": None,
             "temperature": inference_parameters.get("temperature"),
             "topP": inference_parameters.get("top_p"), #0.5,
             #"top_k": inference_parameters.get("top_k"), #300,
@@ -464,20 +570,35 @@ class AI21BedrockModelStrategy(BedrockModelStrategy):
         response = bedrock_runtime.invoke_model(modelId = bedrock_model_id, body = json.dumps(request))
         return response
     
+    async def process_response(self, response, msg : cl.Message):
+        sink = app_stream_sink.BufferedMessageStream(msg)
+        try:
+            await self.process_response_stream(response["body"], sink)
+            sink.usage.invocation_latency_ms = app_usage.InvocationUsage.from_response_headers(response).invocation_latency_ms
+        finally:
+            await sink.flush()
+        return sink
+
     async def process_response_stream(self, stream, msg : cl.Message):
         #await msg.stream_token(f"AI21")
         
-        object = json.loads(stream.read())
+        object = app_bedrock_decode.loads(await app_bedrock_async.run_blocking(stream.read))
         #print(json.dumps(object, indent=2))
         #print(object.get('completions')[0].get('data').get('text'))
-        text = object.get('completions')[0].get('data').get('text')
+        completion = object.get('completions')[0]
+        text = completion.get('data').get('text')
         await msg.stream_token(f"{text}\n")
+        usage = app_usage.InvocationUsage(
+            input_tokens=len(object.get('prompt', {}).get('tokens', [])),
+            output_tokens=len(completion.get('data').get('tokens', [])),
+            stop_reason=completion.get('finishReason', {}).get('reason'))
+        await self.stream_stats(msg, usage)
 
 class MistralBedrockModelStrategy(BedrockModelStrategy):
 
-    def create_request(self, inference_parameters: dict, prompt : str) -> dict:
+    def _create_request_template(self, inference_parameters: dict) -> dict:
         request = {
-            "prompt": prompt,
+            "prompt": None,
             "temperature": inference_parameters.get("temperature"),
             "top_p": inference_parameters.get("top_p"), #0.5,
             "top_k": inference_parameters.get("top_k"), #300,
@@ -488,15 +609,13 @@ class MistralBedrockModelStrategy(BedrockModelStrategy):
 
     async def process_response_stream(self, stream, msg : cl.Message):
         if stream:
-            for event in stream:
+            async for event in app_bedrock_async.iterate_stream(stream):
                 #print(f"Event: {event}")
-                chunk = event.get("chunk")
-                if chunk:
-                    object = json.loads(chunk.get("bytes").decode())
-                    #print(object)
-                    if "outputs" in object:
-                        outputs = object["outputs"]
-                        for index, output in enumerate(outputs):
+                object = app_bedrock_decode.chunk_object(event)
+                if object:
+                    outputs = object.get("outputs")
+                    if outputs:
+                        for output in outputs:
                             text = output["text"]
                             if text == "\n":
                                 #print(f"{len(text)} '{text}'")
@@ -505,16 +624,7 @@ class MistralBedrockModelStrategy(BedrockModelStrategy):
                             else:
                                 await msg.stream_token(text)
 
-                            stop_reason = None
-                            if "stop_reason" in output:
-                                stop_reason = output["stop_reason"]
-                            
-                            if stop_reason == 'stop' or stop_reason == 'length':
-                                invocation_metrics = object["amazon-bedrock-invocationMetrics"]
-                                if invocation_metrics:
-                                    input_token_count = invocation_metrics["inputTokenCount"]
-                                    output_token_count = invocation_metrics["outputTokenCount"]
-                                    latency = invocation_metrics["invocationLatency"]
-                                    lag = invocation_metrics["firstByteLatency"]
-                                    stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                            stop_reason = output.get("stop_reason")
+                            if stop_reason:
+                                # stop or length; one usage record per invocation, not per output
+                                await self.stream_stats(msg, app_usage.InvocationUsage.from_chunk(object, stop_reason))
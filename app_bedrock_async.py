@@ -0,0 +1,71 @@
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# botocore clients and EventStreams are synchronous. Everything that touches the network
+# runs on this bounded pool so the Chainlit event loop keeps serving the other sessions.
+BEDROCK_EXECUTOR_MAX_WORKERS = int(os.environ.get("BEDROCK_EXECUTOR_MAX_WORKERS", "64"))
+BEDROCK_STREAM_QUEUE_SIZE = int(os.environ.get("BEDROCK_STREAM_QUEUE_SIZE", "256"))
+
+executor = ThreadPoolExecutor(max_workers=BEDROCK_EXECUTOR_MAX_WORKERS, thread_name_prefix="bedrock")
+
+_STREAM_END = object()
+
+
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+class _StreamError():
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _pump_stream(stream, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, cancelled):
+    try:
+        for event in stream:
+            if cancelled.is_set():
+                break
+            # put() blocks the worker thread (not the loop) when the consumer falls behind
+            asyncio.run_coroutine_threadsafe(queue.put(event), loop).result()
+    except BaseException as e:
+        asyncio.run_coroutine_threadsafe(queue.put(_StreamError(e)), loop).result()
+    finally:
+        asyncio.run_coroutine_threadsafe(queue.put(_STREAM_END), loop).result()
+
+
+async def iterate_stream(stream):
+
+    if hasattr(stream, "__aiter__"):
+        async for event in stream:
+            yield event
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=BEDROCK_STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+    pump = loop.run_in_executor(executor, _pump_stream, stream, loop, queue, cancelled)
+
+    try:
+        while True:
+            event = await queue.get()
+            if event is _STREAM_END:
+                break
+            if isinstance(event, _StreamError):
+                raise event.error
+            yield event
+    finally:
+        if not pump.done():
+            cancelled.set()
+            # unblock the pump if it is waiting on a full queue
+            while not queue.empty():
+                queue.get_nowait()
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+        await asyncio.shield(pump)
+
@@ -0,0 +1,60 @@
+import os
+import boto3
+import threading
+from botocore.config import Config
+
+AWS_REGION = os.environ["AWS_REGION"]
+
+# One pooled, tuned client per (service, region), created on first use and shared by every module.
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "64"))
+BEDROCK_CONNECT_TIMEOUT = float(os.environ.get("BEDROCK_CONNECT_TIMEOUT", "5"))
+BEDROCK_READ_TIMEOUT = float(os.environ.get("BEDROCK_READ_TIMEOUT", "120"))
+BEDROCK_RETRY_MODE = os.environ.get("BEDROCK_RETRY_MODE", "adaptive")
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "4"))
+BEDROCK_TCP_KEEPALIVE = os.environ.get("BEDROCK_TCP_KEEPALIVE", "true").lower() == "true"
+# Points every Bedrock service at another endpoint, e.g. a local stand-in server
+BEDROCK_ENDPOINT_URL = os.environ.get("BEDROCK_ENDPOINT_URL", "")
+
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_config(max_attempts: int = None) -> Config:
+    return Config(
+        max_pool_connections = BEDROCK_MAX_POOL_CONNECTIONS,
+        connect_timeout = BEDROCK_CONNECT_TIMEOUT,
+        read_timeout = BEDROCK_READ_TIMEOUT,
+        # callers that retry themselves also pace themselves: adaptive mode would add its own client-side delay
+        retries = {
+            'mode': BEDROCK_RETRY_MODE if max_attempts is None else 'standard',
+            'max_attempts': BEDROCK_MAX_ATTEMPTS if max_attempts is None else max_attempts,
+        },
+        tcp_keepalive = BEDROCK_TCP_KEEPALIVE,
+    )
+
+
+def get_client(service_name: str, region_name: str = None, max_attempts: int = None):
+
+    # max_attempts overrides BEDROCK_MAX_ATTEMPTS for callers that retry themselves (app_bedrock_router).
+    # Like BEDROCK_MAX_ATTEMPTS it counts retries after the first request, 0 is a single request.
+    region_name = region_name or AWS_REGION
+    key = (service_name, region_name, max_attempts)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        global _session
+        client = _clients.get(key)
+        if client is None:
+            # boto3.client() shares the default session, which is not safe to use from several threads
+            if _session is None:
+                _session = boto3.session.Session()
+            params = dict(region_name=region_name, config=client_config(max_attempts))
+            if BEDROCK_ENDPOINT_URL:
+                params["endpoint_url"] = BEDROCK_ENDPOINT_URL
+            client = _session.client(service_name, **params)
+            _clients[key] = client
+        return client
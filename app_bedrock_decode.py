@@ -0,0 +1,22 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Stream chunk payloads arrive as bytes. orjson parses bytes directly; the stdlib json
+# also accepts bytes (detects UTF-8), so neither path needs an extra .decode() copy.
+if orjson is not None:
+    loads = orjson.loads
+else:
+    loads = json.loads
+
+
+def chunk_object(event: dict):
+    # the decoded payload of a {"chunk": {"bytes": ...}} stream event, None for other events
+    chunk = event.get("chunk")
+    if chunk:
+        return loads(chunk["bytes"])
+    return None
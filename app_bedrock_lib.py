@@ -1,26 +1,129 @@
 import os
-import boto3
+import asyncio
+import logging
+import app_bedrock
+import app_bedrock_async
+import app_bedrock_clients
+import app_bedrock_decode
+import app_bedrock_router
+import app_usage
+import app_retrieve_cache
+import app_answer_cache
 from typing import List
 
-AWS_REGION = os.environ["AWS_REGION"]
+KB_CATALOG_REFRESH_SECONDS = float(os.environ.get("KB_CATALOG_REFRESH_SECONDS", "300"))
+
+class KnowledgeBaseCatalog():
+
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self.summaries = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    def _fetch_all(self) -> list:
+        summaries = []
+        params = dict(maxResults=100)
+        while True:
+            response = app_bedrock_clients.get_client('bedrock-agent').list_knowledge_bases(**params)
+            summaries.extend(response['knowledgeBaseSummaries'])
+            next_token = response.get('nextToken')
+            if not next_token:
+                return summaries
+            params["nextToken"] = next_token
+
+    async def refresh(self):
+
+        summaries = await app_bedrock_async.run_blocking(self._fetch_all)
+
+        for knowledgeBaseSummary in summaries:
+            kb_id = knowledgeBaseSummary['knowledgeBaseId']
+            updatedAt = knowledgeBaseSummary['updatedAt']
+            app_retrieve_cache.retrieve_cache.set_knowledge_base_version(kb_id, updatedAt)
+            app_answer_cache.answer_cache.set_knowledge_base_version(kb_id, updatedAt)
+
+        self.summaries = summaries
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # keep serving the last good listing
+                logging.warning("KnowledgeBase catalog refresh failed: %s", e)
+
+    async def get_summaries(self) -> list:
+
+        if self.summaries is None:
+            async with self._lock:
+                if self.summaries is None:
+                    await self.refresh()
+
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+
+        return self.summaries
+
+knowledge_base_catalog = KnowledgeBaseCatalog(KB_CATALOG_REFRESH_SECONDS)
 
-bedrock_agent = boto3.client('bedrock-agent', region_name=AWS_REGION)
 
 async def list_knowledge_bases() -> List[str]:
 
-    response = bedrock_agent.list_knowledge_bases(maxResults=20) #response = bedrock_agent.list_knowledge_bases(maxResults = 5)
+    summaries = await knowledge_base_catalog.get_summaries()
 
     kb_id_list = []
-    for i, knowledgeBaseSummary in enumerate(response['knowledgeBaseSummaries']):
+    for i, knowledgeBaseSummary in enumerate(summaries):
         kb_id = knowledgeBaseSummary['knowledgeBaseId']
         name = knowledgeBaseSummary['name']
-        description = knowledgeBaseSummary['description']
-        status = knowledgeBaseSummary['status']
-        updatedAt = knowledgeBaseSummary['updatedAt']
-        #print(f"{i} RetrievalResult: {kb_id} {name} {description} {status} {updatedAt}")
+        #print(f"{i} RetrievalResult: {kb_id} {name} {knowledgeBaseSummary.get('description')} {knowledgeBaseSummary['status']} {knowledgeBaseSummary['updatedAt']}")
         kb_id_list.append(f"{kb_id} {name}")
-    
+
     if not kb_id_list:
         kb_id_list = ["EMPTY EMPTY"]
-    
-    return kb_id_list
\ No newline at end of file
+
+    return kb_id_list
+
+
+async def known_knowledge_base_ids(knowledge_base_ids: list) -> tuple:
+
+    # (ids in the catalog, the others). Typed ids match case-insensitively and come back as listed.
+    summaries = await knowledge_base_catalog.get_summaries()
+    catalog = {knowledgeBaseSummary['knowledgeBaseId'].upper(): knowledgeBaseSummary['knowledgeBaseId'] for knowledgeBaseSummary in summaries}
+
+    known = []
+    unknown = []
+    for kb_id in knowledge_base_ids:
+        if kb_id.upper() in catalog:
+            known.append(catalog[kb_id.upper()])
+        else:
+            unknown.append(kb_id)
+
+    return known, unknown
+
+
+_completion_strategy = app_bedrock.AnthropicClaude3MsgBedrockModelStrategy()
+
+
+async def complete(bedrock_model_id: str, prompt: str, max_tokens: int, labels: dict, system: str = None) -> str:
+
+    # small internal completions (conversation summaries, query rewrites): one non-streaming Claude 3 messages call
+    if not bedrock_model_id.startswith("anthropic.claude-3"):
+        raise ValueError(f"Not a Claude 3 model: {bedrock_model_id}")
+
+    request = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "temperature": 0,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    if system:
+        request["system"] = system
+
+    response, route = await app_bedrock_router.send_request(_completion_strategy, request, bedrock_model_id)
+    response_body = app_bedrock_decode.loads(await app_bedrock_async.run_blocking(response["body"].read))
+    usage = app_usage.InvocationUsage.from_response_headers(response, response_body.get("stop_reason"))
+    usage.input_tokens = response_body["usage"]["input_tokens"]
+    usage.output_tokens = response_body["usage"]["output_tokens"]
+    app_usage.record(dict(labels, model=route.bedrock_model_id), usage)
+    return "".join(content["text"] for content in response_body["content"] if content.get("type") == "text").strip()
@@ -0,0 +1,437 @@
+import os
+import json
+import time
+import random
+import asyncio
+import collections
+import logging
+import botocore.eventstream
+import botocore.exceptions
+import app_bedrock
+import app_bedrock_async
+import app_bedrock_clients
+import app_metrics
+import app_logging
+
+AWS_REGION = os.environ["AWS_REGION"]
+
+BEDROCK_ROUTER_ENABLED = os.environ.get("BEDROCK_ROUTER_ENABLED", "true").lower() == "true"
+# Regions tried after AWS_REGION, e.g. "us-west-2,us-east-2" (the model must be enabled there)
+BEDROCK_FALLBACK_REGIONS = [region.strip() for region in os.environ.get("BEDROCK_FALLBACK_REGIONS", "").split(",") if region.strip()]
+# Model id -> cheaper siblings tried when every region of the model is throttled. Siblings must take the
+# same request format (same strategy class); others are ignored.
+BEDROCK_MODEL_FALLBACKS = json.loads(os.environ.get("BEDROCK_MODEL_FALLBACKS", json.dumps({
+    "anthropic.claude-3-sonnet-20240229-v1:0": ["anthropic.claude-3-haiku-20240307-v1:0"],
+})))
+# At least one attempt is always made
+BEDROCK_ROUTER_MAX_ATTEMPTS = max(1, int(os.environ.get("BEDROCK_ROUTER_MAX_ATTEMPTS", "6")))
+# No new attempt starts this long after the first one, which bounds the time a throttled message can take
+BEDROCK_ROUTER_DEADLINE_SECONDS = float(os.environ.get("BEDROCK_ROUTER_DEADLINE_SECONDS", "20"))
+BEDROCK_ROUTER_BACKOFF_BASE_SECONDS = float(os.environ.get("BEDROCK_ROUTER_BACKOFF_BASE_SECONDS", "0.25"))
+BEDROCK_ROUTER_BACKOFF_MAX_SECONDS = float(os.environ.get("BEDROCK_ROUTER_BACKOFF_MAX_SECONDS", "4"))
+# Per endpoint (model, region) request rate, unlimited until the endpoint throttles: then it starts at MAX_RATE,
+# is halved on every throttle and raised by RATE_INCREASE on every success, back to unlimited at MAX_RATE
+BEDROCK_ROUTER_MAX_RATE = float(os.environ.get("BEDROCK_ROUTER_MAX_RATE", "20"))
+BEDROCK_ROUTER_MIN_RATE = float(os.environ.get("BEDROCK_ROUTER_MIN_RATE", "0.2"))
+BEDROCK_ROUTER_RATE_INCREASE = float(os.environ.get("BEDROCK_ROUTER_RATE_INCREASE", "0.5"))
+# An endpoint slower than SLOW_SECONDS to the first event on average is taken out of rotation for COOLDOWN_SECONDS.
+# Throttled endpoints stay in rotation at their reduced rate: they are busy, not broken.
+BEDROCK_ROUTER_SLOW_SECONDS = float(os.environ.get("BEDROCK_ROUTER_SLOW_SECONDS", "15"))
+BEDROCK_ROUTER_COOLDOWN_SECONDS = float(os.environ.get("BEDROCK_ROUTER_COOLDOWN_SECONDS", "30"))
+
+# Hedging: when a streaming invocation has no first event after the BEDROCK_HEDGE_PERCENTILE first-byte time of
+# its endpoint, the same request is sent to another region of the model (or the same endpoint) and the first
+# to answer is used; the other is closed. A hedge costs a second prompt (input tokens, little output), so each
+# request earns BEDROCK_HEDGE_BUDGET_PERCENT/100 of a hedge and hedges beyond that are not sent.
+BEDROCK_HEDGE_ENABLED = os.environ.get("BEDROCK_HEDGE_ENABLED", "false").lower() == "true"
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "95"))
+BEDROCK_HEDGE_MIN_SECONDS = float(os.environ.get("BEDROCK_HEDGE_MIN_SECONDS", "0.5"))
+# Until an endpoint has this many first-byte samples it is hedged after BEDROCK_HEDGE_DEFAULT_SECONDS
+BEDROCK_HEDGE_MIN_SAMPLES = int(os.environ.get("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+BEDROCK_HEDGE_DEFAULT_SECONDS = float(os.environ.get("BEDROCK_HEDGE_DEFAULT_SECONDS", "5"))
+BEDROCK_HEDGE_BUDGET_PERCENT = float(os.environ.get("BEDROCK_HEDGE_BUDGET_PERCENT", "5"))
+BEDROCK_HEDGE_WINDOW = 200
+
+# Worth another endpoint: capacity and transient service errors
+RETRYABLE_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ServiceQuotaExceededException",
+    "ModelNotReadyException", "ModelTimeoutException", "InternalServerException"}
+# The model is not available on a fallback endpoint (not enabled in that region, no access)
+UNAVAILABLE_ERROR_CODES = {"AccessDeniedException", "ResourceNotFoundException", "UnrecognizedClientException"}
+# The same errors as the first event of a response stream, before any token was produced
+RETRYABLE_STREAM_EVENTS = {"throttlingException", "serviceUnavailableException", "modelTimeoutException", "internalServerException"}
+THROTTLING = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException", "throttlingException"}
+
+
+class StreamStartError(Exception):
+
+    def __init__(self, event_type: str, event: dict):
+        super().__init__(f"{event_type}: {event.get('message', event)}")
+        self.code = event_type
+
+
+class PeekedStream():
+
+    # the response stream with its first event already read, for app_bedrock_async.iterate_stream
+    def __init__(self, first_event, events, stream):
+        self.first_event = first_event
+        self.events = events
+        self.stream = stream
+
+    def __iter__(self):
+        yield self.first_event
+        yield from self.events
+
+    def close(self):
+        self.stream.close()
+
+
+class Endpoint():
+
+    def __init__(self, bedrock_model_id: str, region: str):
+        self.bedrock_model_id = bedrock_model_id
+        self.region = region
+        # None while the endpoint has not throttled
+        self.rate = None
+        self.tokens = 0.0
+        self.updated_at = time.monotonic()
+        self.cooldown_until = 0.0
+        self.decreased_at = 0.0
+        self.first_byte_seconds = None
+        self.first_byte_samples = collections.deque(maxlen=BEDROCK_HEDGE_WINDOW)
+        self.successes = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.bedrock_model_id}@{self.region}"
+
+    def wait_seconds(self, now: float) -> float:
+        # until the endpoint can take a request
+        wait = max(0.0, self.cooldown_until - now)
+        if self.rate is not None:
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+    def cool_down(self, seconds: float, reason: str):
+        self.cooldown_until = time.monotonic() + seconds
+        app_metrics.ROUTER_EVENTS.labels(model=self.bedrock_model_id, region=self.region, event="cooldown").inc()
+        app_logging.event("router.cooldown", logging.WARNING, endpoint=self.name, seconds=seconds, reason=reason)
+
+    def hedge_seconds(self) -> float:
+        if len(self.first_byte_samples) < BEDROCK_HEDGE_MIN_SAMPLES:
+            return BEDROCK_HEDGE_DEFAULT_SECONDS
+        samples = sorted(self.first_byte_samples)
+        index = min(len(samples) - 1, int(len(samples) * BEDROCK_HEDGE_PERCENTILE / 100))
+        return max(BEDROCK_HEDGE_MIN_SECONDS, samples[index])
+
+    def on_success(self, first_byte_seconds: float):
+        self.successes += 1
+        self.first_byte_samples.append(first_byte_seconds)
+        if self.rate is not None:
+            self.rate += BEDROCK_ROUTER_RATE_INCREASE
+            if self.rate >= BEDROCK_ROUTER_MAX_RATE:
+                self.rate = None
+        if self.first_byte_seconds is None:
+            self.first_byte_seconds = first_byte_seconds
+        else:
+            self.first_byte_seconds = 0.8 * self.first_byte_seconds + 0.2 * first_byte_seconds
+        if self.first_byte_seconds > BEDROCK_ROUTER_SLOW_SECONDS:
+            self.cool_down(BEDROCK_ROUTER_COOLDOWN_SECONDS, f"first_byte={self.first_byte_seconds:.1f}s")
+            # back in rotation it starts from a clean average
+            self.first_byte_seconds = None
+
+    def on_lost(self, elapsed_seconds: float):
+        # an attempt closed after losing a hedge race had no first event after elapsed_seconds. Attempts in the
+        # tail are the ones that lose, so they stay in the samples at that lower bound; with only the winners
+        # the percentile would drift down and hedge more and more.
+        if elapsed_seconds >= self.hedge_seconds():
+            self.first_byte_samples.append(elapsed_seconds)
+
+    def on_throttle(self, started_at: float):
+        # requests sent before the last decrease were sent at the old rate: one burst of throttles is one decrease
+        if started_at < self.decreased_at:
+            return
+        self.decreased_at = time.monotonic()
+        self.rate = max(BEDROCK_ROUTER_MIN_RATE, (self.rate or BEDROCK_ROUTER_MAX_RATE) / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.updated_at = self.decreased_at
+
+
+class Route():
+
+    def __init__(self, endpoint: Endpoint, attempts: int, hedged: bool = False, first_byte_seconds: float = None):
+        self.bedrock_model_id = endpoint.bedrock_model_id
+        self.region = endpoint.region
+        self.attempts = attempts
+        self.hedged = hedged
+        # of the attempt that answered: without the backoff, token bucket waits and failed attempts before it
+        self.first_byte_seconds = first_byte_seconds
+
+    @property
+    def stats(self) -> str:
+        stats = f"route={self.bedrock_model_id}@{self.region} attempts={self.attempts}"
+        return f"{stats} hedged=true" if self.hedged else stats
+
+
+class HedgeBudget():
+
+    # every request earns percent/100 of a hedge, up to a small burst
+    def __init__(self, percent: float, burst: float = 10.0):
+        self.ratio = percent / 100
+        self.burst = burst
+        self.balance = 0.0
+        self.requests = 0
+        self.hedges = 0
+
+    def earn(self):
+        self.requests += 1
+        self.balance = min(self.burst, self.balance + self.ratio)
+
+    def spend(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        self.hedges += 1
+        return True
+
+
+hedge_budget = HedgeBudget(BEDROCK_HEDGE_BUDGET_PERCENT)
+
+
+class _Attempt():
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.started_at = time.monotonic()
+        self.first_byte_seconds = None
+        self.response = None
+        self.cancelled = False
+
+    def cancel(self):
+        # close() waits for a worker blocked reading the first event in _peek, so it runs on the executor as well
+        self.cancelled = True
+        stream = self.response.get("body") if self.response else None
+        close = getattr(stream, "close", None)
+        if close:
+            app_bedrock_async.executor.submit(close)
+
+
+_endpoints = {}
+_candidates = {}
+
+
+def endpoint(bedrock_model_id: str, region: str) -> Endpoint:
+    key = (bedrock_model_id, region)
+    value = _endpoints.get(key)
+    if value is None:
+        value = _endpoints[key] = Endpoint(bedrock_model_id, region)
+    return value
+
+
+def candidates(bedrock_model_id: str) -> list:
+    # in order of preference: the model in every region, then each sibling in every region
+    value = _candidates.get(bedrock_model_id)
+    if value is None:
+        strategy_type = type(app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id))
+        models = [bedrock_model_id]
+        for sibling_model_id in BEDROCK_MODEL_FALLBACKS.get(bedrock_model_id, []):
+            if type(app_bedrock.BedrockModelStrategyFactory.create(sibling_model_id)) is strategy_type:
+                models.append(sibling_model_id)
+            else:
+                app_logging.event("router.incompatible_fallback", logging.WARNING, model=bedrock_model_id, fallback=sibling_model_id)
+        regions = [AWS_REGION] + [region for region in BEDROCK_FALLBACK_REGIONS if region != AWS_REGION]
+        value = _candidates[bedrock_model_id] = [endpoint(model_id, region) for model_id in models for region in regions]
+    return value
+
+
+def backoff_seconds(attempt: int) -> float:
+    # full jitter
+    return random.uniform(0, min(BEDROCK_ROUTER_BACKOFF_MAX_SECONDS, BEDROCK_ROUTER_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _error_code(error: Exception):
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get("Error", {}).get("Code")
+    if isinstance(error, StreamStartError):
+        return error.code
+    return type(error).__name__ if error is not None else None
+
+
+def _retryable(error: Exception) -> bool:
+    # connection failures and read timeouts included
+    if isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    code = _error_code(error)
+    return code in RETRYABLE_ERROR_CODES or code in RETRYABLE_STREAM_EVENTS
+
+
+async def _peek(response: dict) -> dict:
+    # a throttled streaming invocation can also fail with its first event, before any token reached the user
+    stream = response.get("body")
+    if not isinstance(stream, botocore.eventstream.EventStream):
+        return response
+    events = iter(stream)
+    try:
+        # botocore raises exception events as EventStreamError (a ClientError with the event type as code)
+        first_event = await app_bedrock_async.run_blocking(next, events, None)
+        if first_event is not None:
+            for event_type in RETRYABLE_STREAM_EVENTS:
+                if event_type in first_event:
+                    raise StreamStartError(event_type, first_event[event_type])
+    except BaseException:
+        # release the connection now rather than when the response is garbage collected
+        stream.close()
+        raise
+    response["body"] = PeekedStream(first_event, events, stream) if first_event is not None else []
+    return response
+
+
+async def _invoke(strategy: app_bedrock.BedrockModelStrategy, request: dict, attempt: _Attempt) -> dict:
+
+    current = attempt.endpoint
+    current.take()
+    start = time.monotonic()
+    try:
+        bedrock_runtime = app_bedrock_clients.get_client('bedrock-runtime', current.region, max_attempts=0)
+        attempt.response = await strategy.send_request_async(request, bedrock_runtime, current.bedrock_model_id)
+        if attempt.cancelled:
+            # lost the race while the request was being sent
+            attempt.cancel()
+            raise asyncio.CancelledError()
+        response = await _peek(attempt.response)
+    except Exception as e:
+        if attempt.cancelled:
+            raise
+        code = _error_code(e)
+        if _retryable(e):
+            if code in THROTTLING:
+                current.on_throttle(start)
+                app_metrics.ROUTER_EVENTS.labels(model=current.bedrock_model_id, region=current.region, event="throttle").inc()
+            else:
+                app_metrics.ROUTER_EVENTS.labels(model=current.bedrock_model_id, region=current.region, event="error").inc()
+            app_logging.event("router.retry", logging.INFO, endpoint=current.name, error=code)
+        raise
+
+    if attempt.cancelled:
+        attempt.cancel()
+        raise asyncio.CancelledError()
+    attempt.first_byte_seconds = time.monotonic() - start
+    current.on_success(attempt.first_byte_seconds)
+    return response
+
+
+def _discard(task: asyncio.Task):
+    # the losing attempt finishes in the background; its outcome is not needed
+    if not task.cancelled():
+        task.exception()
+
+
+def _hedge_endpoint(routes: list, current: Endpoint) -> Endpoint:
+    # another region of the same model when one is ready, otherwise the same endpoint again
+    now = time.monotonic()
+    for route in routes:
+        if route is not current and route.bedrock_model_id == current.bedrock_model_id and route.wait_seconds(now) == 0:
+            return route
+    return current
+
+
+async def _send(strategy: app_bedrock.BedrockModelStrategy, request: dict, routes: list, current: Endpoint):
+
+    # (response, attempt that answered, hedged)
+    primary = _Attempt(current)
+    primary_task = asyncio.ensure_future(_invoke(strategy, request, primary))
+    if not BEDROCK_HEDGE_ENABLED:
+        return await primary_task, primary, False
+
+    hedge_budget.earn()
+    hedge_seconds = current.hedge_seconds()
+    done, _ = await asyncio.wait({primary_task}, timeout=hedge_seconds)
+    if done or not hedge_budget.spend():
+        return await primary_task, primary, False
+
+    hedge = _Attempt(_hedge_endpoint(routes, current))
+    app_metrics.ROUTER_EVENTS.labels(model=hedge.endpoint.bedrock_model_id, region=hedge.endpoint.region, event="hedge").inc()
+    app_logging.event("router.hedge", logging.INFO, endpoint=current.name, hedge=hedge.endpoint.name, after=f"{hedge_seconds:.2f}s")
+    attempts = {primary_task: primary, asyncio.ensure_future(_invoke(strategy, request, hedge)): hedge}
+
+    error = None
+    while attempts:
+        done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            attempt = attempts.pop(task)
+            if task.exception() is None:
+                for loser_task, loser in attempts.items():
+                    loser.endpoint.on_lost(time.monotonic() - loser.started_at)
+                    loser.cancel()
+                    loser_task.add_done_callback(_discard)
+                if attempt is hedge:
+                    app_metrics.ROUTER_EVENTS.labels(model=hedge.endpoint.bedrock_model_id, region=hedge.endpoint.region, event="hedge_won").inc()
+                return task.result(), attempt, True
+            # the primary's error wins over the hedge's when both fail
+            if error is None or attempt is primary:
+                error = task.exception()
+    raise error
+
+
+async def send_request(strategy: app_bedrock.BedrockModelStrategy, request: dict, bedrock_model_id: str):
+
+    # returns (response, Route). Without the router this is strategy.send_request_async on the default client.
+    if not BEDROCK_ROUTER_ENABLED:
+        start = time.monotonic()
+        response = await strategy.send_request_async(request, app_bedrock_clients.get_client('bedrock-runtime'), bedrock_model_id)
+        return response, Route(endpoint(bedrock_model_id, AWS_REGION), 1, first_byte_seconds=time.monotonic() - start)
+
+    deadline = time.monotonic() + BEDROCK_ROUTER_DEADLINE_SECONDS
+    routes = candidates(bedrock_model_id)
+    previous = None
+    error = None
+
+    for attempt in range(BEDROCK_ROUTER_MAX_ATTEMPTS):
+
+        if error is not None:
+            # every retry backs off (full jitter), so a burst of throttled requests does not retry in lockstep
+            wait = backoff_seconds(attempt)
+            if time.monotonic() + wait > deadline:
+                break
+            await asyncio.sleep(wait)
+
+        now = time.monotonic()
+        waits = [(route.wait_seconds(now), i) for i, route in enumerate(routes)]
+        ready = [i for wait, i in waits if wait == 0 and routes[i] is not previous]
+        if ready:
+            current = routes[ready[0]]
+        else:
+            # nothing else ready: the endpoint free soonest. Cooldowns are advisory here, an endpoint
+            # out of rotation is still used when it is all there is.
+            wait, i = min(waits)
+            current = routes[i]
+            await asyncio.sleep(min(wait, BEDROCK_ROUTER_BACKOFF_MAX_SECONDS))
+
+        if previous is not None and current is not previous:
+            app_metrics.ROUTER_EVENTS.labels(model=current.bedrock_model_id, region=current.region, event="failover").inc()
+            app_logging.event("router.failover", logging.INFO, model=bedrock_model_id, endpoint=current.name, error=_error_code(error))
+
+        previous = current
+        try:
+            response, answered, hedged = await _send(strategy, request, routes, current)
+        except Exception as e:
+            code = _error_code(e)
+            if _retryable(e):
+                error = e
+                continue
+            if code in UNAVAILABLE_ERROR_CODES and current is not routes[0]:
+                # a fallback region or sibling without the model: skip it for much longer than a slow endpoint
+                current.cool_down(BEDROCK_ROUTER_COOLDOWN_SECONDS * 10, code)
+                error = e
+                continue
+            raise
+
+        return response, Route(answered.endpoint, attempt + 1, hedged, answered.first_byte_seconds)
+
+    raise error
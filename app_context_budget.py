@@ -0,0 +1,115 @@
+import os
+import math
+
+# Context window (tokens) per model id prefix. The first matching prefix wins.
+MODEL_CONTEXT_WINDOWS = [
+    ("anthropic.claude-3", 200000),
+    ("anthropic.claude-v2:1", 200000),
+    ("anthropic.claude-v2", 100000),
+    ("anthropic.claude-instant", 100000),
+    ("amazon.titan-text-express", 8192),
+    ("amazon.titan-text-lite", 4096),
+    ("amazon.titan-text-premier", 32000),
+    ("mistral.mistral-7b", 32000),
+    ("mistral.mixtral-8x7b", 32000),
+    ("mistral.mistral-large", 32000),
+    ("cohere.command-light", 4096),
+    ("cohere.command-text", 4096),
+    ("meta.llama2", 4096),
+    ("meta.llama3", 8192),
+    ("ai21.j2", 8191),
+]
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Instructions, scaffolding and the question around the retrieved context
+CONTEXT_BUDGET_PROMPT_OVERHEAD_TOKENS = int(os.environ.get("CONTEXT_BUDGET_PROMPT_OVERHEAD_TOKENS", "768"))
+# Optional cost cap on the retrieved context regardless of the model window. 0 disables the cap.
+CONTEXT_BUDGET_MAX_CONTEXT_TOKENS = int(os.environ.get("CONTEXT_BUDGET_MAX_CONTEXT_TOKENS", "0"))
+# A chunk is truncated into the remaining budget only if at least this many tokens are left
+CONTEXT_BUDGET_MIN_CHUNK_TOKENS = int(os.environ.get("CONTEXT_BUDGET_MIN_CHUNK_TOKENS", "64"))
+
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text: str) -> int:
+    # ~3.5 latin characters per token, one token per non-ascii character (CJK etc.)
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return math.ceil((len(text) - non_ascii) / CHARS_PER_TOKEN) + non_ascii
+
+
+def rank_score(result: dict) -> float:
+    # rerankScore (app_rerank) over fusionScore (multi-query fusion) over the KnowledgeBase score
+    if "rerankScore" in result:
+        return result["rerankScore"]
+    if "fusionScore" in result:
+        return result["fusionScore"]
+    return result.get("score", 0)
+
+
+def context_window(bedrock_model_id: str) -> int:
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if bedrock_model_id.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def remaining_tokens(bedrock_model_id: str, max_tokens_to_sample: int, query: str) -> int:
+    # what the model window leaves for the conversation history and the retrieved context
+    return max(context_window(bedrock_model_id) - max_tokens_to_sample - CONTEXT_BUDGET_PROMPT_OVERHEAD_TOKENS - estimate_tokens(query), 0)
+
+
+def context_budget(bedrock_model_id: str, max_tokens_to_sample: int, query: str, history_tokens: int = 0) -> int:
+    budget = remaining_tokens(bedrock_model_id, max_tokens_to_sample, query) - history_tokens
+    if CONTEXT_BUDGET_MAX_CONTEXT_TOKENS > 0:
+        budget = min(budget, CONTEXT_BUDGET_MAX_CONTEXT_TOKENS)
+    return max(budget, 0)
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    # cut on a whitespace boundary; the estimate is conservative for non-ascii text
+    text = text[0:int(max_tokens * CHARS_PER_TOKEN)]
+    while text and estimate_tokens(text) > max_tokens:
+        text = text[0:int(len(text) * 0.9)]
+    cut = text.rfind(" ")
+    return text[0:cut] if cut > len(text) // 2 else text
+
+
+class PackedContext():
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        # (retrievalResult, text, status) with status "full", "truncated" or "dropped"
+        self.entries = []
+        self.tokens = 0
+        self.tokens_retrieved = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_retrieved - self.tokens
+
+    @property
+    def chunks(self) -> list:
+        return [(result, text) for result, text, status in self.entries if status != "dropped"]
+
+
+def pack(retrieval_results: list, budget: int) -> PackedContext:
+
+    packed = PackedContext(budget)
+
+    for result in sorted(retrieval_results, key=rank_score, reverse=True):
+        text = result["content"]["text"]
+        tokens = estimate_tokens(text)
+        packed.tokens_retrieved += tokens
+        remaining = budget - packed.tokens
+
+        if tokens <= remaining:
+            packed.entries.append((result, text, "full"))
+            packed.tokens += tokens
+        elif remaining >= CONTEXT_BUDGET_MIN_CHUNK_TOKENS:
+            text = truncate(text, remaining)
+            packed.entries.append((result, text, "truncated"))
+            packed.tokens += estimate_tokens(text)
+        else:
+            packed.entries.append((result, text, "dropped"))
+
+    return packed
@@ -0,0 +1,64 @@
+import os
+import operator
+from collections import OrderedDict
+import app_context_budget
+
+# Jaccard similarity of the chunks' sampled shingles (see sketch) above which a chunk counts as a near-duplicate
+CONTEXT_DEDUP_THRESHOLD = float(os.environ.get("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+# Sketches of recently seen chunk texts: the same chunks come back for related questions and from the retrieve cache
+CONTEXT_DEDUP_CACHE_MAX_ENTRIES = int(os.environ.get("CONTEXT_DEDUP_CACHE_MAX_ENTRIES", "1024"))
+
+# Lowercases ASCII, turns whitespace into spaces and the last letter of words ending in e or o (digits 0 and 5),
+# about a fifth of English words, into a marker the text is split on
+_SAMPLE = bytes.maketrans(b"ABCDFGHIJKLMNPQRSTUVWXYZ\t\n\r\x0b\x0c" b"eoEO05", b"abcdfghijklmnpqrstuvwxyz     " b"\0\0\0\0\0\0")
+_SAMPLE_END = b"\0 "
+# the first two or three words after a marker
+_SHINGLE = operator.itemgetter(slice(0, 12))
+_sketches = OrderedDict()
+
+
+def sketch(text: str) -> frozenset:
+    # The shingles that start after a marked word: which ones are taken depends on the words, not on their position,
+    # so chunks that share a passage share its sampled shingles at any offset, and the Jaccard similarity of the
+    # samples estimates that of all the shingles. Split, slice and hash run in C, without a Python object per word.
+    return frozenset(map(_SHINGLE, text.encode().translate(_SAMPLE).split(_SAMPLE_END)))
+
+
+def cached_sketch(text: str) -> frozenset:
+    text_sketch = _sketches.get(text)
+    if text_sketch is None:
+        text_sketch = _sketches[text] = sketch(text)
+        if len(_sketches) > CONTEXT_DEDUP_CACHE_MAX_ENTRIES:
+            _sketches.popitem(last=False)
+    return text_sketch
+
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    both = len(a & b)
+    return both / (len(a) + len(b) - both)
+
+
+def deduplicate(retrieval_results: list, threshold: float = CONTEXT_DEDUP_THRESHOLD):
+
+    # best score first, so the first copy of a near-duplicate is the one kept
+    kept = []
+    kept_sketches = []
+    removed = []
+    # shingle of a kept sketch -> position in kept of the last one holding it
+    owners = {}
+    seen = set()
+
+    for result in sorted(retrieval_results, key=app_context_budget.rank_score, reverse=True):
+        result_sketch = cached_sketch(result["content"]["text"])
+        # a chunk at least threshold-similar to a kept one has at least that share of its shingles seen before:
+        # the distinct chunks stop here, and the others are compared only with the chunks they share shingles with
+        shared = result_sketch & seen
+        if len(shared) >= threshold * len(result_sketch) and any(similarity(result_sketch, kept_sketches[i]) >= threshold for i in set(map(owners.__getitem__, shared))):
+            removed.append(result)
+        else:
+            seen |= result_sketch
+            owners.update(dict.fromkeys(result_sketch, len(kept)))
+            kept.append(result)
+            kept_sketches.append(result_sketch)
+
+    return kept, removed
@@ -0,0 +1,236 @@
+import os
+import re
+import asyncio
+import logging
+import traceback
+import chainlit as cl
+import app_bedrock_lib
+import app_context_budget
+import app_retrieve_cache
+import app_retrieve_filter
+import app_logging
+
+CONVERSATION_ENABLED = os.environ.get("CONVERSATION_ENABLED", "true").lower() == "true"
+# Recent turns kept verbatim, in tokens; older turns are folded into the running summary
+CONVERSATION_WINDOW_TOKENS = int(os.environ.get("CONVERSATION_WINDOW_TOKENS", "1500"))
+CONVERSATION_SUMMARY_TOKENS = int(os.environ.get("CONVERSATION_SUMMARY_TOKENS", "300"))
+# Model that folds old turns into the summary, "" keeps an extractive summary (questions and first sentences)
+CONVERSATION_SUMMARY_MODEL_ID = os.environ.get("CONVERSATION_SUMMARY_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+# Model that rewrites follow-up questions into standalone retrieval queries, "" uses local rules only
+CONVERSATION_REWRITE_MODEL_ID = os.environ.get("CONVERSATION_REWRITE_MODEL_ID", "")
+CONVERSATION_REWRITE_TIMEOUT_SECONDS = float(os.environ.get("CONVERSATION_REWRITE_TIMEOUT_SECONDS", "3"))
+
+# words that refer back to an earlier turn
+_REFERENCES = frozenset("""it its it's itself this these those they them their theirs he him his she her
+    same previous former latter""".split())
+_FOLLOW_UP_OPENINGS = ("and ", "what about ", "how about ", "and what", "why ", "so ", "then ")
+# a question with this few words is read as a follow-up
+_FOLLOW_UP_MAX_WORDS = 4
+_REWRITE_MAX_WORDS = 48
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+class Turn():
+
+    def __init__(self, question: str, query: str, answer: str):
+        self.question = question
+        # the standalone retrieval query the question was rewritten to
+        self.query = query
+        self.answer = answer
+        self.tokens = app_context_budget.estimate_tokens(question) + app_context_budget.estimate_tokens(answer)
+
+
+class History():
+
+    # what a model is given of the conversation before the current question
+    def __init__(self, summary: str, turns: list):
+        self.summary = summary
+        self.turns = turns
+
+    def __bool__(self):
+        return bool(self.summary or self.turns)
+
+    @property
+    def tokens(self) -> int:
+        # as a transcript; about the same as the messages and system summary Claude 3 gets
+        return app_context_budget.estimate_tokens(self.transcript("")) if self else 0
+
+    def fit(self, max_tokens: int):
+        # the most recent turns that fit in max_tokens: oldest turns go first, then the summary, then the last turn
+        history = History(self.summary, list(self.turns))
+        while history and history.tokens > max_tokens:
+            if len(history.turns) > 1 or (history.turns and not history.summary):
+                history.turns.pop(0)
+            else:
+                history.summary = ""
+        return history
+
+    def transcript(self, query: str) -> str:
+        # prompt-style models: the history as text ahead of the question
+        lines = ["Conversation so far, most recent last:"]
+        if self.summary:
+            lines.append(f"Summary of the earlier conversation: {self.summary}")
+        for turn in self.turns:
+            lines.append(f"User: {turn.question}")
+            lines.append(f"Answer: {turn.answer}")
+        lines.append("")
+        lines.append(f"Current question: {query}")
+        return "\n".join(lines)
+
+    def messages(self) -> list:
+        # Claude 3 messages API: alternating user/assistant turns
+        messages = []
+        for turn in self.turns:
+            messages.append({"role": "user", "content": turn.question})
+            messages.append({"role": "assistant", "content": turn.answer})
+        return messages
+
+    def system(self, system_message: str) -> str:
+        if not self.summary:
+            return system_message
+        return f"{system_message}\n\nSummary of the earlier conversation with the user: {self.summary}"
+
+
+class ConversationMemory():
+
+    def __init__(self, window_tokens: int, summary_tokens: int):
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.turns = []
+        # turns out of the window that the summary does not cover yet; still part of the history meanwhile
+        self.folding = []
+        self._fold_task = None
+
+    @property
+    def history(self) -> History:
+        return History(self.summary, self.folding + self.turns)
+
+    @property
+    def last_query(self) -> str:
+        turns = self.folding + self.turns
+        return turns[-1].query if turns else None
+
+    def add(self, question: str, query: str, answer: str):
+        # one turn can take at most the whole window, its question at most half of it
+        question_budget = self.window_tokens // 2
+        if app_context_budget.estimate_tokens(question) > question_budget:
+            question = app_context_budget.truncate(question, question_budget)
+        answer_budget = self.window_tokens - app_context_budget.estimate_tokens(question)
+        if app_context_budget.estimate_tokens(answer) > answer_budget:
+            answer = app_context_budget.truncate(answer, answer_budget)
+        if not question.strip() or not answer.strip():
+            # Claude 3 rejects empty messages; a turn with nothing to show is not kept
+            return
+        self.turns.append(Turn(question, query, answer))
+
+        while len(self.turns) > 1 and sum(turn.tokens for turn in self.turns) > self.window_tokens:
+            self.folding.append(self.turns.pop(0))
+        if self.folding and (self._fold_task is None or self._fold_task.done()):
+            # off the message path: the summary is ready for a later message, the turns stay in the history until then
+            self._fold_task = asyncio.ensure_future(self._fold())
+
+    async def _fold(self):
+        while self.folding:
+            turns = list(self.folding)
+            try:
+                summary = await summarize(self.summary, turns, self.summary_tokens)
+            except Exception:
+                logging.error(traceback.format_exc())
+                summary = extractive_summary(self.summary, turns, self.summary_tokens)
+            self.summary = summary
+            del self.folding[0:len(turns)]
+            app_logging.event("conversation.summary", logging.DEBUG, turns=len(turns), tokens=app_context_budget.estimate_tokens(summary))
+
+
+def extractive_summary(summary: str, turns: list, max_tokens: int) -> str:
+    # the questions and the first sentence of each answer; the oldest part goes first when over the limit
+    parts = [summary] if summary else []
+    for turn in turns:
+        first_sentence = _SENTENCE_END.split(turn.answer.strip(), 1)[0]
+        parts.append(f"Q: {turn.question} A: {first_sentence}")
+    text = " ".join(parts)
+    while app_context_budget.estimate_tokens(text) > max_tokens:
+        text = text[len(text) // 10:]
+    return text
+
+
+async def summarize(summary: str, turns: list, max_tokens: int) -> str:
+    if not CONVERSATION_SUMMARY_MODEL_ID:
+        return extractive_summary(summary, turns, max_tokens)
+    exchanges = "\n".join(f"User: {turn.question}\nAssistant: {turn.answer}" for turn in turns)
+    prompt = f"""Update the running summary of a conversation between a user and an assistant that answers from a knowledge base.
+Keep the facts, numbers, product codes and names the user may refer back to. Use at most {int(max_tokens * 0.7)} words.
+<summary>{summary}</summary>
+<new_exchanges>{exchanges}</new_exchanges>
+Reply with the updated summary only."""
+    labels = dict(mode="Summary", model=CONVERSATION_SUMMARY_MODEL_ID, kb="none")
+    return await app_bedrock_lib.complete(CONVERSATION_SUMMARY_MODEL_ID, prompt, max_tokens, labels)
+
+
+def is_follow_up(query: str) -> bool:
+    normalized = app_retrieve_cache.normalize_query(query)
+    words = normalized.split()
+    if normalized.startswith(_FOLLOW_UP_OPENINGS) or any(word in _REFERENCES for word in words):
+        return True
+    # a short question naming its own entities ("max capacity AB-0012?") stands alone
+    return len(words) <= _FOLLOW_UP_MAX_WORDS and not app_retrieve_filter.find_entities(query)
+
+
+def rewrite_locally(query: str, previous_query: str) -> str:
+    # the follow-up with the previous standalone query around it; entities the follow-up names itself
+    # (e.g. another product code) replace the previous ones
+    entities = app_retrieve_filter.find_entities(query)
+    for key, values in app_retrieve_filter.find_entities(previous_query).items():
+        if key in entities:
+            for value in values:
+                previous_query = previous_query.replace(value, "")
+    words = f"{previous_query.strip()} {query}".split()
+    if len(words) > _REWRITE_MAX_WORDS:
+        # follow-ups of follow-ups: the original question and the latest words
+        half = _REWRITE_MAX_WORDS // 2
+        words = words[0:half] + words[-half:]
+    return " ".join(words)
+
+
+async def rewrite_with_model(query: str, history: History) -> str:
+    prompt = f"""{history.transcript(query)}
+
+Rewrite the current question as a standalone search query for the knowledge base, resolving references to the conversation.
+Reply with the query only."""
+    labels = dict(mode="Rewrite", model=CONVERSATION_REWRITE_MODEL_ID, kb="none")
+    rewritten = await app_bedrock_lib.complete(CONVERSATION_REWRITE_MODEL_ID, prompt, 200, labels)
+    return rewritten.strip().strip('"') or query
+
+
+async def standalone_query(query: str, memory: ConversationMemory) -> str:
+    # the retrieval query for a question: itself, unless it reads as a follow-up of the previous turn
+    previous_query = memory.last_query if memory is not None else None
+    if not previous_query or not is_follow_up(query):
+        return query
+    if CONVERSATION_REWRITE_MODEL_ID:
+        try:
+            return await asyncio.wait_for(rewrite_with_model(query, memory.history), CONVERSATION_REWRITE_TIMEOUT_SECONDS)
+        except Exception as e:
+            app_logging.event("conversation.rewrite_failed", logging.WARNING, error=type(e).__name__)
+    return rewrite_locally(query, previous_query)
+
+
+def shares_answers(query: str, history: History) -> bool:
+    # a question that does not refer back to the conversation gets the answer any conversation would,
+    # so it can use the answer cache
+    return not history or not is_follow_up(query)
+
+
+def session_memory() -> ConversationMemory:
+    if not CONVERSATION_ENABLED:
+        return None
+    memory = cl.user_session.get("conversation")
+    if memory is None:
+        memory = ConversationMemory(CONVERSATION_WINDOW_TOKENS, CONVERSATION_SUMMARY_TOKENS)
+        cl.user_session.set("conversation", memory)
+    return memory
+
+
+def history(memory: ConversationMemory) -> History:
+    return memory.history if memory is not None else History("", [])
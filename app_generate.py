@@ -1,16 +1,36 @@
-import os
-import boto3
+import time
 import chainlit as cl
 import logging
 import traceback
 import app_bedrock
+import app_bedrock_router
+import app_answer_cache
+import app_metrics
+import app_usage
+import app_conversation
+import app_context_budget
+import app_logging
 
-AWS_REGION = os.environ["AWS_REGION"]
 
-bedrock_runtime = boto3.client('bedrock-runtime', region_name=AWS_REGION)
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
+# (terse, strict) -> text before and after the query
+_prompt_templates = {}
+
+
+def prompt_template(application_options: dict) -> tuple:
+    key = (application_options.get("option_terse"), application_options.get("option_strict"))
+    template = _prompt_templates.get(key)
+    if template is None:
+        head, _, tail = _render_prompt(application_options, "\x00query\x00").partition("\x00query\x00")
+        template = _prompt_templates[key] = (head, tail)
+    return template
+
 
 async def create_prompt(application_options: dict, query: str) -> str:
+        head, tail = prompt_template(application_options)
+        return f"{head}{query}{tail}"
+
+
+def _render_prompt(application_options: dict, query: str) -> str:
 
         option_terse = application_options.get("option_terse")
         option_strict = application_options.get("option_strict")
@@ -44,6 +64,12 @@ async def main_retrieve(message: cl.Message):
     kb_retrieve_document_count = cl.user_session.get("kb_retrieve_document_count")
 
     query = message.content
+    memory = app_conversation.session_memory()
+    # the conversation gets what the model window leaves after the answer and the instructions
+    history = app_conversation.history(memory).fit(app_context_budget.remaining_tokens(bedrock_model_id, inference_parameters.get("max_tokens_to_sample"), query))
+
+    request_start = time.perf_counter()
+    metric_labels = dict(mode="Generate", model=bedrock_model_id, kb="none")
 
     msg = cl.Message(content="")
 
@@ -51,16 +77,18 @@ async def main_retrieve(message: cl.Message):
 
     try:
 
-        async with cl.Step(name="Model", type="llm", root=False) as step_llm:
+        async with app_metrics.span("Model", **metric_labels), cl.Step(name="Model", type="llm", root=False) as step_llm:
             step_llm.input = msg.content
 
             elements = []
 
             try:
 
+                prompt_build_start = time.perf_counter()
+
                 bedrock_model_strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
 
-                prompt = await create_prompt(application_options, query)
+                prompt = await create_prompt(application_options, bedrock_model_strategy.history_query(query, history))
 
                 system_message = inference_parameters.get("system_message")
                 elements.append(cl.Text(name=f"system", content=system_message.replace("\n\n", "").rstrip(), display="inline")) 
@@ -69,20 +97,56 @@ async def main_retrieve(message: cl.Message):
 
                 max_tokens = inference_parameters.get("max_tokens_to_sample")
                 temperature = inference_parameters.get('temperature')
-                await step_llm.stream_token(f"model.id={bedrock_model_id} prompt.len={len(prompt)} temperature={temperature} max_tokens={max_tokens}")
+                await step_llm.stream_token(f"model.id={bedrock_model_id} prompt.len={len(prompt)} temperature={temperature} max_tokens={max_tokens} history.turns={len(history.turns)}")
 
-                request = bedrock_model_strategy.create_request(inference_parameters, prompt)
- 
-                print(f"{type(request)} {request}")
+                request = bedrock_model_strategy.create_request(inference_parameters, prompt, history)
 
-                response = bedrock_model_strategy.send_request(request, bedrock_runtime, bedrock_model_id)
-
-                await bedrock_model_strategy.process_response(response, msg)
+                app_metrics.PROMPT_BUILD_SECONDS.labels(**metric_labels).observe(time.perf_counter() - prompt_build_start)
+ 
+                app_logging.payload("bedrock.request", request, mode="Generate", model=bedrock_model_id, prompt_len=len(prompt))
+
+                answer_cache = app_answer_cache.answer_cache
+                answer = None
+                prompt_fingerprint = None
+                # a follow-up's answer depends on the conversation and is not reused for another
+                if answer_cache.cacheable(inference_parameters) and app_conversation.shares_answers(query, history):
+                    prompt_fingerprint = answer_cache.fingerprint(bedrock_model_id, inference_parameters, await create_prompt(application_options, ""))
+                    answer = answer_cache.get(prompt_fingerprint, query)
+                    app_metrics.record_cache(metric_labels, "answer", answer is not None)
+
+                if answer is not None:
+                    await step_llm.stream_token(f" answer_cache=hit answer_cache.hit_rate={answer_cache.hit_rate:.2f}")
+                    response_stream = await bedrock_model_strategy.replay_response(answer, msg)
+                else:
+                    response, route = await app_bedrock_router.send_request(bedrock_model_strategy, request, bedrock_model_id)
+                    stream_start = time.perf_counter()
+                    app_metrics.FIRST_BYTE_SECONDS.labels(**metric_labels).observe(route.first_byte_seconds)
+                    app_metrics.RETRIES.labels(**metric_labels).inc(route.attempts - 1)
+                    await step_llm.stream_token(f" {route.stats}")
+
+                    response_stream = await bedrock_model_strategy.process_response(response, msg)
+                    app_metrics.STREAM_SECONDS.labels(**metric_labels).observe(time.perf_counter() - stream_start)
+                    # usage counts against the model that answered, a fallback sibling included
+                    session_usage = app_usage.record(dict(metric_labels, model=route.bedrock_model_id), response_stream.usage)
+                    await step_llm.stream_token(f" session.{session_usage.stats}")
+
+                    answer = response_stream.answer
+                    # an answer from a fallback model is not cached as this model's
+                    # and an answer written with a conversation in view is not shared with other users
+                    if prompt_fingerprint is not None and answer and route.bedrock_model_id == bedrock_model_id and not history:
+                        answer_cache.put(prompt_fingerprint, [], query, answer)
+
+                if memory is not None and response_stream.text:
+                    memory.add(query, query, response_stream.text)
+
+                if response_stream.first_emit_at is not None:
+                    app_metrics.TIME_TO_FIRST_TOKEN_SECONDS.labels(**metric_labels).observe(response_stream.first_emit_at - request_start)
 
                 step_llm.elements = elements
 
             except Exception as e:
                 logging.error(traceback.format_exc())
+                app_metrics.ERRORS.labels(stage="model", **metric_labels).inc()
                 await step_llm.stream_token(f"{e}")
             finally:
                 await step_llm.send()
@@ -92,7 +156,9 @@ async def main_retrieve(message: cl.Message):
 
     except Exception as e:
         logging.error(traceback.format_exc())
+        app_metrics.ERRORS.labels(stage="request", **metric_labels).inc()
         await msg.stream_token(f"{e}")
     finally:
         await msg.send()
+        app_metrics.REQUEST_SECONDS.labels(**metric_labels).observe(time.perf_counter() - request_start)
 
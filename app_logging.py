@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Records are handed to a background writer thread; when it falls this far behind new records are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Request/response payloads in the main log are cut to this many characters
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "512"))
+# Fraction of payloads logged (truncated) at INFO. Otherwise they are DEBUG only.
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+# Debug switch: write every payload in full to a rotating local file
+LOG_PAYLOADS = os.environ.get("LOG_PAYLOADS", "false").lower() == "true"
+LOG_PAYLOAD_FILE = os.environ.get("LOG_PAYLOAD_FILE", "logs/payloads.log")
+LOG_PAYLOAD_FILE_MAX_BYTES = int(os.environ.get("LOG_PAYLOAD_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_PAYLOAD_FILE_BACKUP_COUNT = int(os.environ.get("LOG_PAYLOAD_FILE_BACKUP_COUNT", "5"))
+
+logger = logging.getLogger("kb_chat")
+payload_logger = logging.getLogger("kb_chat.payload")
+payload_logger.propagate = False
+
+_listeners = []
+
+
+class _Payload():
+
+    # serialized by the writer thread when the record is formatted, not by the caller
+    def __init__(self, payload, max_chars: int = 0):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self):
+        text = self.payload if isinstance(self.payload, str) else json.dumps(self.payload, default=str, ensure_ascii=False)
+        if self.max_chars and len(text) > self.max_chars:
+            return f"{text[0:self.max_chars]}...({len(text)} chars)"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    dropped = 0
+
+    def prepare(self, record):
+        # leave message formatting (and payload serialization) to the writer thread
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _start(target: logging.Logger, handlers: list):
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    for handler in target.handlers[:]:
+        target.removeHandler(handler)
+    target.addHandler(_QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+def setup():
+
+    if _listeners:
+        return
+
+    # the handlers Chainlit's basicConfig installed now write from a background thread
+    root = logging.getLogger()
+    _start(root, root.handlers[:] or [logging.StreamHandler(sys.stdout)])
+    logger.setLevel(LOG_LEVEL)
+
+    if LOG_PAYLOADS:
+        os.makedirs(os.path.dirname(LOG_PAYLOAD_FILE) or ".", exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(LOG_PAYLOAD_FILE, maxBytes=LOG_PAYLOAD_FILE_MAX_BYTES,
+            backupCount=LOG_PAYLOAD_FILE_BACKUP_COUNT, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        _start(payload_logger, [file_handler])
+        payload_logger.setLevel(logging.DEBUG)
+
+    atexit.register(shutdown)
+
+
+def shutdown():
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def _fields(fields: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in fields.items())
+
+
+def event(name: str, level: int = logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", name, _fields(fields))
+
+
+def payload(name: str, payload, **fields):
+
+    if LOG_PAYLOADS:
+        payload_logger.debug("%s %s %s", name, _fields(fields), _Payload(payload))
+
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.info("%s %s %s", name, _fields(fields), _Payload(payload, LOG_PAYLOAD_MAX_CHARS))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s %s", name, _fields(fields), _Payload(payload, LOG_PAYLOAD_MAX_CHARS))
@@ -0,0 +1,99 @@
+import os
+import contextlib
+import logging
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Prometheus metrics are served from the Chainlit server on this path when prometheus_client is installed
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+
+LABELS = ["mode", "model", "kb"]
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 21, 34, 60)
+
+
+class _NoopMetric():
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+
+def _histogram(name: str, documentation: str, labels: list = LABELS):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Histogram(name, documentation, labels, buckets=LATENCY_BUCKETS)
+
+
+def _counter(name: str, documentation: str, labels: list):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+REQUEST_SECONDS = _histogram("kb_chat_request_seconds", "Message handling time, end to end")
+RETRIEVE_SECONDS = _histogram("kb_chat_retrieve_seconds", "KnowledgeBase retrieval latency")
+RERANK_SECONDS = _histogram("kb_chat_rerank_seconds", "Local reranking time (BM25, cross-encoder)")
+PROMPT_BUILD_SECONDS = _histogram("kb_chat_prompt_build_seconds", "Context packing, prompt and request build time")
+FIRST_BYTE_SECONDS = _histogram("kb_chat_bedrock_first_byte_seconds", "Time for Bedrock to return the response (the first event for streaming models) on the attempt that answered")
+TIME_TO_FIRST_TOKEN_SECONDS = _histogram("kb_chat_time_to_first_token_seconds", "Time from the user message to the first streamed answer token")
+STREAM_SECONDS = _histogram("kb_chat_stream_seconds", "Time spent streaming the model response")
+INVOCATION_SECONDS = _histogram("kb_chat_bedrock_invocation_seconds", "Invocation latency reported by Bedrock")
+INVOCATIONS = _counter("kb_chat_invocations_total", "Model invocations by stop reason", LABELS + ["stop_reason"])
+TOKENS = _counter("kb_chat_tokens_total", "Model tokens reported by Bedrock invocation metrics", LABELS + ["direction"])
+CACHE_REQUESTS = _counter("kb_chat_cache_requests_total", "Cache lookups", LABELS + ["cache", "result"])
+RETRIES = _counter("kb_chat_bedrock_retries_total", "Model requests sent again by the router after a throttle or error", LABELS)
+ERRORS = _counter("kb_chat_errors_total", "Errors surfaced to the user", LABELS + ["stage"])
+ADMISSION_WAIT_SECONDS = _histogram("kb_chat_admission_wait_seconds", "Time a message waited for admission", ["outcome"])
+ROUTER_EVENTS = _counter("kb_chat_router_events_total", "Model router throttles, errors, failovers and cooldowns", ["model", "region", "event"])
+
+
+@contextlib.asynccontextmanager
+async def span(name: str, **attributes):
+    # async so it can share an "async with" with cl.Step
+    if trace is None:
+        yield None
+        return
+    with trace.get_tracer(__name__).start_as_current_span(name, attributes={key: str(value) for key, value in attributes.items()}) as current:
+        yield current
+
+
+def record_usage(labels: dict, usage):
+    INVOCATIONS.labels(stop_reason=str(usage.stop_reason), **labels).inc()
+    TOKENS.labels(direction="in", **labels).inc(usage.input_tokens or 0)
+    TOKENS.labels(direction="out", **labels).inc(usage.output_tokens or 0)
+    if usage.invocation_latency_ms is not None:
+        INVOCATION_SECONDS.labels(**labels).observe(usage.invocation_latency_ms / 1000)
+
+
+def record_cache(labels: dict, cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss", **labels).inc()
+
+
+def mount_metrics_endpoint():
+
+    if prometheus_client is None:
+        logging.info("prometheus_client is not installed, %s is not served", METRICS_PATH)
+        return
+
+    from chainlit.server import app as chainlit_server
+    from starlette.responses import Response
+    from starlette.routing import Route
+
+    async def metrics(request):
+        return Response(prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+    # ahead of Chainlit's catch-all UI route
+    chainlit_server.router.routes.insert(0, Route(METRICS_PATH, metrics, methods=["GET"]))
@@ -0,0 +1,184 @@
+import os
+import re
+import asyncio
+import logging
+from collections import OrderedDict
+import app_bedrock_lib
+import app_answer_cache
+import app_retrieve_cache
+import app_retrieve_lib
+import app_logging
+
+# Default for the MultiQuery setting
+QUERY_EXPANSION_ENABLED = os.environ.get("QUERY_EXPANSION_ENABLED", "false").lower() == "true"
+# Paraphrases searched next to the question itself
+QUERY_EXPANSION_COUNT = int(os.environ.get("QUERY_EXPANSION_COUNT", "2"))
+# Model that writes the paraphrases, "" uses local rules (keywords, expanded abbreviations)
+QUERY_EXPANSION_MODEL_ID = os.environ.get("QUERY_EXPANSION_MODEL_ID", "")
+QUERY_EXPANSION_TIMEOUT_SECONDS = float(os.environ.get("QUERY_EXPANSION_TIMEOUT_SECONDS", "2"))
+QUERY_EXPANSION_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_EXPANSION_CACHE_MAX_ENTRIES", "1024"))
+# Reciprocal rank fusion constant: a result at rank r in one search adds 1 / (k + r)
+QUERY_EXPANSION_RRF_K = int(os.environ.get("QUERY_EXPANSION_RRF_K", "60"))
+# Retrieve accepts up to 1000 characters of query text
+QUERY_MAX_CHARS = 900
+
+ABBREVIATIONS = {
+    "max": "maximum",
+    "min": "minimum",
+    "qty": "quantity",
+    "approx": "approximately",
+    "avg": "average",
+    "cap": "capacity",
+    "spec": "specification",
+    "specs": "specifications",
+    "info": "information",
+    "req": "requirement",
+    "reqs": "requirements",
+    "dept": "department",
+    "pref": "prefecture",
+}
+
+# question openings dropped for the statement form ("what is the maximum capacity of ..." -> "maximum capacity of ...")
+_QUESTION_OPENING = frozenset("""what which who whom whose when where why how is are was were do does did can could should would will
+    the a an please tell me i we want need to know""".split())
+_SCAFFOLD = re.compile(r"\b(human|assistant):\s*", re.IGNORECASE)
+_EDGE_PUNCTUATION = "?!.,;:()[]{}\"'"
+
+
+def clean_query(query: str) -> str:
+    # the question as the user wrote it: no prompt scaffold (it only adds noise to the embedding), one line,
+    # cut on a word boundary
+    query = " ".join(_SCAFFOLD.sub(" ", query).split())
+    if len(query) > QUERY_MAX_CHARS:
+        query = query[0:QUERY_MAX_CHARS].rsplit(" ", 1)[0]
+    return query
+
+
+def _words(query: str) -> list:
+    # original case and inner punctuation kept, so product codes like AB-0012 survive
+    return [word.strip(_EDGE_PUNCTUATION) for word in query.split() if word.strip(_EDGE_PUNCTUATION)]
+
+
+def local_paraphrases(query: str) -> list:
+    words = _words(query)
+    keywords = [word for word in words if word.lower() not in app_answer_cache.STOPWORDS]
+    expanded = [ABBREVIATIONS.get(word.lower(), word) for word in words]
+    statement = list(expanded)
+    while statement and statement[0].lower() in _QUESTION_OPENING:
+        statement.pop(0)
+    return [
+        # abbreviations spelled out, as documents write them
+        " ".join(expanded),
+        # keyword form: what the lexical half of a hybrid search matches on
+        " ".join(keywords),
+        # statement form, closer to how a document phrases the answer
+        " ".join(statement),
+    ]
+
+
+class ParaphraseCache():
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        paraphrases = self._entries.get(key)
+        if paraphrases is not None:
+            self._entries.move_to_end(key)
+        return paraphrases
+
+    def put(self, key: str, paraphrases: list):
+        self._entries[key] = paraphrases
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+paraphrase_cache = ParaphraseCache(QUERY_EXPANSION_CACHE_MAX_ENTRIES)
+
+
+async def model_paraphrases(query: str, count: int) -> list:
+    key = app_retrieve_cache.normalize_query(query)
+    paraphrases = paraphrase_cache.get(key)
+    if paraphrases is None:
+        prompt = f"""Write {count} different search queries for a document knowledge base that together find what the question asks.
+Use the terms the documents are likely to use, spell out abbreviations, keep product codes and names as written.
+<question>{query}</question>
+Reply with one query per line and nothing else."""
+        labels = dict(mode="QueryExpansion", model=QUERY_EXPANSION_MODEL_ID, kb="none")
+        text = await app_bedrock_lib.complete(QUERY_EXPANSION_MODEL_ID, prompt, 300, labels)
+        paraphrases = [clean_query(line.strip().lstrip("-*0123456789. ")) for line in text.splitlines() if line.strip()]
+        paraphrase_cache.put(key, paraphrases)
+    return paraphrases
+
+
+async def paraphrases(query: str, count: int = QUERY_EXPANSION_COUNT) -> list:
+    # up to count queries other than the question itself
+    candidates = []
+    if QUERY_EXPANSION_MODEL_ID:
+        try:
+            candidates = await asyncio.wait_for(model_paraphrases(query, count), QUERY_EXPANSION_TIMEOUT_SECONDS)
+        except Exception as e:
+            app_logging.event("query_expansion.model_failed", logging.WARNING, error=type(e).__name__)
+    candidates = candidates + local_paraphrases(query)
+
+    seen = {app_retrieve_cache.normalize_query(query)}
+    unique = []
+    for candidate in candidates:
+        normalized = app_retrieve_cache.normalize_query(candidate)
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            unique.append(candidate)
+    return unique[0:count]
+
+
+def fuse(responses: list, number_of_results: int, k: int = QUERY_EXPANSION_RRF_K) -> tuple:
+    # (results, distinct chunks found). Reciprocal rank fusion over the result lists, each ranked by its own
+    # KnowledgeBase score. A chunk found by several searches keeps its best score and gets fusionScore,
+    # which ranks it from here on.
+    fused = {}
+    for response in responses:
+        ranked = sorted(response["retrievalResults"], key=lambda result: result.get("score", 0), reverse=True)
+        for rank, result in enumerate(ranked, 1):
+            key = app_retrieve_lib.chunk_key(result)
+            entry = fused.get(key)
+            if entry is None:
+                fused[key] = entry = [0.0, result]
+            elif result.get("score", 0) > entry[1].get("score", 0):
+                entry[1] = result
+            entry[0] += 1 / (k + rank)
+    ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)
+    return [dict(result, fusionScore=round(score, 6)) for score, result in ranked[0:number_of_results]], len(fused)
+
+
+async def multi_search(search, query: str, number_of_results: int) -> dict:
+
+    # search(query) -> Retrieve response. The question is searched while the paraphrases are written, then the
+    # paraphrases concurrently: one retrieval round trip with local paraphrases.
+    first = asyncio.ensure_future(search(query))
+    try:
+        queries = await paraphrases(query)
+    except BaseException:
+        first.cancel()
+        raise
+    responses = await asyncio.gather(first, *[search(paraphrase) for paraphrase in queries], return_exceptions=True)
+
+    succeeded = [response for response in responses if not isinstance(response, BaseException)]
+    if not succeeded:
+        raise responses[0]
+    for paraphrase, response in zip([query] + queries, responses):
+        if isinstance(response, BaseException):
+            app_logging.event("query_expansion.search_failed", logging.WARNING, query=paraphrase, error=type(response).__name__)
+
+    results, candidates = fuse(succeeded, number_of_results)
+    errors = {}
+    for response in succeeded:
+        errors.update(response.get("errors", {}))
+    return {
+        "retrievalResults": results,
+        "cached": all(response.get("cached") for response in succeeded),
+        "errors": errors,
+        "queries": [query] + queries,
+        "candidates": candidates,
+    }
@@ -1,22 +1,34 @@
-import os
-import boto3
+import time
 import chainlit as cl
 import logging
 import traceback
 import app_bedrock
+import app_bedrock_router
+import app_bedrock_clients
+import app_answer_cache
+import app_retrieve_lib
+import app_retrieve_cache
+import app_retrieve_filter
+import app_context_budget
+import app_context_dedup
+import app_rerank
+import app_query_expansion
+import app_conversation
+import app_metrics
+import app_usage
+import app_logging
 
 from botocore.exceptions import ClientError
 
-AWS_REGION = os.environ["AWS_REGION"]
-
-bedrock_runtime = boto3.client('bedrock-runtime', region_name=AWS_REGION)
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
 
 async def main_retrieve(message: cl.Message):
 
+    bedrock_agent_runtime = app_bedrock_clients.get_client('bedrock-agent-runtime')
+
     application_options = cl.user_session.get("application_options")
     #session_id = cl.user_session.get("session_id") 
     knowledge_base_id = cl.user_session.get("knowledge_base_id") 
+    knowledge_base_ids = cl.user_session.get("knowledge_base_ids")
     #llm_model_arn = cl.user_session.get("llm_model_arn") 
     bedrock_model_id = cl.user_session.get("bedrock_model_id")
     inference_parameters = cl.user_session.get("inference_parameters")
@@ -26,8 +38,22 @@ async def main_retrieve(message: cl.Message):
     option_state_conclusions_first = application_options.get("option_state_conclusions_first")
     option_source_table_markdown_display = application_options.get("option_source_table_markdown_display")
     kb_retrieve_document_count = cl.user_session.get("kb_retrieve_document_count")
+    kb_search_type = cl.user_session.get("kb_search_type")
+    kb_metadata_filter = cl.user_session.get("kb_metadata_filter")
+    kb_auto_filter = cl.user_session.get("kb_auto_filter")
+    kb_rerank = cl.user_session.get("kb_rerank")
+    kb_multi_query = cl.user_session.get("kb_multi_query")
 
     query = message.content
+    memory = app_conversation.session_memory()
+    # the conversation gets at most half of what the model window leaves for history and retrieved context
+    history_budget = app_context_budget.remaining_tokens(bedrock_model_id, inference_parameters.get("max_tokens_to_sample"), query) // 2
+    history = app_conversation.history(memory).fit(history_budget)
+    search_query = query
+
+    request_start = time.perf_counter()
+    # the primary KB only: the additional KBs are a free-form list and would make a series per combination
+    metric_labels = dict(mode="Retrieve", model=bedrock_model_id, kb=knowledge_base_id)
 
     msg = cl.Message(content="")
 
@@ -37,63 +63,113 @@ async def main_retrieve(message: cl.Message):
 
         context_info = ""
 
-        async with cl.Step(name="KnowledgeBase", type="llm", root=False) as step:
+        async with app_metrics.span("KnowledgeBase", knowledge_base_ids=" ".join(knowledge_base_ids), **metric_labels), cl.Step(name="KnowledgeBase", type="llm", root=False) as step:
             step.input = msg.content
 
             await step.stream_token(f"\nSearch Max {kb_retrieve_document_count} documents.\n")
 
+            # reranking over-fetches and keeps the best kb_retrieve_document_count
+            retrieve_count = app_rerank.fetch_count(kb_retrieve_document_count) if kb_rerank else kb_retrieve_document_count
+
             try:
 
-                prompt = f"""\n\nHuman: {query[0:900]}
-                Assistant:
-                """
-
-                response = bedrock_agent_runtime.retrieve(
-                    knowledgeBaseId = knowledge_base_id,
-                    retrievalQuery={
-                        'text': prompt,
-                    },
-                    retrievalConfiguration={
-                        'vectorSearchConfiguration': {
-                            'numberOfResults': kb_retrieve_document_count
-                        }
-                    }
-                )
+                # a follow-up is searched as a standalone question built from the conversation
+                search_query = await app_conversation.standalone_query(query, memory)
+                if search_query != query:
+                    await step.stream_token(f"\nrewrite={search_query}\n")
+
+                retrieval_query = app_query_expansion.clean_query(search_query)
+                if len(knowledge_base_ids) > 1:
+                    await step.stream_token(f"\nKnowledgeBases {' '.join(knowledge_base_ids)}\n")
+
+                async def search_one(q: str, metadata_filter: dict) -> dict:
+                    if len(knowledge_base_ids) > 1:
+                        return await app_retrieve_lib.retrieve_multi(bedrock_agent_runtime, knowledge_base_ids, q, retrieve_count, search_type=kb_search_type, metadata_filter=metadata_filter)
+                    return await app_retrieve_lib.retrieve(bedrock_agent_runtime, knowledge_base_id, q, retrieve_count, search_type=kb_search_type, metadata_filter=metadata_filter)
+
+                async def search(metadata_filter: dict) -> dict:
+                    if kb_multi_query:
+                        # the question and its paraphrases searched concurrently, merged by reciprocal rank fusion
+                        response = await app_query_expansion.multi_search(lambda q: search_one(q, metadata_filter), retrieval_query, retrieve_count)
+                        for i, q in enumerate(response["queries"]):
+                            await step.stream_token(f"\nquery[{i}]={q}\n")
+                        await step.stream_token(f"\nfusion.candidates={response['candidates']}\n")
+                    else:
+                        response = await search_one(retrieval_query, metadata_filter)
+                    for failed_knowledge_base_id, error in response.get("errors", {}).items():
+                        await step.stream_token(f"\nKnowledgeBase {failed_knowledge_base_id} failed: {error}\n")
+                    return response
+
+                retrieval_filter, entities = app_retrieve_filter.query_filter(search_query, kb_metadata_filter, kb_auto_filter)
+                await step.stream_token(f"\nsearch_type={kb_search_type or 'DEFAULT'} filter={app_retrieve_filter.describe(retrieval_filter)}\n")
+
+                retrieve_start = time.perf_counter()
+                response = await search(retrieval_filter)
+                if entities and not response["retrievalResults"]:
+                    # the entities may not be in the KB metadata, search again with the MetadataFilter setting only
+                    await step.stream_token(f"\nfilter.fallback=no results for {app_retrieve_filter.describe(entities)}\n")
+                    response = await search(kb_metadata_filter)
+                app_metrics.RETRIEVE_SECONDS.labels(**metric_labels).observe(time.perf_counter() - retrieve_start)
+                app_metrics.record_cache(metric_labels, "retrieve", response.get("cached"))
+
+                cache = app_retrieve_cache.retrieve_cache
+                cache_status = "hit" if response.get("cached") else "miss"
+                await step.stream_token(f"\ncache={cache_status} cache.hit_rate={cache.hit_rate:.2f}\n")
+
+                max_tokens = inference_parameters.get("max_tokens_to_sample")
+                context_budget = app_context_budget.context_budget(bedrock_model_id, max_tokens, query, history.tokens)
+                retrieval_results, duplicate_results = app_context_dedup.deduplicate(response['retrievalResults'])
+                await step.stream_token(f"\ndedup.removed={len(duplicate_results)}\n")
+                if kb_rerank:
+                    rerank_start = time.perf_counter()
+                    fetched = len(retrieval_results)
+                    retrieval_results = await app_rerank.rerank_async(retrieval_query, retrieval_results, kb_retrieve_document_count)
+                    rerank_seconds = time.perf_counter() - rerank_start
+                    app_metrics.RERANK_SECONDS.labels(**metric_labels).observe(rerank_seconds)
+                    await step.stream_token(f"\nrerank={app_rerank.describe()} fetched={fetched} kept={len(retrieval_results)} rerank.ms={rerank_seconds * 1000:.1f}\n")
+                packed_context = app_context_budget.pack(retrieval_results, context_budget)
 
                 reference_elements = []
-                for i, retrievalResult in enumerate(response['retrievalResults']):
+                for i, (retrievalResult, text, context_status) in enumerate(packed_context.entries):
                     uri = retrievalResult['location']['s3Location']['uri']
-                    text = retrievalResult['content']['text']
                     excerpt = text[0:75]
                     score = retrievalResult['score']
-                    print(f"{i} RetrievalResult: {score} {uri} {excerpt}")
+                    app_logging.event("retrieve.result", logging.DEBUG, i=i, score=score, uri=uri, status=context_status, excerpt=repr(excerpt))
                     #await msg.stream_token(f"\n{i} RetrievalResult: {score} {uri} {excerpt}\n")
-                    context_info += f"{text}\n" #context_info += f"<p>${text}</p>\n" #context_info += f"${text}\n"
+                    if context_status != "dropped":
+                        context_info += f"{text}\n" #context_info += f"<p>${text}</p>\n" #context_info += f"${text}\n"
                     #await step.stream_token(f"\n[{i+1}] score={score} uri={uri} len={len(text)} text={excerpt}\n")
-                    await step.stream_token(f"\n[{i+1}] score={score} uri={uri} len={len(text)}\n")
+                    kb = f" kb={retrievalResult['knowledgeBaseId']}" if "knowledgeBaseId" in retrievalResult else ""
+                    rerank_score = f" rerank={retrievalResult['rerankScore']}" if "rerankScore" in retrievalResult else ""
+                    fusion_score = f" fusion={retrievalResult['fusionScore']}" if "fusionScore" in retrievalResult else ""
+                    await step.stream_token(f"\n[{i+1}] score={score}{fusion_score}{rerank_score}{kb} uri={uri} len={len(text)} context={context_status}\n")
                     reference_elements.append(cl.Text(name=f"[{i+1}] {uri}", content=text, display="inline"))
-                
+
+                await step.stream_token(f"\ncontext.tokens={packed_context.tokens} context.budget={context_budget} context.tokens_saved={packed_context.tokens_saved}\n")
                 await step.stream_token(f"\n")
                 step.elements = reference_elements
 
             except Exception as e:
                 logging.error(traceback.format_exc())
+                app_metrics.ERRORS.labels(stage="retrieve", **metric_labels).inc()
                 await msg.stream_token(f"{e}")
             finally:
                 await step.send()
 
-        async with cl.Step(name="Model", type="llm", root=False) as step_llm:
+        async with app_metrics.span("Model", **metric_labels), cl.Step(name="Model", type="llm", root=False) as step_llm:
             step_llm.input = msg.content
 
             elements = []
 
             try:
 
+                prompt_build_start = time.perf_counter()
+
                 bedrock_model_strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
 
                 # Create Prompt create_prompt(self, application_options: dict, context_info: str, query: str) -> str:
 
-                prompt = bedrock_model_strategy.create_prompt(application_options, context_info, query)
+                prompt = bedrock_model_strategy.create_prompt(application_options, context_info, bedrock_model_strategy.history_query(query, history))
 
                 # End - Create Prompt 
 
@@ -104,24 +180,61 @@ async def main_retrieve(message: cl.Message):
 
                 max_tokens = inference_parameters.get("max_tokens_to_sample")
                 temperature = inference_parameters.get('temperature')
-                await step_llm.stream_token(f"model.id={bedrock_model_id} prompt.len={len(prompt)} temperature={temperature} max_tokens={max_tokens}")
+                await step_llm.stream_token(f"model.id={bedrock_model_id} prompt.len={len(prompt)} temperature={temperature} max_tokens={max_tokens} history.turns={len(history.turns)}")
 
-                request = bedrock_model_strategy.create_request(inference_parameters, prompt)
- 
-                print(f"{type(request)} {request}")
+                request = bedrock_model_strategy.create_request(inference_parameters, prompt, history)
 
-                response = bedrock_model_strategy.send_request(request, bedrock_runtime, bedrock_model_id)
-
-                await bedrock_model_strategy.process_response(response, msg)
+                app_metrics.PROMPT_BUILD_SECONDS.labels(**metric_labels).observe(time.perf_counter() - prompt_build_start)
+ 
+                app_logging.payload("bedrock.request", request, mode="Retrieve", model=bedrock_model_id, prompt_len=len(prompt))
+
+                answer_cache = app_answer_cache.answer_cache
+                answer = None
+                prompt_fingerprint = None
+                # a follow-up's answer depends on the conversation and is not reused for another
+                if answer_cache.cacheable(inference_parameters) and app_conversation.shares_answers(query, history):
+                    prompt_fingerprint = answer_cache.fingerprint(bedrock_model_id, inference_parameters, bedrock_model_strategy.create_prompt(application_options, context_info, ""))
+                    answer = answer_cache.get(prompt_fingerprint, query)
+                    app_metrics.record_cache(metric_labels, "answer", answer is not None)
+
+                if answer is not None:
+                    await step_llm.stream_token(f" answer_cache=hit answer_cache.hit_rate={answer_cache.hit_rate:.2f}")
+                    response_stream = await bedrock_model_strategy.replay_response(answer, msg)
+                else:
+                    response, route = await app_bedrock_router.send_request(bedrock_model_strategy, request, bedrock_model_id)
+                    stream_start = time.perf_counter()
+                    app_metrics.FIRST_BYTE_SECONDS.labels(**metric_labels).observe(route.first_byte_seconds)
+                    app_metrics.RETRIES.labels(**metric_labels).inc(route.attempts - 1)
+                    await step_llm.stream_token(f" {route.stats}")
+
+                    response_stream = await bedrock_model_strategy.process_response(response, msg)
+                    app_metrics.STREAM_SECONDS.labels(**metric_labels).observe(time.perf_counter() - stream_start)
+                    # usage counts against the model that answered, a fallback sibling included
+                    session_usage = app_usage.record(dict(metric_labels, model=route.bedrock_model_id), response_stream.usage)
+                    await step_llm.stream_token(f" session.{session_usage.stats}")
+
+                    answer = response_stream.answer
+                    # an answer from a fallback model is not cached as this model's
+                    # and an answer written with a conversation in view is not shared with other users
+                    if prompt_fingerprint is not None and answer and route.bedrock_model_id == bedrock_model_id and not history:
+                        answer_cache.put(prompt_fingerprint, knowledge_base_ids, query, answer)
+
+                if memory is not None and response_stream.text:
+                    memory.add(query, search_query, response_stream.text)
+
+                if response_stream.first_emit_at is not None:
+                    app_metrics.TIME_TO_FIRST_TOKEN_SECONDS.labels(**metric_labels).observe(response_stream.first_emit_at - request_start)
 
                 step_llm.elements = elements
 
             except ClientError as err:
                 message = err.response["Error"]["Message"]
                 logging.error("A client error occurred: %s", message)
+                app_metrics.ERRORS.labels(stage="model", **metric_labels).inc()
                 await msg.stream_token(f"{message}")
             except Exception as e:
                 logging.error(traceback.format_exc())
+                app_metrics.ERRORS.labels(stage="model", **metric_labels).inc()
                 await msg.stream_token(f"{e}")
             finally:
                 await step_llm.send()
@@ -132,6 +245,8 @@ async def main_retrieve(message: cl.Message):
 
     except Exception as e:
         logging.error(traceback.format_exc())
+        app_metrics.ERRORS.labels(stage="request", **metric_labels).inc()
         await msg.stream_token(f"{e}")
     finally:
         await msg.send()
+        app_metrics.REQUEST_SECONDS.labels(**metric_labels).observe(time.perf_counter() - request_start)
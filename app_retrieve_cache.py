@@ -0,0 +1,134 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import app_bedrock_async
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+RETRIEVE_CACHE_ENABLED = os.environ.get("RETRIEVE_CACHE_ENABLED", "true").lower() == "true"
+RETRIEVE_CACHE_TTL_SECONDS = float(os.environ.get("RETRIEVE_CACHE_TTL_SECONDS", "900"))
+RETRIEVE_CACHE_MAX_ENTRIES = int(os.environ.get("RETRIEVE_CACHE_MAX_ENTRIES", "1024"))
+RETRIEVE_CACHE_MAX_CHARS = int(os.environ.get("RETRIEVE_CACHE_MAX_CHARS", str(64 * 1024 * 1024)))
+# Optional shared backend for multi-replica deployments, e.g. redis://cache:6379/0
+RETRIEVE_CACHE_REDIS_URL = os.environ.get("RETRIEVE_CACHE_REDIS_URL", "")
+
+_SCAFFOLD = re.compile(r"^\s*human:\s*|\s*assistant:\s*$", re.IGNORECASE)
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    query = _SCAFFOLD.sub(" ", query.strip())
+    query = _PUNCTUATION.sub(" ", query.lower())
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+def _results_size(results: list) -> int:
+    return sum(len(result.get("content", {}).get("text", "")) for result in results)
+
+
+class RetrieveCache():
+
+    def __init__(self, ttl: float, max_entries: int, max_chars: int, redis_url: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._kb_versions = {}
+        self._lock = threading.Lock()
+        self._shared = None
+        if redis_url:
+            if redis is None:
+                logging.warning("RETRIEVE_CACHE_REDIS_URL is set but the redis package is not installed. Using in-process cache only.")
+            else:
+                self._shared = redis.Redis.from_url(redis_url)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def key(self, knowledge_base_id: str, query: str, number_of_results: int, *args) -> str:
+        version = self._kb_versions.get(knowledge_base_id, "")
+        raw = json.dumps([knowledge_base_id, version, normalize_query(query), number_of_results, *args], sort_keys=True, default=str)
+        return "retrieve:" + hashlib.sha256(raw.encode()).hexdigest()
+
+    def set_knowledge_base_version(self, knowledge_base_id: str, updated_at):
+        updated_at = str(updated_at)
+        previous = self._kb_versions.get(knowledge_base_id)
+        self._kb_versions[knowledge_base_id] = updated_at
+        if previous is not None and previous != updated_at:
+            self.invalidate_knowledge_base(knowledge_base_id)
+
+    def invalidate_knowledge_base(self, knowledge_base_id: str):
+        # shared entries are keyed by the KB version, so they age out on their own
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == knowledge_base_id]:
+                self._remove(key)
+
+    def _remove(self, key: str):
+        _, _, results = self._entries.pop(key)
+        self._chars -= _results_size(results)
+
+    def _get_local(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            _, expires_at, results = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return results
+
+    def _put_local(self, key: str, knowledge_base_id: str, results: list):
+        size = _results_size(results)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (knowledge_base_id, time.monotonic() + self.ttl, results)
+            self._chars += size
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                self._remove(next(iter(self._entries)))
+
+    async def get(self, key: str, knowledge_base_id: str):
+        results = self._get_local(key)
+        if results is None and self._shared is not None:
+            try:
+                value = await app_bedrock_async.run_blocking(self._shared.get, key)
+                if value is not None:
+                    results = json.loads(value)
+                    self._put_local(key, knowledge_base_id, results)
+            except Exception as e:
+                logging.warning("Shared retrieve cache read failed: %s", e)
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return results
+
+    async def put(self, key: str, knowledge_base_id: str, results: list):
+        self._put_local(key, knowledge_base_id, results)
+        if self._shared is not None:
+            try:
+                value = json.dumps(results, default=str)
+                await app_bedrock_async.run_blocking(self._shared.set, key, value, ex=int(self.ttl))
+            except Exception as e:
+                logging.warning("Shared retrieve cache write failed: %s", e)
+
+
+retrieve_cache = RetrieveCache(RETRIEVE_CACHE_TTL_SECONDS, RETRIEVE_CACHE_MAX_ENTRIES, RETRIEVE_CACHE_MAX_CHARS, RETRIEVE_CACHE_REDIS_URL)
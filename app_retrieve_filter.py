@@ -0,0 +1,75 @@
+import os
+import re
+import json
+
+# Metadata key -> regex. Entities found in the query become an equals/in filter on that key.
+# A pattern with a group filters on the group, e.g. {"year": "\\bFY(\\d{4})\\b"}
+KB_FILTER_ENTITIES = json.loads(os.environ.get("KB_FILTER_ENTITIES", json.dumps({"product_code": r"\b[A-Z]{2,4}-\d{3,6}\b"})))
+# Bedrock accepts at most this many entries in one andAll/orAll and in one in/notIn list
+KB_FILTER_MAX_VALUES = int(os.environ.get("KB_FILTER_MAX_VALUES", "5"))
+
+FILTER_OPERATORS = {"equals", "notEquals", "greaterThan", "greaterThanOrEquals", "lessThan", "lessThanOrEquals",
+    "in", "notIn", "startsWith", "listContains", "stringContains", "andAll", "orAll"}
+
+_entity_patterns = {key: re.compile(pattern) for key, pattern in KB_FILTER_ENTITIES.items()}
+
+
+def parse_filter(text: str):
+    # the MetadataFilter setting, a RetrievalFilter as JSON, e.g. {"equals": {"key": "category", "value": "pumps"}}
+    if not text or not text.strip():
+        return None
+    metadata_filter = json.loads(text)
+    if not isinstance(metadata_filter, dict) or len(metadata_filter) != 1 or next(iter(metadata_filter)) not in FILTER_OPERATORS:
+        raise ValueError(f"Metadata filter must be one of {', '.join(sorted(FILTER_OPERATORS))}")
+    return metadata_filter
+
+
+def find_entities(query: str) -> dict:
+    entities = {}
+    for key, pattern in _entity_patterns.items():
+        values = []
+        for match in pattern.finditer(query):
+            value = match.group(1) if pattern.groups else match.group(0)
+            if value not in values:
+                values.append(value)
+        if values:
+            entities[key] = values[0:KB_FILTER_MAX_VALUES]
+    return entities
+
+
+def entity_filter(entities: dict):
+    filters = []
+    for key, values in entities.items():
+        if len(values) == 1:
+            filters.append({"equals": {"key": key, "value": values[0]}})
+        else:
+            filters.append({"in": {"key": key, "value": values}})
+    return combine(*filters)
+
+
+def _and_all(conditions: list) -> dict:
+    if len(conditions) == 1:
+        return conditions[0]
+    # andAll takes 2..KB_FILTER_MAX_VALUES conditions, nest the rest
+    if len(conditions) > KB_FILTER_MAX_VALUES:
+        conditions = conditions[0:KB_FILTER_MAX_VALUES - 1] + [_and_all(conditions[KB_FILTER_MAX_VALUES - 1:])]
+    return {"andAll": conditions}
+
+
+def combine(*filters):
+    conditions = []
+    for metadata_filter in filters:
+        if metadata_filter is None:
+            continue
+        conditions += metadata_filter["andAll"] if "andAll" in metadata_filter else [metadata_filter]
+    return _and_all(conditions) if conditions else None
+
+
+def query_filter(query: str, metadata_filter: dict = None, auto_filter: bool = False):
+    # (filter for this query, entities it was derived from)
+    entities = find_entities(query) if auto_filter else {}
+    return combine(metadata_filter, entity_filter(entities)), entities
+
+
+def describe(metadata_filter) -> str:
+    return json.dumps(metadata_filter, separators=(",", ":"), ensure_ascii=False) if metadata_filter else "none"
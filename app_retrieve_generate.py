@@ -1,24 +1,34 @@
-import os
-import boto3
+import time
 import chainlit as cl
 import logging
 import traceback
+import app_retrieve_lib
+import app_bedrock_async
+import app_stream_sink
+import app_bedrock_clients
+import app_metrics
+import app_logging
 
-AWS_REGION = os.environ["AWS_REGION"]
-
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
 
 async def main_retrieve_and_generate(message: cl.Message):
 
+    bedrock_agent_runtime = app_bedrock_clients.get_client('bedrock-agent-runtime')
+
     session_id = cl.user_session.get("session_id") 
     knowledge_base_id = cl.user_session.get("knowledge_base_id") 
     llm_model_arn = cl.user_session.get("llm_model_arn") 
     inference_parameters = cl.user_session.get("inference_parameters")
     kb_retrieve_document_count = cl.user_session.get("kb_retrieve_document_count")
+    kb_search_type = cl.user_session.get("kb_search_type")
+    kb_prompt_template = cl.user_session.get("kb_prompt_template")
+    kb_metadata_filter = cl.user_session.get("kb_metadata_filter")
 
     query = message.content
     query = query[0:900]
 
+    request_start = time.perf_counter()
+    metric_labels = dict(mode="RetrieveAndGenerate", model=llm_model_arn, kb=knowledge_base_id)
+
     prompt = f"""\n\nHuman: {query}
     Assistant:
     """
@@ -48,6 +58,29 @@ async def main_retrieve_and_generate(message: cl.Message):
 
     try:
 
+        vector_search_configuration = {
+            'numberOfResults': kb_retrieve_document_count, #Minimum value of 1. Maximum value of 100
+        }
+        if kb_search_type:
+            vector_search_configuration['overrideSearchType'] = kb_search_type # 'HYBRID'|'SEMANTIC'
+        if kb_metadata_filter:
+            vector_search_configuration['filter'] = kb_metadata_filter
+
+        generation_configuration = {
+            'inferenceConfig': {
+                'textInferenceConfig': {
+                    'temperature': inference_parameters.get("temperature"),
+                    'topP': inference_parameters.get("top_p"),
+                    'maxTokens': inference_parameters.get("max_tokens_to_sample"),
+                    'stopSequences': inference_parameters.get("stop_sequences"),
+                }
+            }
+        }
+        if kb_prompt_template:
+            generation_configuration['promptTemplate'] = {
+                'textPromptTemplate': prompt_template
+            }
+
         params = {
             "input" : {
                 'text': prompt,
@@ -58,17 +91,10 @@ async def main_retrieve_and_generate(message: cl.Message):
                     'knowledgeBaseId': knowledge_base_id,
                     'modelArn': llm_model_arn,
                     'retrievalConfiguration': {
-                        'vectorSearchConfiguration': {
-                            'numberOfResults': 3, #kb_retrieve_document_count,  #Minimum value of 1. Maximum value of 100
-                            #'overrideSearchType': 'HYBRID'|'SEMANTIC'
-                        }
+                        'vectorSearchConfiguration': vector_search_configuration
                     },
-                    # Unknown parameter in retrieveAndGenerateConfiguration.knowledgeBaseConfiguration: "generationConfiguration", must be one of: knowledgeBaseId, modelArn, retrievalConfiguration
-                    #'generationConfiguration': {
-                    #    'promptTemplate': {
-                    #        'textPromptTemplate': prompt_template
-                    #    }
-                    #}
+                    # dropped by app_retrieve_lib on botocore versions that do not know it yet
+                    'generationConfiguration': generation_configuration
                 }
             },
         }
@@ -76,74 +102,10 @@ async def main_retrieve_and_generate(message: cl.Message):
         if session_id != "" and session_id is not None:
             params["sessionId"] = session_id #session_id=84219eab-2060-4a8f-a481-3356d66b8586
 
-        response = bedrock_agent_runtime.retrieve_and_generate(**params)
-
-        #response = bedrock_agent_runtime.retrieve_and_generate(
-        #    #sessionId = session_id,
-        #    input = {
-        #        'text': prompt,
-        #    },
-        #    retrieveAndGenerateConfiguration = {
-        #        'type': 'KNOWLEDGE_BASE',
-        #        'knowledgeBaseConfiguration': {
-        #            'knowledgeBaseId': knowledge_base_id,
-        #            'modelArn': llm_model_arn,
-        #            'retrievalConfiguration': {
-        #                'vectorSearchConfiguration': {
-        #                    'numberOfResults': kb_retrieve_document_count,  #Minimum value of 1. Maximum value of 100
-        #                    #'overrideSearchType': 'HYBRID'|'SEMANTIC'
-        #                }
-        #            },
-        #            # Unknown parameter in retrieveAndGenerateConfiguration.knowledgeBaseConfiguration: "generationConfiguration", must be one of: knowledgeBaseId, modelArn, retrievalConfiguration
-        #            #'generationConfiguration': {
-        #            #    'promptTemplate': {
-        #            #        'textPromptTemplate': prompt_template
-        #            #    }
-        #            #}
-        #        }
-        #    }
-        #)
-
-        text = response['output']['text']
-        await msg.stream_token(text)
-
-        async with cl.Step(name="KnowledgeBase", type="llm", root=False) as step:
-            step.input = msg.content
-
-            elements = []
-
-            if "citations" in response:
-                #print(response["citations"])
-                for citation in response["citations"]:
-                    if "retrievedReferences" in citation:
-                        references = citation["retrievedReferences"]
-                        #print(references)
-                        reference_idx = 0
-                        for reference in references:
-                            reference_idx = reference_idx + 1
-                            print(reference)
-                            reference_name = f"r{reference_idx}"
-                            reference_text = ""
-                            reference_location_type = ""
-                            reference_location_uri = ""
-                            if "content" in reference:
-                                content = reference["content"]
-                                reference_text = content["text"]
-                                #elements.append(cl.Text(name=f"r{reference_idx}", content=reference_text, display="inline"))
-                            if "location" in reference:
-                                location = reference["location"]
-                                location_type = location["type"]
-                                reference_location_type = location_type
-                                if "S3" == location_type:
-                                    location_uri = location["s3Location"]["uri"]
-                                    reference_location_uri = location_uri
-                                    reference_name = f"\n{reference_location_type}-{reference_location_uri}"
-                            #await step.stream_token(f"\n{reference_location_type} {reference_location_uri}")
-                            #elements.append(cl.Text(name=f"src_{reference_idx}", content=f"{location_uri}\n{reference_text}"))
-                            elements.append(cl.Text(name=f"{reference_name}", content=reference_text, display="inline"))
-
-            step.elements = elements
-            await step.send()
+        if app_retrieve_lib.supports_retrieve_and_generate_stream(bedrock_agent_runtime):
+            response = await stream_retrieve_and_generate(bedrock_agent_runtime, params, msg, metric_labels, request_start)
+        else:
+            response = await blocking_retrieve_and_generate(bedrock_agent_runtime, params, msg, metric_labels, request_start)
 
         session_id = response['sessionId']
         await msg.stream_token(f"\nsession_id={session_id}")
@@ -151,6 +113,122 @@ async def main_retrieve_and_generate(message: cl.Message):
 
     except Exception as e:
         logging.error(traceback.format_exc())
+        app_metrics.ERRORS.labels(stage="request", **metric_labels).inc()
         await msg.stream_token(f"{e}")
     finally:
-        await msg.send()
\ No newline at end of file
+        await msg.send()
+        app_metrics.REQUEST_SECONDS.labels(**metric_labels).observe(time.perf_counter() - request_start)
+
+
+def reference_element(reference: dict, reference_idx: int) -> cl.Text:
+    app_logging.payload("kb.reference", reference, i=reference_idx)
+    reference_name = f"r{reference_idx}"
+    reference_text = ""
+    reference_location_type = ""
+    reference_location_uri = ""
+    if "content" in reference:
+        content = reference["content"]
+        reference_text = content["text"]
+        #elements.append(cl.Text(name=f"r{reference_idx}", content=reference_text, display="inline"))
+    if "location" in reference:
+        location = reference["location"]
+        location_type = location["type"]
+        reference_location_type = location_type
+        if "S3" == location_type:
+            location_uri = location["s3Location"]["uri"]
+            reference_location_uri = location_uri
+            reference_name = f"\n{reference_location_type}-{reference_location_uri}"
+    #await step.stream_token(f"\n{reference_location_type} {reference_location_uri}")
+    #elements.append(cl.Text(name=f"src_{reference_idx}", content=f"{location_uri}\n{reference_text}"))
+    return cl.Text(name=f"{reference_name}", content=reference_text, display="inline")
+
+
+async def stream_retrieve_and_generate(bedrock_agent_runtime, params: dict, msg: cl.Message, metric_labels: dict, request_start: float) -> dict:
+
+    sink = app_stream_sink.BufferedMessageStream(msg)
+
+    async with app_metrics.span("RetrieveAndGenerate", **metric_labels):
+        response = await app_retrieve_lib.retrieve_and_generate_stream(bedrock_agent_runtime, params)
+
+        async with cl.Step(name="KnowledgeBase", type="llm", root=False) as step:
+            step.input = msg.content
+
+            # citations are attached as they arrive, right after the text they support.
+            # They are sent one by one rather than through step.elements so the step update does not resend them.
+            reference_idx = 0
+            try:
+                async for event in app_bedrock_async.iterate_stream(response["stream"]):
+                    if "output" in event:
+                        await sink.stream_token(event["output"]["text"])
+                    elif "citation" in event:
+                        citation = event["citation"]
+                        references = citation.get("retrievedReferences") or citation.get("citation", {}).get("retrievedReferences", [])
+                        for reference in references:
+                            reference_idx = reference_idx + 1
+                            await reference_element(reference, reference_idx).send(for_id=step.id)
+                    elif "guardrail" in event:
+                        await sink.annotate(f"\n\nguardrail={event['guardrail'].get('action')}")
+            finally:
+                await sink.flush()
+
+    if sink.first_emit_at is not None:
+        app_metrics.TIME_TO_FIRST_TOKEN_SECONDS.labels(**metric_labels).observe(sink.first_emit_at - request_start)
+
+    return response
+
+
+async def blocking_retrieve_and_generate(bedrock_agent_runtime, params: dict, msg: cl.Message, metric_labels: dict, request_start: float) -> dict:
+
+    async with app_metrics.span("RetrieveAndGenerate", **metric_labels):
+        response = await app_retrieve_lib.retrieve_and_generate(bedrock_agent_runtime, params)
+
+    #response = bedrock_agent_runtime.retrieve_and_generate(
+    #    #sessionId = session_id,
+    #    input = {
+    #        'text': prompt,
+    #    },
+    #    retrieveAndGenerateConfiguration = {
+    #        'type': 'KNOWLEDGE_BASE',
+    #        'knowledgeBaseConfiguration': {
+    #            'knowledgeBaseId': knowledge_base_id,
+    #            'modelArn': llm_model_arn,
+    #            'retrievalConfiguration': {
+    #                'vectorSearchConfiguration': {
+    #                    'numberOfResults': kb_retrieve_document_count,  #Minimum value of 1. Maximum value of 100
+    #                    #'overrideSearchType': 'HYBRID'|'SEMANTIC'
+    #                }
+    #            },
+    #            # Unknown parameter in retrieveAndGenerateConfiguration.knowledgeBaseConfiguration: "generationConfiguration", must be one of: knowledgeBaseId, modelArn, retrievalConfiguration
+    #            #'generationConfiguration': {
+    #            #    'promptTemplate': {
+    #            #        'textPromptTemplate': prompt_template
+    #            #    }
+    #            #}
+    #        }
+    #    }
+    #)
+
+    text = response['output']['text']
+    await msg.stream_token(text)
+    app_metrics.TIME_TO_FIRST_TOKEN_SECONDS.labels(**metric_labels).observe(time.perf_counter() - request_start)
+
+    async with cl.Step(name="KnowledgeBase", type="llm", root=False) as step:
+        step.input = msg.content
+
+        elements = []
+
+        if "citations" in response:
+            #print(response["citations"])
+            for citation in response["citations"]:
+                if "retrievedReferences" in citation:
+                    references = citation["retrievedReferences"]
+                    #print(references)
+                    reference_idx = 0
+                    for reference in references:
+                        reference_idx = reference_idx + 1
+                        elements.append(reference_element(reference, reference_idx))
+
+        step.elements = elements
+        await step.send()
+
+    return response
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import logging
+import functools
+import botocore.model
+import app_bedrock_async
+import app_retrieve_cache
+import app_logging
+
+KB_RETRIEVE_MAX_CONCURRENCY = int(os.environ.get("KB_RETRIEVE_MAX_CONCURRENCY", "16"))
+KB_RETRIEVE_TIMEOUT = float(os.environ.get("KB_RETRIEVE_TIMEOUT", "10"))
+KB_RETRIEVE_AND_GENERATE_TIMEOUT = float(os.environ.get("KB_RETRIEVE_AND_GENERATE_TIMEOUT", "60"))
+# Use RetrieveAndGenerateStream when the installed botocore has it
+KB_RETRIEVE_AND_GENERATE_STREAM = os.environ.get("KB_RETRIEVE_AND_GENERATE_STREAM", "true").lower() == "true"
+
+_semaphore = asyncio.Semaphore(KB_RETRIEVE_MAX_CONCURRENCY)
+
+
+class RetrieveTimeoutError(Exception):
+    pass
+
+
+async def _call(timeout: float, fn, *args, **kwargs):
+    # the slot is held until the thread finishes: a timed-out call keeps running (and keeps its worker)
+    # until botocore returns, and must still count against KB_RETRIEVE_MAX_CONCURRENCY
+    await _semaphore.acquire()
+    loop = asyncio.get_running_loop()
+    try:
+        future = app_bedrock_async.executor.submit(functools.partial(fn, *args, **kwargs))
+    except BaseException:
+        _semaphore.release()
+        raise
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(_semaphore.release))
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise RetrieveTimeoutError(f"KnowledgeBase request timed out after {timeout}s")
+
+
+async def retrieve(bedrock_agent_runtime, knowledge_base_id: str, query: str, number_of_results: int, timeout: float = None, search_type: str = None, metadata_filter: dict = None) -> dict:
+
+    timeout = KB_RETRIEVE_TIMEOUT if timeout is None else timeout
+
+    cache = app_retrieve_cache.retrieve_cache
+    if app_retrieve_cache.RETRIEVE_CACHE_ENABLED:
+        cache_key = cache.key(knowledge_base_id, query, number_of_results, search_type, metadata_filter)
+        results = await cache.get(cache_key, knowledge_base_id)
+        if results is not None:
+            return {"retrievalResults": results, "cached": True}
+
+    vector_search_configuration = {
+        'numberOfResults': number_of_results
+    }
+    if search_type:
+        vector_search_configuration['overrideSearchType'] = search_type # 'HYBRID'|'SEMANTIC'
+    if metadata_filter:
+        vector_search_configuration['filter'] = metadata_filter
+
+    params = dict(
+        knowledgeBaseId = knowledge_base_id,
+        retrievalQuery={
+            'text': query,
+        },
+        retrievalConfiguration={
+            'vectorSearchConfiguration': vector_search_configuration
+        }
+    )
+    drop_unsupported_parameters(bedrock_agent_runtime, "Retrieve", params)
+
+    response = await _call(timeout, bedrock_agent_runtime.retrieve, **params)
+
+    if app_retrieve_cache.RETRIEVE_CACHE_ENABLED:
+        await cache.put(cache_key, knowledge_base_id, response["retrievalResults"])
+
+    return response
+
+
+def chunk_key(result: dict) -> str:
+    return " ".join(result.get("content", {}).get("text", "").split())
+
+
+async def retrieve_multi(bedrock_agent_runtime, knowledge_base_ids: list, query: str, number_of_results: int, timeout: float = None, search_type: str = None, metadata_filter: dict = None) -> dict:
+
+    # every KB is queried concurrently, so the wall time is that of the slowest KB
+    responses = await asyncio.gather(
+        *[retrieve(bedrock_agent_runtime, knowledge_base_id, query, number_of_results, timeout, search_type, metadata_filter) for knowledge_base_id in knowledge_base_ids],
+        return_exceptions=True
+    )
+
+    errors = {}
+    merged = {}
+    for knowledge_base_id, response in zip(knowledge_base_ids, responses):
+        if isinstance(response, BaseException):
+            errors[knowledge_base_id] = response
+            continue
+        for result in response["retrievalResults"]:
+            key = chunk_key(result)
+            if key not in merged or merged[key]["score"] < result["score"]:
+                merged[key] = dict(result, knowledgeBaseId=knowledge_base_id)
+
+    if len(errors) == len(knowledge_base_ids):
+        raise next(iter(errors.values()))
+
+    results = sorted(merged.values(), key=lambda result: result["score"], reverse=True)[0:number_of_results]
+    cached = all(not isinstance(response, BaseException) and response.get("cached") for response in responses)
+
+    return {"retrievalResults": results, "cached": cached, "errors": errors}
+
+
+def drop_unsupported_parameters(client, operation_name: str, params: dict) -> list:
+    # configuration newer than the installed botocore (e.g. generationConfiguration on 1.34.49) is
+    # removed instead of failing parameter validation on every message
+    try:
+        shape = client.meta.service_model.operation_model(operation_name).input_shape
+    except botocore.model.OperationNotFoundError:
+        return []
+    dropped = _drop_unsupported(shape, params, "")
+    if dropped:
+        app_logging.event("bedrock.unsupported_parameters", logging.WARNING, operation=operation_name, dropped=",".join(dropped))
+    return dropped
+
+
+def _drop_unsupported(shape, params: dict, path: str) -> list:
+    dropped = []
+    for name in list(params):
+        member = shape.members.get(name)
+        if member is None:
+            del params[name]
+            dropped.append(f"{path}{name}")
+        elif member.type_name == "structure" and isinstance(params[name], dict):
+            dropped += _drop_unsupported(member, params[name], f"{path}{name}.")
+    return dropped
+
+
+async def retrieve_and_generate(bedrock_agent_runtime, params: dict, timeout: float = None) -> dict:
+
+    timeout = KB_RETRIEVE_AND_GENERATE_TIMEOUT if timeout is None else timeout
+
+    drop_unsupported_parameters(bedrock_agent_runtime, "RetrieveAndGenerate", params)
+
+    response = await _call(timeout, bedrock_agent_runtime.retrieve_and_generate, **params)
+
+    return response
+
+
+def supports_retrieve_and_generate_stream(bedrock_agent_runtime) -> bool:
+    return KB_RETRIEVE_AND_GENERATE_STREAM and hasattr(bedrock_agent_runtime, "retrieve_and_generate_stream")
+
+
+async def retrieve_and_generate_stream(bedrock_agent_runtime, params: dict, timeout: float = None) -> dict:
+
+    # the timeout covers retrieval and the first byte; the event stream is then read with
+    # app_bedrock_async.iterate_stream(response["stream"]) and bounded by the client read timeout
+    timeout = KB_RETRIEVE_AND_GENERATE_TIMEOUT if timeout is None else timeout
+
+    drop_unsupported_parameters(bedrock_agent_runtime, "RetrieveAndGenerateStream", params)
+
+    response = await _call(timeout, bedrock_agent_runtime.retrieve_and_generate_stream, **params)
+
+    return response
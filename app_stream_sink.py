@@ -0,0 +1,99 @@
+import os
+import time
+import asyncio
+import chainlit as cl
+
+# Each msg.stream_token is one websocket frame. Deltas are merged and flushed every
+# STREAM_FLUSH_INTERVAL_MS or once STREAM_FLUSH_CHARS characters are pending.
+STREAM_FLUSH_INTERVAL_MS = float(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "40"))
+STREAM_FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", "512"))
+
+
+class BufferedMessageStream():
+
+    def __init__(self, msg : cl.Message, flush_interval_ms: float = None, flush_chars: int = None):
+        self.msg = msg
+        self.flush_interval = (STREAM_FLUSH_INTERVAL_MS if flush_interval_ms is None else flush_interval_ms) / 1000
+        self.flush_chars = STREAM_FLUSH_CHARS if flush_chars is None else flush_chars
+        self.frames = 0
+        self.completed = False
+        self.usage = None
+        self.first_emit_at = None
+        self._recorded = []
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.msg, name)
+
+    @property
+    def answer(self):
+        # the model text streamed so far, once the model reported a normal completion
+        return "".join(self._recorded) if self.completed else None
+
+    @property
+    def text(self) -> str:
+        # the model text streamed so far, complete or not
+        return "".join(self._recorded)
+
+    def mark_completed(self):
+        self.completed = True
+
+    async def annotate(self, text: str):
+        # out-of-band text (stats, diagnostics) that is shown but is not part of the answer
+        await self._append(text)
+
+    async def stream_token(self, token: str, is_sequence=False):
+
+        if is_sequence:
+            self._buffer = []
+            self._size = 0
+            self._recorded = [token]
+            async with self._lock:
+                await self._emit(token, is_sequence=True)
+            return
+
+        if not token:
+            return
+
+        self._recorded.append(token)
+        await self._append(token)
+
+    async def _append(self, token: str):
+
+        self._buffer.append(token)
+        self._size += len(token)
+
+        if self._size >= self.flush_chars or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+        elif self._timer is None:
+            # make sure a slow trickle of deltas still reaches the UI within the time budget
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._on_timer)
+
+    async def flush(self):
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            await self._emit(text)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def _emit(self, text: str, is_sequence=False):
+        if self.first_emit_at is None:
+            self.first_emit_at = time.perf_counter()
+        self.frames += 1
+        self._last_flush = time.monotonic()
+        await self.msg.stream_token(text, is_sequence=is_sequence)
@@ -0,0 +1,110 @@
+import threading
+import chainlit as cl
+import app_metrics
+import app_admission
+
+# Stop reasons (all providers) for an answer cut off by the token limit
+TRUNCATED_STOP_REASONS = {"max_tokens", "length", "LENGTH", "MAX_TOKENS"}
+
+
+class InvocationUsage():
+
+    def __init__(self, input_tokens: int = None, output_tokens: int = None, invocation_latency_ms: int = None, first_byte_latency_ms: int = None, stop_reason: str = None):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.invocation_latency_ms = invocation_latency_ms
+        self.first_byte_latency_ms = first_byte_latency_ms
+        self.stop_reason = stop_reason
+
+    @staticmethod
+    def from_invocation_metrics(invocation_metrics: dict, stop_reason: str = None):
+        # amazon-bedrock-invocationMetrics, sent in the last chunk of every stream whatever the stop reason
+        invocation_metrics = invocation_metrics or {}
+        return InvocationUsage(
+            input_tokens=invocation_metrics.get("inputTokenCount"),
+            output_tokens=invocation_metrics.get("outputTokenCount"),
+            invocation_latency_ms=invocation_metrics.get("invocationLatency"),
+            first_byte_latency_ms=invocation_metrics.get("firstByteLatency"),
+            stop_reason=stop_reason)
+
+    @staticmethod
+    def from_chunk(chunk: dict, stop_reason: str = None):
+        return InvocationUsage.from_invocation_metrics(chunk.get("amazon-bedrock-invocationMetrics"), stop_reason)
+
+    @staticmethod
+    def from_response_headers(response: dict, stop_reason: str = None):
+        # invoke_model (non streaming) reports the same numbers as HTTP headers
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        def header(name):
+            value = headers.get(f"x-amzn-bedrock-{name}")
+            return int(value) if value is not None else None
+        return InvocationUsage(
+            input_tokens=header("input-token-count"),
+            output_tokens=header("output-token-count"),
+            invocation_latency_ms=header("invocation-latency"),
+            stop_reason=stop_reason)
+
+    @property
+    def truncated(self) -> bool:
+        return self.stop_reason in TRUNCATED_STOP_REASONS
+
+    @property
+    def stats(self) -> str:
+        stats = f"token.in={self.input_tokens} token.out={self.output_tokens}"
+        if self.invocation_latency_ms is not None:
+            stats += f" latency={self.invocation_latency_ms}"
+        if self.first_byte_latency_ms is not None:
+            stats += f" lag={self.first_byte_latency_ms}"
+        return f"{stats} stop_reason={self.stop_reason}"
+
+
+class UsageLedger():
+
+    def __init__(self):
+        self.invocations = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.truncated = 0
+        # model id -> [invocations, input tokens, output tokens]
+        self.by_model = {}
+        self._lock = threading.Lock()
+
+    def add(self, bedrock_model_id: str, usage: InvocationUsage):
+        input_tokens = usage.input_tokens or 0
+        output_tokens = usage.output_tokens or 0
+        with self._lock:
+            self.invocations += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.truncated += 1 if usage.truncated else 0
+            model = self.by_model.setdefault(bedrock_model_id, [0, 0, 0])
+            model[0] += 1
+            model[1] += input_tokens
+            model[2] += output_tokens
+
+    @property
+    def stats(self) -> str:
+        return f"invocations={self.invocations} token.in={self.input_tokens} token.out={self.output_tokens} truncated={self.truncated}"
+
+
+process_usage = UsageLedger()
+
+
+def session_usage() -> UsageLedger:
+    usage = cl.user_session.get("usage")
+    if usage is None:
+        usage = UsageLedger()
+        cl.user_session.set("usage", usage)
+    return usage
+
+
+def record(labels: dict, usage: InvocationUsage) -> UsageLedger:
+    # one call per model invocation: session and process totals, Prometheus counters, the user's token budget
+    if usage is None:
+        return session_usage()
+    process_usage.add(labels["model"], usage)
+    session = session_usage()
+    session.add(labels["model"], usage)
+    app_metrics.record_usage(labels, usage)
+    app_admission.charge(usage)
+    return session
@@ -0,0 +1,93 @@
+# Chunk decoding throughput of each provider strategy's process_response_stream.
+#
+# Replays the recorded event streams from loadtest/fake_bedrock.py (provider_chunks, as bytes)
+# through every strategy into a no-op sink, once with the old json.loads(bytes.decode()) path
+# and once with app_bedrock_decode (orjson when installed). Reports chunks/s.
+#
+#   python benchmarks/bench_chunk_decode.py [tokens] [repeat]
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "loadtest"))
+
+import app_bedrock
+import app_bedrock_decode
+import fake_bedrock
+
+MODELS = [
+    "anthropic.claude-3-haiku-20240307-v1:0",
+    "anthropic.claude-v2",
+    "cohere.command-text-v14",
+    "amazon.titan-text-express-v1",
+    "meta.llama2-13b-chat-v1",
+    "mistral.mistral-7b-instruct-v0:2",
+]
+
+
+class NullSink():
+
+    usage = None
+
+    async def stream_token(self, token: str, is_sequence=False):
+        pass
+
+    async def annotate(self, text: str):
+        pass
+
+    async def flush(self):
+        pass
+
+    def mark_completed(self):
+        pass
+
+
+class RecordedStream():
+
+    # has __aiter__, so iterate_stream consumes it in the loop without the reader thread
+    def __init__(self, events: list):
+        self.events = events
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+
+
+def recorded_events(model_id: str, tokens: int) -> list:
+    texts = fake_bedrock.answer_tokens(tokens)
+    metrics = fake_bedrock.invocation_metrics(1000, len(texts), 1000, 100)
+    return [{"chunk": {"bytes": json.dumps(chunk).encode()}} for chunk in fake_bedrock.provider_chunks(model_id, texts, 1000, metrics)]
+
+
+async def run(model_id: str, events: list, repeat: int) -> float:
+    strategy = app_bedrock.BedrockModelStrategyFactory.create(model_id)
+    sink = NullSink()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await strategy.process_response_stream(RecordedStream(events), sink)
+    return len(events) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    fast_loads = app_bedrock_decode.loads
+    fast_label = "orjson" if app_bedrock_decode.orjson is not None else "json(bytes)"
+
+    for model_id in MODELS:
+        events = recorded_events(model_id, tokens)
+        app_bedrock_decode.loads = lambda data: json.loads(data.decode())
+        baseline = asyncio.run(run(model_id, events, repeat))
+        app_bedrock_decode.loads = fast_loads
+        fast = asyncio.run(run(model_id, events, repeat))
+        print(f"{model_id:42} json.loads(decode())={baseline:10.0f} chunks/s {fast_label}={fast:10.0f} chunks/s x{fast / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Near-duplicate removal cost per message (app_context_dedup): chunks seen for the first time are sketched,
+# chunks seen before (related questions, retrieve cache hits) reuse their sketch. Half the chunks are copies
+# of the other half with the last words dropped, as overlapping chunking produces. The chunks are passages of
+# English prose (the Python reference docs shipped with the interpreter) and random words from a synthetic
+# vocabulary.
+#
+#   python benchmarks/bench_context_dedup.py [chunks] [words] [repeat]
+
+import os
+import sys
+import json
+import time
+import random
+from pydoc_data.topics import topics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app_context_dedup
+
+
+PROSE = " ".join(topics.values()).split()
+VOCABULARY = [f"term{i}" for i in range(5000)]
+
+
+def prose(rng: random.Random, words: int) -> str:
+    start = rng.randrange(len(PROSE) - words)
+    return " ".join(PROSE[start:start + words])
+
+
+def synthetic(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def retrieval_results(passage, chunks: int, words: int) -> list:
+    rng = random.Random(0)
+    results = []
+    for i in range(chunks // 2):
+        text = passage(rng, words)
+        results.append({"content": {"text": text}, "score": 0.9 - i * 0.01})
+        results.append({"content": {"text": text.rsplit(" ", 3)[0]}, "score": 0.5 - i * 0.01})
+    return results
+
+
+def main():
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    words = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+
+    for label, passage in (("prose", prose), ("synthetic", synthetic)):
+        # fresh objects per message, as decoded from a Retrieve response
+        raw = json.dumps(retrieval_results(passage, chunks, words))
+
+        first_seen = []
+        seen_before = []
+        for _ in range(repeat):
+            app_context_dedup._sketches.clear()
+            results = json.loads(raw)
+            start = time.perf_counter()
+            kept, removed = app_context_dedup.deduplicate(results)
+            first_seen.append(time.perf_counter() - start)
+
+            results = json.loads(raw)
+            start = time.perf_counter()
+            app_context_dedup.deduplicate(results)
+            seen_before.append(time.perf_counter() - start)
+
+        first_seen.sort()
+        seen_before.sort()
+        print(f"{label:10} chunks={chunks} words={words} kept={len(kept)} removed={len(removed)} "
+              f"first seen p50={first_seen[repeat // 2] * 1000:.3f}ms seen before p50={seen_before[repeat // 2] * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
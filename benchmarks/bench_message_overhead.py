@@ -0,0 +1,84 @@
+# Per-message strategy/prompt/request overhead, before and after the compiled templates.
+#
+# "per-message" resolves the strategy and renders the prompt and request from the settings on every
+# message (the old path, still available as _create / render_prompt / _create_request_template);
+# "compiled" is what app_retrieve does now: registry lookup, splice into precompiled templates.
+#
+#   python benchmarks/bench_message_overhead.py [messages]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app_bedrock
+
+MODELS = [
+    "anthropic.claude-3-haiku-20240307-v1:0",
+    "anthropic.claude-v2",
+    "cohere.command-text-v14",
+    "amazon.titan-text-express-v1",
+    "mistral.mistral-7b-instruct-v0:2",
+    "ai21.j2-mid",
+]
+
+APPLICATION_OPTIONS = app_bedrock.FrozenSettings(
+    option_terse=False,
+    option_strict=True,
+    option_align_units_of_measure=True,
+    option_align_geographic_divisions=True,
+    option_state_conclusions_first=False,
+    option_source_table_markdown_display=True,
+)
+
+INFERENCE_PARAMETERS = app_bedrock.FrozenSettings(
+    temperature=0.0,
+    top_p=1.0,
+    top_k=250,
+    max_tokens_to_sample=1024,
+    stop_sequences=[],
+    system_message="You are a helpful assistant and tries to answer questions as best as you can.",
+)
+
+CONTEXT_INFO = "Section 12. The maximum capacity for product code AB-0012 is 974 units per site.\n" * 24
+QUERY = "What is the max capacity per site in Osaka?"
+
+
+def per_message(bedrock_model_id: str):
+    strategy = app_bedrock.BedrockModelStrategyFactory._create(bedrock_model_id)
+    prompt = strategy.render_prompt(APPLICATION_OPTIONS, CONTEXT_INFO, QUERY)
+    request = strategy._create_request_template(INFERENCE_PARAMETERS)
+    if strategy.prompt_field == "prompt" or strategy.prompt_field == "inputText":
+        request[strategy.prompt_field] = prompt
+    else:
+        request["messages"] = [{"role": "user", "content": prompt}]
+    return request
+
+
+def compiled(bedrock_model_id: str):
+    strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
+    prompt = strategy.create_prompt(APPLICATION_OPTIONS, CONTEXT_INFO, QUERY)
+    return strategy.create_request(INFERENCE_PARAMETERS, prompt)
+
+
+def timed(fn, bedrock_model_id: str, messages: int) -> float:
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn(bedrock_model_id)
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for bedrock_model_id in MODELS:
+        # what setup_agent does when the settings change
+        app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id).compile(APPLICATION_OPTIONS, INFERENCE_PARAMETERS)
+        before = timed(per_message, bedrock_model_id, messages)
+        after = timed(compiled, bedrock_model_id, messages)
+        print(f"{bedrock_model_id:42} per-message={before:6.2f}us compiled={after:6.2f}us x{before / after:.2f}")
+
+
+if __name__ == "__main__":
+    main()
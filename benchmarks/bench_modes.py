@@ -0,0 +1,48 @@
+# Retrieve vs RetrieveAndGenerate vs Generate on the local Bedrock stand-in, across retrieval depths.
+#
+# Runs loadtest/load_driver.py sessions in-process against loadtest/fake_bedrock.py (started here) for
+# every mode x document count, with first byte latency growing with the input size
+# (--prefill-ms-per-1k-tokens), and prints one row per combination.
+#
+#   python benchmarks/bench_modes.py --document-counts 3,8,16 --sessions 10 --messages 2 --search-type HYBRID
+
+import os
+import sys
+import copy
+import asyncio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "loadtest"))
+
+import load_driver
+
+MODES = ["Retrieve", "RetrieveAndGenerate", "Generate"]
+
+
+def main():
+    parser = load_driver.build_parser("Per-mode latency comparison on the local Bedrock stand-in")
+    parser.add_argument("--document-counts", default="3,8,16")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.set_defaults(endpoint="http://127.0.0.1:8797", sessions=10, messages=2, prefill_ms_per_1k_tokens=40, temperature=0.5)
+    args = parser.parse_args()
+
+    load_driver.configure_environment(args)
+    load_driver.start_server(args)
+
+    print(f"{'mode':20} {'docs':>4} {'ttft p50':>9} {'ttft p95':>9} {'total p50':>10} {'total p95':>10} {'errors':>6}")
+    for mode in args.modes.split(","):
+        # Generate does not retrieve, one row is enough
+        document_counts = [args.document_count] if mode == "Generate" else [int(count) for count in args.document_counts.split(",")]
+        for document_count in document_counts:
+            run_args = copy.copy(args)
+            run_args.mode = mode
+            run_args.document_count = document_count
+            summary = asyncio.run(load_driver.run(run_args))
+            ttft, total = summary["ttft"], summary["total"]
+            print(f"{mode:20} {document_count if mode != 'Generate' else '-':>4} {load_driver.percentile(ttft, 50):9.1f} {load_driver.percentile(ttft, 95):9.1f} "
+                f"{load_driver.percentile(total, 50):10.1f} {load_driver.percentile(total, 95):10.1f} {len(summary['errors']):6}")
+
+
+if __name__ == "__main__":
+    main()
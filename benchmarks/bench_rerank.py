@@ -0,0 +1,56 @@
+# Local reranking cost per message: BM25 (+ the cross-encoder when RERANK_CROSS_ENCODER_PATH is set)
+# over an over-fetched result set from loadtest/fake_bedrock.py, keeping the top N.
+#
+#   python benchmarks/bench_rerank.py [fetched] [kept] [repeat]
+#   RERANK_CROSS_ENCODER_PATH=models/ms-marco-MiniLM-L-6-v2 python benchmarks/bench_rerank.py 24 8
+
+import os
+import sys
+import time
+import random
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "loadtest"))
+
+import app_rerank
+import app_context_budget
+import fake_bedrock
+
+QUERY = "What is the maximum capacity of product AB-0012 per site?"
+
+
+def retrieval_results(fetched: int) -> list:
+    rng = random.Random(0)
+    results = []
+    for i in range(fetched):
+        n = rng.randrange(1, 60)
+        results.append({
+            "content": {"text": fake_bedrock.PASSAGE.format(n=n, cap=rng.randrange(100, 2000)) * 6},
+            "location": {"type": "S3", "s3Location": {"uri": f"s3://fake-bucket/doc-{n}.pdf"}},
+            "score": round(0.9 - i * 0.02, 4),
+        })
+    return results
+
+
+def main():
+    fetched = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    kept = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    results = retrieval_results(fetched)
+    app_rerank.rerank(QUERY, results, kept)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        reranked = app_rerank.rerank(QUERY, results, kept)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tokens_fetched = sum(app_context_budget.estimate_tokens(result["content"]["text"]) for result in results)
+    tokens_kept = sum(app_context_budget.estimate_tokens(result["content"]["text"]) for result in reranked)
+    print(f"rerank={app_rerank.describe()} fetched={fetched} kept={kept} {elapsed * 1000:.2f}ms/message context.tokens {tokens_fetched} -> {tokens_kept}")
+    print("top: " + " ".join(result["location"]["s3Location"]["uri"].rsplit("/", 1)[-1] for result in reranked[0:5]))
+
+
+if __name__ == "__main__":
+    main()
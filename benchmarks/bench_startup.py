@@ -0,0 +1,59 @@
+# Worker boot-time measurement for Bedrock client creation.
+#
+# "eager" creates the nine default clients the app modules used to build at import time;
+# "registry" imports the app modules (clients are now created lazily) and then times the
+# first get_client per service, which is what the first request pays once per process.
+#
+#   python benchmarks/bench_startup.py [runs]
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# chainlit and boto3 are imported before the clock starts in both cases
+EAGER = """
+import time
+import boto3, chainlit
+start = time.perf_counter()
+for service in ["bedrock", "bedrock-runtime", "bedrock-agent", "bedrock-agent-runtime",
+                "bedrock-runtime", "bedrock-agent-runtime", "bedrock-runtime", "bedrock-agent-runtime", "bedrock-agent"]:
+    boto3.client(service, region_name="us-east-1")
+print(time.perf_counter() - start)
+"""
+
+REGISTRY = """
+import sys, time
+sys.path.insert(0, %r)
+import boto3, chainlit
+start = time.perf_counter()
+import app_retrieve, app_generate, app_retrieve_generate, app_bedrock_lib
+import app_bedrock_clients
+boot = time.perf_counter() - start
+start = time.perf_counter()
+for service in ["bedrock-runtime", "bedrock-agent", "bedrock-agent-runtime"]:
+    app_bedrock_clients.get_client(service)
+print(boot, time.perf_counter() - start)
+""" % ROOT
+
+
+def run(code: str) -> list:
+    env = dict(os.environ, AWS_REGION=os.environ.get("AWS_REGION", "us-east-1"))
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    return [float(value) for value in out.split()]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    eager = sorted(run(EAGER)[0] for _ in range(runs))
+    registry = sorted(run(REGISTRY) for _ in range(runs))
+
+    print(f"eager clients at import:      {eager[runs // 2] * 1000:8.1f}ms (median of {runs})")
+    print(f"app module import (registry): {registry[runs // 2][0] * 1000:8.1f}ms")
+    print(f"first get_client x3:          {registry[runs // 2][1] * 1000:8.1f}ms (paid on first request)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Concurrency benchmark for the non-blocking Bedrock streaming path.
+#
+# Runs N sessions against a stubbed bedrock-runtime whose EventStream sleeps (blocking, like
+# botocore does on the socket) between chunks. With the streaming path off the event loop,
+# N sessions should finish in roughly the time of one.
+#
+#   python benchmarks/bench_stream_concurrency.py [sessions] [chunks] [chunk_delay_ms]
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app_bedrock
+
+
+class StubMessage():
+
+    def __init__(self):
+        self.content = ""
+
+    async def stream_token(self, token: str, is_sequence=False):
+        self.content += token
+
+
+class StubBedrockRuntime():
+
+    def __init__(self, chunks: int, chunk_delay: float):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+
+    def _events(self):
+        yield {"chunk": {"bytes": json.dumps({"type": "message_start", "message": {"usage": {"input_tokens": 10}}}).encode()}}
+        for i in range(self.chunks):
+            time.sleep(self.chunk_delay)
+            yield {"chunk": {"bytes": json.dumps({"type": "content_block_delta", "delta": {"type": "text_delta", "text": f"token{i} "}}).encode()}}
+        metrics = {"inputTokenCount": 10, "outputTokenCount": self.chunks, "invocationLatency": 0, "firstByteLatency": 0}
+        yield {"chunk": {"bytes": json.dumps({"type": "message_stop", "amazon-bedrock-invocationMetrics": metrics}).encode()}}
+
+    def invoke_model_with_response_stream(self, modelId: str, body: str):
+        time.sleep(self.chunk_delay)
+        return {"body": self._events()}
+
+
+async def run_session(bedrock_runtime, bedrock_model_id: str):
+    strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
+    request = strategy.create_request({"max_tokens_to_sample": 256}, "hello")
+    msg = StubMessage()
+    response = await strategy.send_request_async(request, bedrock_runtime, bedrock_model_id)
+    await strategy.process_response(response, msg)
+    return msg
+
+
+async def run(sessions: int, bedrock_runtime, bedrock_model_id: str) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*[run_session(bedrock_runtime, bedrock_model_id) for _ in range(sessions)])
+    return time.perf_counter() - start
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    chunk_delay = (float(sys.argv[3]) if len(sys.argv) > 3 else 10) / 1000
+
+    bedrock_runtime = StubBedrockRuntime(chunks, chunk_delay)
+    bedrock_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+
+    single = asyncio.run(run(1, bedrock_runtime, bedrock_model_id))
+    concurrent = asyncio.run(run(sessions, bedrock_runtime, bedrock_model_id))
+
+    print(f"chunks={chunks} chunk_delay={chunk_delay * 1000:.0f}ms")
+    print(f"1 session: {single:.3f}s")
+    print(f"{sessions} sessions: {concurrent:.3f}s ({concurrent / single:.2f}x single, serial would be {sessions}x)")
+
+
+if __name__ == "__main__":
+    main()
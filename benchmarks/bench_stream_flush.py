@@ -0,0 +1,128 @@
+# Frames-per-answer and CPU benchmark for the buffered msg.stream_token sink.
+#
+# Replays a Claude 3 content_block_delta stream (a few characters per delta) into real cl.Message
+# objects whose emitter is a python-socketio server (served by uvicorn on localhost), once unbuffered
+# and once through BufferedMessageStream. Every frame pays what it pays in the app: Chainlit's
+# emitter, socket.io/engine.io packet encoding and a websocket write. The websocket clients run in a
+# child process so the CPU reported is the server's alone.
+#
+#   python benchmarks/bench_stream_flush.py [sessions] [deltas] [delta_interval_ms]
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import socketio
+import uvicorn
+import chainlit as cl
+from chainlit.context import init_ws_context
+from chainlit.session import WebsocketSession
+import app_bedrock
+
+# sessions clients connect, count the stream_token frames, and print the count when stdin closes
+CLIENTS = """
+import sys, asyncio, socketio
+frames = 0
+async def main(url, sessions):
+    global frames
+    clients = []
+    for _ in range(sessions):
+        client = socketio.AsyncClient()
+        @client.on("stream_token")
+        async def on_token(data):
+            global frames
+            frames += 1
+        await client.connect(url, transports=["websocket"])
+        clients.append(client)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    print(frames, flush=True)
+    for client in clients:
+        await client.disconnect()
+asyncio.run(main(sys.argv[1], int(sys.argv[2])))
+"""
+
+
+def events(deltas: int, delta_interval: float):
+    yield {"chunk": {"bytes": json.dumps({"type": "message_start", "message": {"usage": {"input_tokens": 10}}}).encode()}}
+    for i in range(deltas):
+        if delta_interval:
+            time.sleep(delta_interval)
+        yield {"chunk": {"bytes": json.dumps({"type": "content_block_delta", "delta": {"type": "text_delta", "text": f" tok{i % 10}"}}).encode()}}
+    metrics = {"inputTokenCount": 10, "outputTokenCount": deltas, "invocationLatency": 0, "firstByteLatency": 0}
+    yield {"chunk": {"bytes": json.dumps({"type": "message_stop", "amazon-bedrock-invocationMetrics": metrics}).encode()}}
+
+
+def websocket_session(sio: socketio.AsyncServer, sid: str) -> WebsocketSession:
+    # the emit chainlit.socket gives a connected session
+    def emit(event, data):
+        return sio.emit(event, data, to=sid)
+    return WebsocketSession(id=str(uuid.uuid4()), socket_id=sid, emit=emit, ask_user=None, user_env={})
+
+
+async def run_session(session: WebsocketSession, buffered: bool, deltas: int, delta_interval: float) -> int:
+    init_ws_context(session)
+    strategy = app_bedrock.AnthropicClaude3MsgBedrockModelAsyncStrategy()
+    msg = cl.Message(content="")
+    response = {"body": events(deltas, delta_interval)}
+    if buffered:
+        await strategy.process_response(response, msg)
+    else:
+        sink = app_bedrock.app_stream_sink.BufferedMessageStream(msg, flush_interval_ms=0, flush_chars=0)
+        await strategy.process_response_stream(response["body"], sink)
+    return len(msg.content)
+
+
+async def run(buffered: bool, sessions: int, deltas: int, delta_interval: float):
+
+    sio = socketio.AsyncServer(async_mode="asgi")
+    sids = []
+    connected = asyncio.Event()
+
+    @sio.on("connect")
+    async def on_connect(sid, environ):
+        sids.append(sid)
+        if len(sids) == sessions:
+            connected.set()
+
+    server = uvicorn.Server(uvicorn.Config(socketio.ASGIApp(sio), host="127.0.0.1", port=0, log_level="error", lifespan="off"))
+    serve = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    clients = subprocess.Popen([sys.executable, "-c", CLIENTS, f"http://127.0.0.1:{port}", str(sessions)],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    await asyncio.wait_for(connected.wait(), 30)
+
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    await asyncio.gather(*[run_session(websocket_session(sio, sid), buffered, deltas, delta_interval) for sid in sids])
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    # let the writers drain before the clients report what they received
+    await asyncio.sleep(0.5)
+    frames, _ = await asyncio.get_running_loop().run_in_executor(None, clients.communicate, "")
+    server.should_exit = True
+    await serve
+    # stream_start and every stream_token, as received by the browser side
+    return int(frames) / sessions, cpu, wall
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    deltas = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    delta_interval = (float(sys.argv[3]) if len(sys.argv) > 3 else 1) / 1000
+
+    for label, buffered in (("per-delta", False), ("buffered", True)):
+        frames, cpu, wall = asyncio.run(run(buffered, sessions, deltas, delta_interval))
+        print(f"{label:10} frames/answer={frames:8.1f} cpu={cpu:.3f}s cpu/answer={cpu / sessions * 1000:.1f}ms wall={wall:.3f}s sessions={sessions} deltas={deltas}")
+
+
+if __name__ == "__main__":
+    main()
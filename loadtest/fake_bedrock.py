@@ -0,0 +1,471 @@
+# Local stand-in for bedrock-runtime, bedrock-agent and bedrock-agent-runtime.
+#
+# Speaks enough of the AWS REST/JSON and event-stream wire formats for boto3 clients pointed at it
+# with endpoint_url (BEDROCK_ENDPOINT_URL=http://127.0.0.1:8787) to run every mode of the app:
+#
+#   POST /model/{modelId}/invoke-with-response-stream   provider chunk formats parsed by app_bedrock
+#   POST /model/{modelId}/invoke                        AI21 and Claude 3 non-streaming bodies
+#   POST /knowledgebases/                               ListKnowledgeBases (paginated)
+#   POST /knowledgebases/{knowledgeBaseId}/retrieve     Retrieve
+#   POST /retrieveAndGenerate                           RetrieveAndGenerate
+#   POST /retrieveAndGenerateStream                     RetrieveAndGenerateStream (output/citation events)
+#
+#   python loadtest/fake_bedrock.py --port 8787 --tokens-per-second 60 --first-byte-ms 400 --throttle-rate 0.05
+#
+# --model-concurrency throttles invocations beyond N in flight per (model, region); the region is the one
+# the client signed for, so cross-region fallback clients land in separate buckets.
+
+import re
+import json
+import time
+import uuid
+import zlib
+import base64
+import struct
+import random
+import asyncio
+import argparse
+import datetime
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+ANSWER = ("Based on the provided context, the maximum capacity is 1,200 units per site. "
+    "Each site is reviewed quarterly and the limit applies to every prefecture listed in the source table. "
+    "Requests above the limit need written approval from the regional office before the order is placed.")
+
+PASSAGE = ("Section {n}. The maximum capacity for product code AB-{n:04d} is {cap} units per site. "
+    "Capacity is reviewed quarterly by the regional office. Sites in the listed prefectures follow the same limit. "
+    "Orders above the limit require written approval. ")
+
+
+class FakeBedrockConfig():
+
+    def __init__(self, tokens_per_second: float = 60, first_byte_ms: float = 400, tokens_per_chunk: int = 1,
+                 output_tokens: int = 0, throttle_rate: float = 0.0, error_rate: float = 0.0, stream_error_rate: float = 0.0,
+                 retrieve_ms: float = 300, knowledge_bases: int = 3, passage_repeat: int = 6, prefill_ms_per_1k_tokens: float = 0,
+                 model_concurrency: int = 0, throttle_in_stream: bool = False, region_first_byte_ms: dict = None,
+                 slow_first_byte_rate: float = 0.0, slow_first_byte_ms: float = 5000, seed: int = None):
+        self.tokens_per_second = tokens_per_second
+        self.first_byte_ms = first_byte_ms
+        self.tokens_per_chunk = tokens_per_chunk
+        # 0 uses the canned answer as is
+        self.output_tokens = output_tokens
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.retrieve_ms = retrieve_ms
+        self.knowledge_bases = knowledge_bases
+        self.passage_repeat = passage_repeat
+        # added to the first byte time per 1000 input tokens, so larger contexts answer later
+        self.prefill_ms_per_1k_tokens = prefill_ms_per_1k_tokens
+        # 0 is unlimited
+        self.model_concurrency = model_concurrency
+        # streaming throttles as a throttlingException first event instead of HTTP 429
+        self.throttle_in_stream = throttle_in_stream
+        # region -> first byte ms, overrides first_byte_ms for that region
+        self.region_first_byte_ms = region_first_byte_ms or {}
+        # tail latency: this fraction of invocations waits slow_first_byte_ms for the first byte instead
+        self.slow_first_byte_rate = slow_first_byte_rate
+        self.slow_first_byte_ms = slow_first_byte_ms
+        self.random = random.Random(seed)
+
+
+def answer_tokens(output_tokens: int = 0) -> list:
+    words = ANSWER.split(" ")
+    if output_tokens:
+        words = (words * (output_tokens // len(words) + 1))[0:output_tokens]
+    return [word + " " for word in words]
+
+
+def invocation_metrics(input_tokens: int, output_tokens: int, latency_ms: int, first_byte_ms: int) -> dict:
+    return {
+        "inputTokenCount": input_tokens,
+        "outputTokenCount": output_tokens,
+        "invocationLatency": latency_ms,
+        "firstByteLatency": first_byte_ms,
+    }
+
+
+def provider_chunks(model_id: str, texts: list, input_tokens: int, metrics: dict) -> list:
+    # The chunk bodies each provider streams, in the shapes the strategies in app_bedrock.py parse
+    output_tokens = len(texts)
+    chunks = []
+
+    if model_id.startswith("anthropic.claude-3"):
+        chunks.append({"type": "message_start", "message": {"id": "msg_fake", "type": "message", "role": "assistant", "model": model_id,
+            "content": [], "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": input_tokens, "output_tokens": 1}}})
+        chunks.append({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for text in texts:
+            chunks.append({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}})
+        chunks.append({"type": "content_block_stop", "index": 0})
+        chunks.append({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": output_tokens}})
+        chunks.append({"type": "message_stop", "amazon-bedrock-invocationMetrics": metrics})
+    elif model_id.startswith("anthropic."):
+        for text in texts:
+            chunks.append({"completion": text, "stop_reason": None, "stop": None})
+        chunks.append({"completion": "", "stop_reason": "stop_sequence", "stop": "\n\nHuman:", "amazon-bedrock-invocationMetrics": metrics})
+    elif model_id.startswith("cohere."):
+        for i, text in enumerate(texts):
+            chunks.append({"index": 0, "text": text, "is_finished": False})
+        chunks.append({"is_finished": True, "finish_reason": "COMPLETE",
+            "response": {"id": "fake", "generations": [{"text": "".join(texts), "finish_reason": "COMPLETE"}]}, "amazon-bedrock-invocationMetrics": metrics})
+    elif model_id.startswith("amazon."):
+        for i, text in enumerate(texts):
+            last = i == len(texts) - 1
+            chunk = {"outputText": text, "index": 0, "totalOutputTextTokenCount": i + 1, "completionReason": "FINISH" if last else None,
+                "inputTextTokenCount": input_tokens}
+            if last:
+                chunk["amazon-bedrock-invocationMetrics"] = metrics
+            chunks.append(chunk)
+    elif model_id.startswith("mistral."):
+        for text in texts:
+            chunks.append({"outputs": [{"text": text, "stop_reason": None}]})
+        chunks.append({"outputs": [{"text": "", "stop_reason": "stop"}], "amazon-bedrock-invocationMetrics": metrics})
+    elif model_id.startswith("meta."):
+        for i, text in enumerate(texts):
+            chunks.append({"generation": text, "prompt_token_count": input_tokens if i == 0 else None, "generation_token_count": i + 1, "stop_reason": None})
+        chunks.append({"generation": "", "prompt_token_count": None, "generation_token_count": output_tokens, "stop_reason": "stop",
+            "amazon-bedrock-invocationMetrics": metrics})
+    else:
+        raise ValueError(f"No stream format for {model_id}")
+
+    return chunks
+
+
+def invoke_body(model_id: str, text: str, input_tokens: int, output_tokens: int) -> dict:
+    if model_id.startswith("ai21."):
+        return {"id": 1234, "prompt": {"text": "", "tokens": []},
+            "completions": [{"data": {"text": text, "tokens": []}, "finishReason": {"reason": "endoftext"}}]}
+    if model_id.startswith("anthropic.claude-3"):
+        return {"id": "msg_fake", "type": "message", "role": "assistant", "model": model_id, "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn", "stop_sequence": None, "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}}
+    raise ValueError(f"No invoke format for {model_id}")
+
+
+def _header(name: str, value: str) -> bytes:
+    name = name.encode()
+    value = value.encode()
+    return struct.pack("!B", len(name)) + name + struct.pack("!BH", 7, len(value)) + value
+
+
+def event_message(headers: dict, payload: bytes) -> bytes:
+    # application/vnd.amazon.eventstream framing
+    encoded_headers = b"".join(_header(name, value) for name, value in headers.items())
+    total_length = 12 + len(encoded_headers) + len(payload) + 4
+    prelude = struct.pack("!II", total_length, len(encoded_headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + encoded_headers + payload
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def chunk_event(chunk: dict) -> bytes:
+    payload = json.dumps({"bytes": base64.b64encode(json.dumps(chunk).encode()).decode()}).encode()
+    return event_message({":event-type": "chunk", ":content-type": "application/json", ":message-type": "event"}, payload)
+
+
+def typed_event(event_type: str, member: dict) -> bytes:
+    return event_message({":event-type": event_type, ":content-type": "application/json", ":message-type": "event"}, json.dumps(member).encode())
+
+
+def exception_event(exception_type: str, message: str) -> bytes:
+    payload = json.dumps({"message": message}).encode()
+    return event_message({":exception-type": exception_type, ":content-type": "application/json", ":message-type": "exception"}, payload)
+
+
+def error_response(status_code: int, error_type: str, message: str) -> Response:
+    return JSONResponse({"message": message}, status_code=status_code, headers={"x-amzn-ErrorType": error_type})
+
+
+def document_metadata(n: int) -> dict:
+    return {"product_code": f"AB-{n:04d}", "section": n}
+
+
+def matches_filter(metadata_filter: dict, metadata: dict) -> bool:
+    # the RetrievalFilter operators the app sends; others match everything
+    (operator, operand), = metadata_filter.items()
+    if operator == "andAll":
+        return all(matches_filter(condition, metadata) for condition in operand)
+    if operator == "orAll":
+        return any(matches_filter(condition, metadata) for condition in operand)
+    value = metadata.get(operand["key"])
+    if operator == "equals":
+        return value == operand["value"]
+    if operator == "notEquals":
+        return value != operand["value"]
+    if operator == "in":
+        return value in operand["value"]
+    if operator == "notIn":
+        return value not in operand["value"]
+    if operator == "startsWith":
+        return isinstance(value, str) and value.startswith(operand["value"])
+    return True
+
+
+def estimate_input_tokens(body: bytes) -> int:
+    return max(1, len(body) // 4)
+
+
+def create_app(config: FakeBedrockConfig) -> Starlette:
+
+    def prefill_seconds(input_tokens: int) -> float:
+        return config.prefill_ms_per_1k_tokens * input_tokens / 1000 / 1000
+
+    def reference_tokens(references: list) -> int:
+        return sum(len(reference["content"]["text"]) // 4 for reference in references)
+
+    in_flight = {}
+
+    def request_region(request) -> str:
+        # SigV4 credential scope: Credential=<key>/<date>/<region>/<service>/aws4_request
+        match = re.search(r"Credential=[^/]+/[^/]+/([^/]+)/", request.headers.get("authorization", ""))
+        return match.group(1) if match else "unknown"
+
+    def acquire(model_id: str, region: str) -> bool:
+        key = (model_id, region)
+        if config.model_concurrency and in_flight.get(key, 0) >= config.model_concurrency:
+            return False
+        in_flight[key] = in_flight.get(key, 0) + 1
+        return True
+
+    def release(model_id: str, region: str):
+        in_flight[(model_id, region)] -= 1
+
+    def first_byte_seconds(region: str) -> float:
+        if config.slow_first_byte_rate and config.random.random() < config.slow_first_byte_rate:
+            return config.slow_first_byte_ms / 1000
+        return config.region_first_byte_ms.get(region, config.first_byte_ms) / 1000
+
+    def throttled_response(stream: bool) -> Response:
+        if stream and config.throttle_in_stream:
+            async def events():
+                yield exception_event("throttlingException", "Too many requests, please wait before trying again.")
+            return StreamingResponse(events(), media_type="application/vnd.amazon.eventstream")
+        return error_response(429, "ThrottlingException", "Too many requests, please wait before trying again.")
+
+    def request_error():
+        roll = config.random.random()
+        if roll < config.throttle_rate:
+            return error_response(429, "ThrottlingException", "Too many requests, please wait before trying again.")
+        if roll < config.throttle_rate + config.error_rate:
+            return error_response(500, "InternalServerException", "Fake internal server error.")
+        return None
+
+    async def invoke_with_response_stream(request):
+        model_id = request.path_params["modelId"]
+        region = request_region(request)
+        body = await request.body()
+        error = request_error()
+        if error is not None:
+            return error
+        if not acquire(model_id, region):
+            return throttled_response(True)
+
+        start = time.monotonic()
+        texts = answer_tokens(config.output_tokens)
+        texts = ["".join(texts[i:i + config.tokens_per_chunk]) for i in range(0, len(texts), config.tokens_per_chunk)]
+        input_tokens = estimate_input_tokens(body)
+        fail_at = config.random.randrange(len(texts)) if config.random.random() < config.stream_error_rate else None
+        token_interval = config.tokens_per_chunk / config.tokens_per_second if config.tokens_per_second else 0
+        try:
+            provider_chunks(model_id, [], 0, {})
+        except ValueError as e:
+            release(model_id, region)
+            return error_response(400, "ValidationException", str(e))
+
+        async def events():
+            try:
+                async for event in model_events():
+                    yield event
+            finally:
+                release(model_id, region)
+
+        async def model_events():
+            await asyncio.sleep(prefill_seconds(input_tokens) + first_byte_seconds(region))
+            first_byte_ms = int((time.monotonic() - start) * 1000)
+            latency_ms = first_byte_ms + int(token_interval * len(texts) * 1000)
+            metrics = invocation_metrics(input_tokens, len(answer_tokens(config.output_tokens)), latency_ms, first_byte_ms)
+            chunks = provider_chunks(model_id, texts, input_tokens, metrics)
+            text_index = 0
+            for chunk in chunks:
+                is_text = any(key in chunk for key in ("completion", "text", "outputText", "outputs", "generation")) or chunk.get("type") == "content_block_delta"
+                if is_text and text_index > 0:
+                    await asyncio.sleep(token_interval)
+                if is_text:
+                    if fail_at is not None and text_index == fail_at:
+                        yield exception_event("modelStreamErrorException", "Fake model stream error.")
+                        return
+                    text_index += 1
+                yield chunk_event(chunk)
+
+        return StreamingResponse(events(), media_type="application/vnd.amazon.eventstream",
+            headers={"x-amzn-bedrock-content-type": "application/json", "x-amzn-RequestId": str(uuid.uuid4())})
+
+    async def invoke(request):
+        model_id = request.path_params["modelId"]
+        region = request_region(request)
+        body = await request.body()
+        error = request_error()
+        if error is not None:
+            return error
+        if not acquire(model_id, region):
+            return throttled_response(False)
+        texts = answer_tokens(config.output_tokens)
+        token_interval = 1 / config.tokens_per_second if config.tokens_per_second else 0
+        try:
+            await asyncio.sleep(prefill_seconds(estimate_input_tokens(body)) + first_byte_seconds(region) + token_interval * len(texts))
+        finally:
+            release(model_id, region)
+        try:
+            response_body = invoke_body(model_id, "".join(texts), estimate_input_tokens(body), len(texts))
+        except ValueError as e:
+            return error_response(400, "ValidationException", str(e))
+        return JSONResponse(response_body, headers={"X-Amzn-Bedrock-Content-Type": "application/json"})
+
+    def knowledge_base_summaries() -> list:
+        updated_at = datetime.datetime(2024, 4, 1, tzinfo=datetime.timezone.utc).isoformat()
+        return [{"knowledgeBaseId": f"FAKEKB{i:04d}", "name": f"fake-kb-{i}", "description": "Local stand-in", "status": "ACTIVE", "updatedAt": updated_at}
+            for i in range(config.knowledge_bases)]
+
+    async def list_knowledge_bases(request):
+        params = json.loads(await request.body() or b"{}")
+        summaries = knowledge_base_summaries()
+        start = int(params.get("nextToken") or 0)
+        end = start + int(params.get("maxResults") or 10)
+        response = {"knowledgeBaseSummaries": summaries[start:end]}
+        if end < len(summaries):
+            response["nextToken"] = str(end)
+        return JSONResponse(response)
+
+    def retrieval_results(knowledge_base_id: str, query: str, number_of_results: int, metadata_filter: dict = None) -> list:
+        # deterministic per (kb, query) so caches and dedup see realistic repeats
+        rng = random.Random(f"{knowledge_base_id}:{query}")
+        results = []
+        # a filter narrows the candidates to the matching documents, one per product code
+        candidates = [n for n in range(1, 60) if matches_filter(metadata_filter, document_metadata(n))] if metadata_filter else None
+        for i in range(number_of_results if candidates is None else min(number_of_results, len(candidates))):
+            n = rng.randrange(1, 60) if candidates is None else candidates[i]
+            text = PASSAGE.format(n=n, cap=rng.randrange(100, 2000)) * config.passage_repeat
+            results.append({
+                "content": {"text": text},
+                "location": {"type": "S3", "s3Location": {"uri": f"s3://fake-bucket/{knowledge_base_id}/doc-{n}.pdf"}},
+                "metadata": document_metadata(n),
+                "score": round(0.9 - i * 0.02 - rng.random() * 0.01, 4),
+            })
+        return results
+
+    async def retrieve(request):
+        knowledge_base_id = request.path_params["knowledgeBaseId"]
+        params = json.loads(await request.body())
+        error = request_error()
+        if error is not None:
+            return error
+        await asyncio.sleep(config.retrieve_ms / 1000)
+        vector_search_configuration = params.get("retrievalConfiguration", {}).get("vectorSearchConfiguration", {})
+        number_of_results = vector_search_configuration.get("numberOfResults", 5)
+        return JSONResponse({"retrievalResults": retrieval_results(knowledge_base_id, params["retrievalQuery"]["text"], number_of_results, vector_search_configuration.get("filter"))})
+
+    def retrieve_and_generate_references(params: dict) -> list:
+        configuration = params["retrieveAndGenerateConfiguration"]["knowledgeBaseConfiguration"]
+        vector_search_configuration = configuration.get("retrievalConfiguration", {}).get("vectorSearchConfiguration", {})
+        number_of_results = vector_search_configuration.get("numberOfResults", 5)
+        references = retrieval_results(configuration["knowledgeBaseId"], params["input"]["text"], number_of_results, vector_search_configuration.get("filter"))
+        return [{"content": reference["content"], "location": reference["location"]} for reference in references]
+
+    async def retrieve_and_generate(request):
+        params = json.loads(await request.body())
+        error = request_error()
+        if error is not None:
+            return error
+        references = retrieve_and_generate_references(params)
+        texts = answer_tokens(config.output_tokens)
+        token_interval = 1 / config.tokens_per_second if config.tokens_per_second else 0
+        await asyncio.sleep(prefill_seconds(reference_tokens(references)) + (config.retrieve_ms + config.first_byte_ms) / 1000 + token_interval * len(texts))
+        text = "".join(texts)
+        return JSONResponse({
+            "sessionId": params.get("sessionId") or str(uuid.uuid4()),
+            "output": {"text": text},
+            "citations": [{
+                "generatedResponsePart": {"textResponsePart": {"text": text, "span": {"start": 0, "end": len(text) - 1}}},
+                "retrievedReferences": references,
+            }],
+        })
+
+    async def retrieve_and_generate_stream(request):
+        params = json.loads(await request.body())
+        error = request_error()
+        if error is not None:
+            return error
+        references = retrieve_and_generate_references(params)
+        texts = answer_tokens(config.output_tokens)
+        token_interval = 1 / config.tokens_per_second if config.tokens_per_second else 0
+
+        async def events():
+            await asyncio.sleep(prefill_seconds(reference_tokens(references)) + (config.retrieve_ms + config.first_byte_ms) / 1000)
+            # one citation per sentence, after the sentence it supports
+            sentence = ""
+            for i, text in enumerate(texts):
+                if i > 0:
+                    await asyncio.sleep(token_interval)
+                yield typed_event("output", {"text": text})
+                sentence += text
+                if text.rstrip().endswith(".") or i == len(texts) - 1:
+                    part = {"textResponsePart": {"text": sentence, "span": {"start": 0, "end": len(sentence) - 1}}}
+                    yield typed_event("citation", {"generatedResponsePart": part, "retrievedReferences": references[0:2]})
+                    references[0:2] = []
+                    sentence = ""
+
+        return StreamingResponse(events(), media_type="application/vnd.amazon.eventstream",
+            headers={"x-amzn-bedrock-knowledge-base-session-id": params.get("sessionId") or str(uuid.uuid4())})
+
+    return Starlette(routes=[
+        Route("/model/{modelId:path}/invoke-with-response-stream", invoke_with_response_stream, methods=["POST"]),
+        Route("/model/{modelId:path}/invoke", invoke, methods=["POST"]),
+        Route("/knowledgebases/", list_knowledge_bases, methods=["POST"]),
+        Route("/knowledgebases/{knowledgeBaseId}/retrieve", retrieve, methods=["POST"]),
+        Route("/retrieveAndGenerate", retrieve_and_generate, methods=["POST"]),
+        Route("/retrieveAndGenerateStream", retrieve_and_generate_stream, methods=["POST"]),
+    ])
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    parser.add_argument("--first-byte-ms", type=float, default=400)
+    parser.add_argument("--tokens-per-chunk", type=int, default=1)
+    parser.add_argument("--output-tokens", type=int, default=0, help="0 streams the canned answer")
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    parser.add_argument("--retrieve-ms", type=float, default=300)
+    parser.add_argument("--knowledge-bases", type=int, default=3)
+    parser.add_argument("--passage-repeat", type=int, default=6, help="size of each retrieved chunk, in passages")
+    parser.add_argument("--prefill-ms-per-1k-tokens", type=float, default=0, help="extra first byte latency per 1000 input tokens")
+    parser.add_argument("--model-concurrency", type=int, default=0, help="invocations in flight per (model, region) before throttling, 0 is unlimited")
+    parser.add_argument("--throttle-in-stream", action="store_true", help="throttle streaming invocations with a throttlingException event")
+    parser.add_argument("--region-first-byte-ms", nargs="*", default=[], metavar="REGION=MS", help="slower (or faster) regions")
+    parser.add_argument("--slow-first-byte-rate", type=float, default=0.0, help="fraction of invocations with a slow first byte")
+    parser.add_argument("--slow-first-byte-ms", type=float, default=5000)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_arguments(args) -> FakeBedrockConfig:
+    return FakeBedrockConfig(tokens_per_second=args.tokens_per_second, first_byte_ms=args.first_byte_ms, tokens_per_chunk=args.tokens_per_chunk,
+        output_tokens=args.output_tokens, throttle_rate=args.throttle_rate, error_rate=args.error_rate, stream_error_rate=args.stream_error_rate,
+        retrieve_ms=args.retrieve_ms, knowledge_bases=args.knowledge_bases, passage_repeat=args.passage_repeat,
+        prefill_ms_per_1k_tokens=args.prefill_ms_per_1k_tokens, model_concurrency=args.model_concurrency, throttle_in_stream=args.throttle_in_stream,
+        region_first_byte_ms={region: float(ms) for region, ms in (value.split("=", 1) for value in args.region_first_byte_ms)},
+        slow_first_byte_rate=args.slow_first_byte_rate, slow_first_byte_ms=args.slow_first_byte_ms, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Bedrock stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_arguments(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# Load driver: runs many concurrent chat sessions through app.main (the on_message handler)
+# against a Bedrock endpoint, normally the local stand-in in fake_bedrock.py.
+#
+# Reports time-to-first-token (p50/p95/p99), streamed tokens/s and event-loop lag.
+#
+#   python loadtest/load_driver.py --start-server --sessions 50 --messages 3 --mode Retrieve
+#   python loadtest/load_driver.py --endpoint http://127.0.0.1:8787 --model mistral.mistral-7b-instruct-v0:2
+
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import threading
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "What is the maximum capacity of product AB-0012?",
+    "max capacity AB-0012?",
+    "Who approves orders above the limit?",
+    "How often is capacity reviewed?",
+    "Does the limit apply to every prefecture?",
+    "What is the max capacity per site in Osaka?",
+]
+
+
+# with --follow-ups: a session asks QUESTIONS[0], then these
+FOLLOW_UPS = [
+    "Who approves orders above it?",
+    "How often is it reviewed?",
+    "Does it apply in Osaka?",
+    "And what about AB-0013?",
+]
+
+
+def build_parser(description: str = "Concurrent session load driver for app.main") -> argparse.ArgumentParser:
+    import fake_bedrock
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--endpoint", default="http://127.0.0.1:8787")
+    parser.add_argument("--start-server", action="store_true", help="run fake_bedrock in-process on --endpoint's port")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2, help="messages per session")
+    parser.add_argument("--users", type=int, default=2, help="distinct user identities the sessions are spread over")
+    parser.add_argument("--heavy-user-share", type=float, default=0, help="fraction of the sessions opened by load-user-0, the rest spread over the others")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="ADMISSION_MAX_CONCURRENT")
+    parser.add_argument("--user-max-concurrent", type=int, default=None, help="ADMISSION_USER_MAX_CONCURRENT")
+    parser.add_argument("--user-tokens-per-minute", type=int, default=None, help="ADMISSION_USER_TOKENS_PER_MINUTE")
+    parser.add_argument("--ramp-seconds", type=float, default=1.0)
+    parser.add_argument("--mode", default="Retrieve", choices=["Retrieve", "Generate", "RetrieveAndGenerate"])
+    parser.add_argument("--model", default="anthropic.claude-3-haiku-20240307-v1:0")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--document-count", type=int, default=8)
+    parser.add_argument("--search-type", default="DEFAULT", choices=["DEFAULT", "HYBRID", "SEMANTIC"])
+    parser.add_argument("--metadata-filter", default="", help='RetrievalFilter JSON, e.g. \'{"startsWith": {"key": "product_code", "value": "AB-00"}}\'')
+    parser.add_argument("--fallback-regions", default="", help="BEDROCK_FALLBACK_REGIONS for the model router, e.g. us-west-2")
+    parser.add_argument("--hedge", action="store_true", help="BEDROCK_HEDGE_ENABLED: hedge invocations slow to their first event")
+    parser.add_argument("--rerank", action="store_true", help="over-fetch and rerank locally, keeping --document-count")
+    parser.add_argument("--multi-query", action="store_true", help="search the question and its paraphrases concurrently, fused by reciprocal rank")
+    parser.add_argument("--follow-ups", action="store_true", help="every session asks one question, then follow-ups that refer back to it")
+    parser.add_argument("--auto-filter", action="store_true", help="filter retrieval by the product codes in the question")
+    fake_bedrock.add_arguments(parser)
+    return parser
+
+
+def parse_arguments():
+    return build_parser().parse_args()
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class MessageRecord():
+
+    def __init__(self, user: str):
+        self.user = user
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.end = None
+        self.text = ""
+        self.answer_ids = set()
+
+
+class EventLoopLagMonitor():
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+def default_settings(args, knowledge_base_id: str) -> dict:
+    return {
+        "KnowledgeBase": knowledge_base_id,
+        "AdditionalKnowledgeBases": [],
+        "RetrieveDocumentCount": args.document_count,
+        "SearchType": args.search_type,
+        "MetadataFilter": args.metadata_filter,
+        "AutoFilter": args.auto_filter,
+        "Rerank": args.rerank,
+        "MultiQuery": args.multi_query,
+        "Mode": args.mode,
+        "Model": args.model,
+        "Temperature": args.temperature,
+        "TopP": 1,
+        "TopK": 250,
+        "MaxTokenCount": 1024,
+        "PromptTemplate": True,
+        "Strict": False,
+        "Terse": False,
+        "AlignUnitsOfMeasure": True,
+        "AlignGeographicDivisions": True,
+        "StateConclusionFirst": False,
+        "SourceTableMarkdown": True,
+    }
+
+
+def session_question(index: int, i: int, args) -> str:
+    if args.follow_ups:
+        return FOLLOW_UPS[(index + i - 1) % len(FOLLOW_UPS)] if i > 0 else QUESTIONS[0]
+    return QUESTIONS[(index + i) % len(QUESTIONS)]
+
+
+def session_user(index: int, args) -> str:
+    if args.heavy_user_share and args.users > 1:
+        if index < args.sessions * args.heavy_user_share:
+            return "load-user-0"
+        return f"load-user-{1 + index % (args.users - 1)}"
+    return f"load-user-{index % args.users}"
+
+
+async def run_session(index: int, args, app, knowledge_base_id: str, records: list, errors: list):
+
+    import chainlit as cl
+    from chainlit.context import ChainlitContext, context_var
+    from chainlit.emitter import BaseChainlitEmitter
+    from chainlit.session import HTTPSession
+
+    class LoadTestSession(HTTPSession):
+
+        async def persist_file(self, name: str, mime: str, path: str = None, content = None):
+            # elements are not written to disk during load tests
+            return {"id": str(uuid.uuid4())}
+
+    class RecordingEmitter(BaseChainlitEmitter):
+
+        record = None
+
+        async def stream_start(self, step_dict):
+            if step_dict["type"] == "assistant_message":
+                self.record.answer_ids.add(step_dict["id"])
+
+        async def send_token(self, id: str, token: str, is_sequence=False):
+            record = self.record
+            if id in record.answer_ids:
+                if record.first_token is None:
+                    record.first_token = time.perf_counter()
+                record.text = token if is_sequence else record.text + token
+
+    await asyncio.sleep(random.random() * args.ramp_seconds)
+
+    session = LoadTestSession(id=str(uuid.uuid4()), user=cl.User(identifier=session_user(index, args)))
+    context = ChainlitContext(session)
+    context.emitter = RecordingEmitter(session)
+    context_var.set(context)
+
+    await app.setup_agent(default_settings(args, knowledge_base_id))
+
+    for i in range(args.messages):
+        record = MessageRecord(session.user.identifier)
+        context.emitter.record = record
+        try:
+            await app.main(cl.Message(content=session_question(index, i, args), author="User", type="user_message"))
+        except Exception as e:
+            errors.append(e)
+        record.end = time.perf_counter()
+        records.append(record)
+
+
+def start_server(args):
+    import uvicorn
+    import fake_bedrock
+    from urllib.parse import urlparse
+
+    endpoint = urlparse(args.endpoint)
+    server = uvicorn.Server(uvicorn.Config(fake_bedrock.create_app(fake_bedrock.config_from_arguments(args)),
+        host=endpoint.hostname, port=endpoint.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+
+async def run(args):
+
+    import app
+    import app_usage
+    import app_context_budget
+    import app_bedrock_router
+    import app_admission
+
+    knowledge_base_id = (await app.app_bedrock_lib.list_knowledge_bases())[0]
+
+    records = []
+    errors = []
+    monitor = EventLoopLagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*[run_session(i, args, app, knowledge_base_id, records, errors) for i in range(args.sessions)])
+    wall = time.perf_counter() - start
+    monitor.stop()
+
+    streamed = [record for record in records if record.first_token is not None]
+    tokens = sum(app_context_budget.estimate_tokens(record.text) for record in streamed)
+    stream_seconds = sum(record.end - record.first_token for record in streamed)
+
+    return {
+        "messages": len(records),
+        "errors": errors,
+        "wall": wall,
+        "ttft": [(record.first_token - record.start) * 1000 for record in streamed],
+        "ttft_by_user": {user: [(record.first_token - record.start) * 1000 for record in streamed if record.user == user]
+            for user in sorted({record.user for record in streamed})},
+        "total": [(record.end - record.start) * 1000 for record in records],
+        "tokens_per_stream": tokens / stream_seconds if stream_seconds else 0,
+        "tokens_aggregate": tokens / wall,
+        "lags": [lag * 1000 for lag in monitor.lags],
+        "usage": app_usage.process_usage.stats,
+        "routes": " ".join(f"{endpoint.name}={endpoint.successes}" for endpoint in app_bedrock_router._endpoints.values() if endpoint.successes),
+        "hedges": f"{app_bedrock_router.hedge_budget.hedges}/{app_bedrock_router.hedge_budget.requests}",
+        "admission": app_admission.controller.stats,
+    }
+
+
+def report(args, summary: dict):
+    ttft, total, lags, errors = summary["ttft"], summary["total"], summary["lags"], summary["errors"]
+    print(f"mode={args.mode} model={args.model} sessions={args.sessions} messages={summary['messages']} errors={len(errors)} wall={summary['wall']:.2f}s")
+    print(f"ttft ms         p50={percentile(ttft, 50):8.1f} p95={percentile(ttft, 95):8.1f} p99={percentile(ttft, 99):8.1f}")
+    print(f"total ms        p50={percentile(total, 50):8.1f} p95={percentile(total, 95):8.1f} p99={percentile(total, 99):8.1f}")
+    print(f"tokens/s        per stream={summary['tokens_per_stream']:8.1f} aggregate={summary['tokens_aggregate']:8.1f}")
+    print(f"loop lag ms     p50={percentile(lags, 50):8.1f} p95={percentile(lags, 95):8.1f} p99={percentile(lags, 99):8.1f} max={max(lags, default=0):8.1f}")
+    print(f"usage           {summary['usage']}")
+    print(f"routes          {summary['routes']} hedges={summary['hedges']}")
+    print(f"admission       {summary['admission']}")
+    if len(summary["ttft_by_user"]) > 1:
+        for user, values in summary["ttft_by_user"].items():
+            print(f"ttft ms {user} p50={percentile(values, 50):8.1f} p95={percentile(values, 95):8.1f} messages={len(values)}")
+    for error in errors[0:5]:
+        print(f"error: {error!r}")
+
+
+def configure_environment(args):
+    # must be set before the app modules (and their client registry) are imported
+    os.environ["BEDROCK_ENDPOINT_URL"] = args.endpoint
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    if args.fallback_regions:
+        os.environ["BEDROCK_FALLBACK_REGIONS"] = args.fallback_regions
+    if args.hedge:
+        os.environ["BEDROCK_HEDGE_ENABLED"] = "true"
+    for name, value in (("ADMISSION_MAX_CONCURRENT", args.max_concurrent), ("ADMISSION_USER_MAX_CONCURRENT", args.user_max_concurrent),
+            ("ADMISSION_USER_TOKENS_PER_MINUTE", args.user_tokens_per_minute)):
+        if value is not None:
+            os.environ[name] = str(value)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+    for name in ("AUTH_ADMIN_USR", "AUTH_ADMIN_PWD", "AUTH_USER_USR", "AUTH_USER_PWD"):
+        os.environ.setdefault(name, "loadtest")
+
+
+def main():
+    args = parse_arguments()
+
+    configure_environment(args)
+
+    if args.start_server:
+        start_server(args)
+
+    report(args, asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import asyncio
+import pytest
+
+# the app modules read their settings at import
+os.environ.setdefault("AWS_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+_sleep = asyncio.sleep
+
+
+class FakeClock():
+
+    # time.monotonic / time.perf_counter and asyncio.sleep for a module under test: sleeping advances the clock
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    async def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+        await _sleep(0)
+
+
+class FakeAsyncio():
+
+    # the asyncio module with sleep on the fake clock
+    def __init__(self, clock: FakeClock):
+        self.sleep = clock.sleep
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
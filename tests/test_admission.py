@@ -0,0 +1,175 @@
+import asyncio
+import pytest
+import app_admission
+
+
+@pytest.fixture
+def admission(monkeypatch, clock):
+    monkeypatch.setattr(app_admission, "time", clock)
+    return app_admission
+
+
+async def queue(controller, user: str, admitted: list, name: str):
+    await controller.acquire(user)
+    admitted.append(name)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_admits_immediately_under_the_limits(admission):
+    async def main():
+        controller = admission.AdmissionController(2, 2, 0)
+        await controller.acquire("a")
+        await controller.acquire("b")
+        assert controller.in_flight == 2
+        assert controller.queued == 0
+    asyncio.run(main())
+
+
+def test_queued_messages_are_admitted_round_robin_across_users(admission):
+    async def main():
+        controller = admission.AdmissionController(1, 0, 0)
+        await controller.acquire("heavy")
+        admitted = []
+        tasks = [asyncio.ensure_future(queue(controller, "heavy", admitted, f"heavy{i}")) for i in range(1, 4)]
+        await settle()
+        tasks.append(asyncio.ensure_future(queue(controller, "light", admitted, "light")))
+        await settle()
+        assert admitted == []
+        for _ in range(4):
+            user = "light" if admitted and admitted[-1] == "light" else "heavy"
+            controller.release(user)
+            await settle()
+        await asyncio.gather(*tasks)
+        # the light user waits for one heavy message, not for the heavy user's whole queue
+        assert admitted == ["heavy1", "light", "heavy2", "heavy3"]
+    asyncio.run(main())
+
+
+def test_position_counts_the_messages_admitted_first(admission):
+    async def main():
+        controller = admission.AdmissionController(1, 0, 0)
+        await controller.acquire("heavy")
+        heavy = [asyncio.ensure_future(controller.acquire("heavy")) for _ in range(2)]
+        await settle()
+        light = asyncio.ensure_future(controller.acquire("light"))
+        await settle()
+        heavy_futures = list(controller.queues["heavy"])
+        assert controller.position("heavy", heavy_futures[0]) == 1
+        assert controller.position("light", controller.queues["light"][0]) == 2
+        assert controller.position("heavy", heavy_futures[1]) == 3
+        for task in heavy + [light]:
+            task.cancel()
+        await asyncio.gather(*heavy, light, return_exceptions=True)
+    asyncio.run(main())
+
+
+def test_user_concurrency_limit_does_not_hold_back_other_users(admission):
+    async def main():
+        controller = admission.AdmissionController(0, 2, 0)
+        await controller.acquire("a")
+        await controller.acquire("a")
+        waiting = asyncio.ensure_future(controller.acquire("a"))
+        await settle()
+        assert not waiting.done()
+        await controller.acquire("b")
+        controller.release("a")
+        await settle()
+        assert waiting.done()
+        assert controller.user_in_flight["a"] == 2
+    asyncio.run(main())
+
+
+def test_unknown_spend_admits_one_message_at_a_time(admission):
+    async def main():
+        controller = admission.AdmissionController(0, 0, 1000)
+        await controller.acquire("a")
+        waiting = asyncio.ensure_future(controller.acquire("a"))
+        await settle()
+        assert not waiting.done()
+        # the first invocation tells what a message spends: two of 300 fit next to the 300 already spent
+        controller.charge("a", 300)
+        controller.release("a")
+        await settle()
+        assert waiting.done()
+        await controller.acquire("a")
+        assert controller.user_in_flight["a"] == 2
+    asyncio.run(main())
+
+
+def test_token_budget_holds_messages_until_usage_leaves_the_window(admission, clock):
+    async def main():
+        controller = admission.AdmissionController(0, 0, 1000)
+        await controller.acquire("a")
+        controller.charge("a", 1000)
+        controller.release("a")
+        waiting = asyncio.ensure_future(controller.acquire("a"))
+        await settle()
+        assert not waiting.done()
+        # another user's budget is separate
+        await controller.acquire("b")
+        clock.advance(admission.WINDOW_SECONDS)
+        controller.release("b")
+        await settle()
+        assert waiting.done()
+        assert controller.tokens_last_minute("a", clock.monotonic()) == 0
+    asyncio.run(main())
+
+
+def test_budget_retry_admits_without_another_release(monkeypatch):
+    # real time: the retry is a loop timer set for when the oldest usage leaves the window
+    monkeypatch.setattr(app_admission, "WINDOW_SECONDS", 0.05)
+    async def main():
+        controller = app_admission.AdmissionController(0, 0, 1000)
+        await controller.acquire("a")
+        controller.charge("a", 1000)
+        controller.release("a")
+        await asyncio.wait_for(controller.acquire("a"), 1)
+        # admitted from the queue by the timer
+        assert controller.queued == 1
+    asyncio.run(main())
+
+
+def test_queued_message_times_out(monkeypatch):
+    monkeypatch.setattr(app_admission, "ADMISSION_QUEUE_TIMEOUT_SECONDS", 0.02)
+    monkeypatch.setattr(app_admission, "ADMISSION_POSITION_INTERVAL_SECONDS", 0.01)
+    async def main():
+        controller = app_admission.AdmissionController(1, 0, 0)
+        await controller.acquire("a")
+        with pytest.raises(app_admission.AdmissionTimeout):
+            await controller.acquire("b")
+        assert controller.timed_out == 1
+        assert controller.queues == {}
+    asyncio.run(main())
+
+
+def test_cancelled_message_leaves_the_queue(admission):
+    async def main():
+        controller = admission.AdmissionController(1, 0, 0)
+        await controller.acquire("a")
+        waiting = asyncio.ensure_future(controller.acquire("b"))
+        await settle()
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.queues == {}
+        controller.release("a")
+        assert controller.in_flight == 0
+    asyncio.run(main())
+
+
+def test_on_wait_is_told_the_queue_position(admission):
+    async def main():
+        controller = admission.AdmissionController(1, 0, 0)
+        await controller.acquire("a")
+        positions = []
+        async def on_wait(position):
+            positions.append(position)
+        waiting = asyncio.ensure_future(controller.acquire("b", on_wait))
+        await settle()
+        controller.release("a")
+        await waiting
+        assert positions == [1]
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import pytest
+import app_answer_cache
+
+FINGERPRINT = "fingerprint"
+KB = ["KB1"]
+
+
+@pytest.fixture
+def cache():
+    return app_answer_cache.AnswerCache(60, 16, 0.8)
+
+
+def test_reworded_question_is_answered_from_the_cache(cache):
+    cache.put(FINGERPRINT, KB, "Is the X100 suitable for outdoor use in winter?", "yes")
+    assert cache.get(FINGERPRINT, "is the X100 suitable for outdoor use in the winter") == "yes"
+
+
+def test_negation_is_not_answered_although_the_wording_is_similar(cache):
+    question = "is the X100 suitable for outdoor use in winter"
+    negated = "is the X100 not suitable for outdoor use in winter"
+    # 5 of 6 content terms shared
+    assert app_answer_cache.similarity(app_answer_cache.query_terms(question), app_answer_cache.query_terms(negated)) >= 0.8
+    cache.put(FINGERPRINT, KB, question, "yes")
+    assert cache.get(FINGERPRINT, negated) is None
+
+
+@pytest.mark.parametrize("negated", [
+    "is the X100 not suitable for outdoor use in winter",
+    "isn't the X100 suitable for outdoor use in winter",
+    "is the X100 suitable for outdoor use in winter without a cover",
+    "is the X100 suitable for outdoor use except in winter",
+    "is the X100 never suitable for outdoor use in winter",
+])
+def test_negated_question_is_not_answered_with_the_opposite_answer(cache, negated):
+    question = "is the X100 suitable for outdoor use in winter"
+    cache.put(FINGERPRINT, KB, question, "yes")
+    assert cache.get(FINGERPRINT, negated) is None
+    cache.put(FINGERPRINT, KB, negated, "no")
+    assert cache.get(FINGERPRINT, question) == "yes"
+
+
+def test_contracted_and_spelled_out_negations_are_the_same_exact_term():
+    assert app_answer_cache.exact_terms("doesn't the X100 work in winter") == app_answer_cache.exact_terms("does the X100 not work in winter")
+    assert app_answer_cache.exact_terms("can’t the X100 work in winter") == app_answer_cache.exact_terms("the X100 cannot work in winter")
+
+
+def test_questions_about_different_numbers_do_not_share_answers(cache):
+    cache.put(FINGERPRINT, KB, "what is the maximum pressure at 10 bar inlet for the pump", "a")
+    assert cache.get(FINGERPRINT, "what is the maximum pressure at 20 bar inlet for the pump") is None
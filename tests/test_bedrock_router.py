@@ -0,0 +1,233 @@
+import time
+import asyncio
+import collections
+import pytest
+import botocore.exceptions
+import app_bedrock_clients
+import app_bedrock_router
+from conftest import FakeAsyncio
+
+SONNET = "anthropic.claude-3-sonnet-20240229-v1:0"
+HAIKU = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def client_error(code: str) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, "InvokeModelWithResponseStream")
+
+
+class FakeBedrock():
+
+    # stands in for the model strategy: outcomes scripted per (model, region) in call order, a response by default.
+    # An outcome is a response, an exception to raise, or a number of (real) seconds before the default response.
+    def __init__(self):
+        self.outcomes = collections.defaultdict(collections.deque)
+        self.calls = []
+
+    def script(self, bedrock_model_id: str, region: str, *outcomes):
+        self.outcomes[(bedrock_model_id, region)].extend(outcomes)
+
+    async def send_request_async(self, request: dict, bedrock_runtime, bedrock_model_id: str) -> dict:
+        # the fake client is the region name
+        key = (bedrock_model_id, bedrock_runtime)
+        self.calls.append(key)
+        outcome = self.outcomes[key].popleft() if self.outcomes[key] else {"body": []}
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, (int, float)):
+            await asyncio.sleep(outcome)
+            return {"body": [], "region": bedrock_runtime}
+        return dict(outcome, region=bedrock_runtime)
+
+
+@pytest.fixture
+def router(monkeypatch, clock):
+    monkeypatch.setattr(app_bedrock_router, "time", clock)
+    monkeypatch.setattr(app_bedrock_router, "asyncio", FakeAsyncio(clock))
+    monkeypatch.setattr(app_bedrock_router, "_endpoints", {})
+    monkeypatch.setattr(app_bedrock_router, "_candidates", {})
+    monkeypatch.setattr(app_bedrock_router, "hedge_budget", app_bedrock_router.HedgeBudget(5))
+    monkeypatch.setattr(app_bedrock_router, "AWS_REGION", "us-east-1")
+    monkeypatch.setattr(app_bedrock_router, "BEDROCK_FALLBACK_REGIONS", ["us-west-2"])
+    monkeypatch.setattr(app_bedrock_router, "BEDROCK_MODEL_FALLBACKS", {SONNET: [HAIKU]})
+    monkeypatch.setattr(app_bedrock_router, "BEDROCK_ROUTER_ENABLED", True)
+    monkeypatch.setattr(app_bedrock_router, "BEDROCK_HEDGE_ENABLED", False)
+    monkeypatch.setattr(app_bedrock_clients, "get_client", lambda service, region=None, **kwargs: region)
+    return app_bedrock_router
+
+
+def send(router, fake, bedrock_model_id=SONNET):
+    return asyncio.run(router.send_request(fake, {}, bedrock_model_id))
+
+
+def test_throttle_halves_the_rate_once_per_burst(router, clock):
+    endpoint = router.Endpoint(HAIKU, "us-east-1")
+    started_at = clock.monotonic()
+    clock.advance(1)
+    endpoint.on_throttle(started_at)
+    assert endpoint.rate == router.BEDROCK_ROUTER_MAX_RATE / 2
+    # requests sent before the decrease belong to the same burst
+    endpoint.on_throttle(started_at)
+    assert endpoint.rate == router.BEDROCK_ROUTER_MAX_RATE / 2
+    clock.advance(1)
+    endpoint.on_throttle(clock.monotonic())
+    assert endpoint.rate == router.BEDROCK_ROUTER_MAX_RATE / 4
+
+
+def test_rate_never_drops_below_the_minimum(router, clock):
+    endpoint = router.Endpoint(HAIKU, "us-east-1")
+    for _ in range(20):
+        clock.advance(1)
+        endpoint.on_throttle(clock.monotonic())
+    assert endpoint.rate == router.BEDROCK_ROUTER_MIN_RATE
+
+
+def test_successes_raise_the_rate_back_to_unlimited(router, clock):
+    endpoint = router.Endpoint(HAIKU, "us-east-1")
+    endpoint.on_throttle(clock.monotonic())
+    steps = 0
+    while endpoint.rate is not None:
+        endpoint.on_success(0.1)
+        steps += 1
+    assert steps == (router.BEDROCK_ROUTER_MAX_RATE / 2) / router.BEDROCK_ROUTER_RATE_INCREASE
+
+
+def test_token_bucket_paces_a_throttled_endpoint(router, clock):
+    endpoint = router.Endpoint(HAIKU, "us-east-1")
+    assert endpoint.wait_seconds(clock.monotonic()) == 0
+    endpoint.on_throttle(clock.monotonic())
+    rate = endpoint.rate
+    assert endpoint.wait_seconds(clock.monotonic()) == pytest.approx(1 / rate)
+    clock.advance(1 / rate)
+    assert endpoint.wait_seconds(clock.monotonic()) == 0
+    endpoint.take()
+    assert endpoint.wait_seconds(clock.monotonic()) == pytest.approx(1 / rate)
+
+
+def test_slow_endpoint_is_cooled_down(router, clock):
+    endpoint = router.Endpoint(HAIKU, "us-east-1")
+    endpoint.on_success(router.BEDROCK_ROUTER_SLOW_SECONDS + 1)
+    assert endpoint.wait_seconds(clock.monotonic()) == pytest.approx(router.BEDROCK_ROUTER_COOLDOWN_SECONDS)
+    clock.advance(router.BEDROCK_ROUTER_COOLDOWN_SECONDS)
+    assert endpoint.wait_seconds(clock.monotonic()) == 0
+    # back in rotation from a clean average
+    assert endpoint.first_byte_seconds is None
+
+
+def test_throttled_region_fails_over_to_the_next_region(router):
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ThrottlingException"))
+    response, route = send(router, fake)
+    assert fake.calls == [(SONNET, "us-east-1"), (SONNET, "us-west-2")]
+    assert (route.bedrock_model_id, route.region, route.attempts) == (SONNET, "us-west-2", 2)
+    assert router.endpoint(SONNET, "us-east-1").rate == router.BEDROCK_ROUTER_MAX_RATE / 2
+
+
+def test_sibling_model_answers_when_every_region_is_throttled(router, monkeypatch):
+    # no backoff: both regions are still waiting for their next token when the third attempt starts
+    monkeypatch.setattr(router, "backoff_seconds", lambda attempt: 0)
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ThrottlingException"))
+    fake.script(SONNET, "us-west-2", client_error("ThrottlingException"))
+    response, route = send(router, fake)
+    assert fake.calls == [(SONNET, "us-east-1"), (SONNET, "us-west-2"), (HAIKU, "us-east-1")]
+    assert (route.bedrock_model_id, route.region) == (HAIKU, "us-east-1")
+
+
+def test_retries_back_off(router, clock):
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ServiceUnavailableException"))
+    send(router, fake)
+    assert len(clock.slept) == 1
+    assert 0 <= clock.slept[0] <= router.BEDROCK_ROUTER_BACKOFF_BASE_SECONDS * 2
+
+
+def test_non_retryable_error_is_raised_without_retry(router):
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ValidationException"))
+    with pytest.raises(botocore.exceptions.ClientError) as raised:
+        send(router, fake)
+    assert raised.value.response["Error"]["Code"] == "ValidationException"
+    assert fake.calls == [(SONNET, "us-east-1")]
+
+
+def test_fallback_region_without_the_model_is_skipped_for_longer(router, monkeypatch, clock):
+    monkeypatch.setattr(router, "backoff_seconds", lambda attempt: 0)
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ThrottlingException"))
+    fake.script(SONNET, "us-west-2", client_error("ResourceNotFoundException"))
+    response, route = send(router, fake)
+    assert (route.bedrock_model_id, route.region) == (HAIKU, "us-east-1")
+    skipped = router.endpoint(SONNET, "us-west-2")
+    assert skipped.wait_seconds(clock.monotonic()) > router.BEDROCK_ROUTER_COOLDOWN_SECONDS * 9
+
+
+def test_unavailable_primary_is_not_retried(router):
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("AccessDeniedException"))
+    with pytest.raises(botocore.exceptions.ClientError):
+        send(router, fake)
+    assert fake.calls == [(SONNET, "us-east-1")]
+
+
+def test_gives_up_after_max_attempts_with_the_last_error(router, monkeypatch):
+    monkeypatch.setattr(router, "BEDROCK_ROUTER_MAX_ATTEMPTS", 3)
+    fake = FakeBedrock()
+    for region in ("us-east-1", "us-west-2"):
+        fake.script(HAIKU, region, *[client_error("ThrottlingException")] * 3)
+    with pytest.raises(botocore.exceptions.ClientError) as raised:
+        send(router, fake, HAIKU)
+    assert raised.value.response["Error"]["Code"] == "ThrottlingException"
+    assert len(fake.calls) == 3
+
+
+def test_no_new_attempt_after_the_deadline(router, monkeypatch):
+    monkeypatch.setattr(router, "BEDROCK_ROUTER_DEADLINE_SECONDS", 1)
+    monkeypatch.setattr(router, "backoff_seconds", lambda attempt: 2)
+    fake = FakeBedrock()
+    fake.script(SONNET, "us-east-1", client_error("ThrottlingException"))
+    with pytest.raises(botocore.exceptions.ClientError):
+        send(router, fake)
+    assert len(fake.calls) == 1
+
+
+def test_throttled_endpoint_is_used_when_nothing_else_is_left(router, monkeypatch, clock):
+    monkeypatch.setattr(router, "BEDROCK_FALLBACK_REGIONS", [])
+    fake = FakeBedrock()
+    fake.script(HAIKU, "us-east-1", client_error("ThrottlingException"))
+    response, route = send(router, fake, HAIKU)
+    assert fake.calls == [(HAIKU, "us-east-1")] * 2
+    assert route.attempts == 2
+    # the backoff, then the wait for the endpoint's next token
+    assert sum(clock.slept) >= 1 / router.endpoint(HAIKU, "us-east-1").rate - 1e-9
+    # neither counts towards the answering attempt's first byte
+    assert route.first_byte_seconds == 0
+
+
+def test_slow_first_event_is_hedged_to_another_region(router, monkeypatch):
+    # real time: the hedge fires from asyncio.wait's timeout
+    monkeypatch.setattr(router, "time", time)
+    monkeypatch.setattr(router, "asyncio", asyncio)
+    monkeypatch.setattr(router, "BEDROCK_HEDGE_ENABLED", True)
+    monkeypatch.setattr(router, "BEDROCK_HEDGE_DEFAULT_SECONDS", 0.05)
+    monkeypatch.setattr(router, "hedge_budget", router.HedgeBudget(100))
+    fake = FakeBedrock()
+    fake.script(HAIKU, "us-east-1", 5.0)
+    response, route = send(router, fake, HAIKU)
+    assert (route.region, route.hedged) == ("us-west-2", True)
+    assert response["region"] == "us-west-2"
+    # the slow loser is kept in its endpoint's first-byte samples as a censored value
+    samples = router.endpoint(HAIKU, "us-east-1").first_byte_samples
+    assert len(samples) == 1 and samples[0] >= 0.05
+
+
+def test_hedges_are_limited_by_the_budget(router, monkeypatch):
+    monkeypatch.setattr(router, "time", time)
+    monkeypatch.setattr(router, "asyncio", asyncio)
+    monkeypatch.setattr(router, "BEDROCK_HEDGE_ENABLED", True)
+    monkeypatch.setattr(router, "BEDROCK_HEDGE_DEFAULT_SECONDS", 0.01)
+    fake = FakeBedrock()
+    fake.script(HAIKU, "us-east-1", 0.05)
+    response, route = send(router, fake, HAIKU)
+    # 5% of one request is not a whole hedge: the primary is waited for
+    assert (route.region, route.hedged) == ("us-east-1", False)
+    assert fake.calls == [(HAIKU, "us-east-1")]
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+import pytest
+import app_retrieve_lib
+
+
+@pytest.fixture
+def retrieve_lib(monkeypatch):
+    monkeypatch.setattr(app_retrieve_lib, "_semaphore", asyncio.Semaphore(1))
+    return app_retrieve_lib
+
+
+def test_timed_out_call_holds_its_slot_until_the_thread_finishes(retrieve_lib):
+    finish = threading.Event()
+    started = []
+
+    def slow():
+        started.append("slow")
+        finish.wait(5)
+        return "slow"
+
+    def fast():
+        started.append("fast")
+        return "fast"
+
+    async def main():
+        with pytest.raises(retrieve_lib.RetrieveTimeoutError):
+            await retrieve_lib._call(0.01, slow)
+        waiting = asyncio.ensure_future(retrieve_lib._call(5, fast))
+        await asyncio.sleep(0.05)
+        # the slow call is still running in its thread, so the next one is not sent yet
+        assert started == ["slow"]
+        finish.set()
+        assert await waiting == "fast"
+        assert started == ["slow", "fast"]
+    asyncio.run(main())
+
+
+def test_failed_call_releases_its_slot(retrieve_lib):
+    def fail():
+        raise ValueError("boom")
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await retrieve_lib._call(1, fail)
+        assert await retrieve_lib._call(1, lambda: "ok") == "ok"
+    asyncio.run(main())